@@ -0,0 +1,107 @@
+class BalanceIndex:
+    def __init__(self) -> None:
+        """
+        Verified account balances, keyed by compressed pubkey (hex).
+
+        Kept up to date one block at a time as blocks are connected to or
+        disconnected from the chain, so a balance lookup never has to scan it.
+        """
+        self.balances = {}
+
+    def get(self, address):
+        """
+        :param address: <str> compressed pubkey (hex)
+        :returns: <int> the verified balance of the address
+        """
+        return self.balances.get(address, 0)
+
+    def apply_block(self, block):
+        """
+        Credit and debit the transactions of a block being added to the chain
+
+        :returns: <dict> the undo record of the block: address -> change in balance
+        """
+        changes = self.changes(block)
+        for address, amount in changes.items():
+            self._credit(address, amount)
+        return changes
+
+    def revert_block(self, block, changes=None):
+        """
+        Undo apply_block() for a block being removed from the tip of the chain
+
+        :param changes: <dict> the undo record apply_block() returned for the block,
+                        if it was kept. Otherwise it's worked out from the block again
+        """
+        if changes is None:
+            changes = self.changes(block)
+        for address, amount in changes.items():
+            self._credit(address, -amount)
+
+    def rebuild(self, chain, start=0, balances=None):
+        """
+        Recompute the balances from the blocks of `chain` from height `start` on
+
+        :param balances: <dict> the balances as of height `start` (e.g. from a
+                         checkpoint)
+        """
+        self.balances = dict(balances or {})
+        for height in range(start, len(chain)):
+            self.apply_block(chain[height])
+
+    def changes(self, block):
+        """
+        :returns: <dict> address -> how much the block changes its balance by
+        """
+        changes = {}
+        coinbase_tx = block.transactions["coinbase"]
+        if coinbase_tx:
+            address = coinbase_tx.recipient_address
+            changes[address] = changes.get(address, 0) + coinbase_tx.amount
+        # Scan the block's columnar table rather than materializing each transaction
+        table = block.table()
+        # Fees come out of the sender's balance, and go to the miner through the
+        # coinbase transaction
+        for sender, recipient, amount, fee in zip(
+            table.senders, table.recipients, table.amounts, table.fees
+        ):
+            sender, recipient = sender.hex(), recipient.hex()
+            changes[sender] = changes.get(sender, 0) - (amount + fee)
+            changes[recipient] = changes.get(recipient, 0) + amount
+        return changes
+
+    def _credit(self, address, amount):
+        balance = self.balances.get(address, 0) + amount
+        if balance:
+            self.balances[address] = balance
+        else:
+            self.balances.pop(address, None)
+
+
+class BalanceView:
+    def __init__(self, index) -> None:
+        """
+        Balances as of another height than the index's, e.g. a fork point or a
+        block of a peer's chain. They're kept as changes on top of the index, so
+        none of its balances are copied
+
+        :param index: <object> the BalanceIndex to start from
+        """
+        self.index = index
+        self.changes = {}
+
+    def get(self, address):
+        """
+        :param address: <str> compressed pubkey (hex)
+        :returns: <int> the balance of the address as of the view's height
+        """
+        return self.index.get(address) + self.changes.get(address, 0)
+
+    def apply(self, changes, sign=1):
+        """
+        Move the view forward past a block (or back before it, if sign is -1)
+
+        :param changes: <dict> address -> change in balance (see BalanceIndex.changes)
+        """
+        for address, amount in changes.items():
+            self.changes[address] = self.changes.get(address, 0) + sign * amount
@@ -1,36 +1,193 @@
 import json
+import math
 from time import time
 from hashlib import sha256
 
+from transaction import Transaction, TransactionTable
+from merkle import merkle_root, merkle_proof
+from difficulty import DEFAULT_DIFFICULTY, MAX_TARGET, target_from_difficulty
+from encoding import (
+    Reader,
+    FORMAT_VERSION,
+    VERSION,
+    KIND,
+    TIMESTAMP,
+    COUNT,
+    NONCE,
+    HASH_LENGTH,
+    encode_previous_hash,
+    decode_previous_hash,
+    encode_target,
+    decode_target,
+)
 
-from transaction import Transaction
+# Target of blocks created without one (e.g. by older versions, which had a fixed
+# difficulty)
+DEFAULT_TARGET = target_from_difficulty(DEFAULT_DIFFICULTY)
 
 
 class Block:
+    __slots__ = (
+        "previous_hash",
+        "timestamp",
+        "transactions",
+        "nonce",
+        "target",
+        "_sealed",
+        "_hash",
+        "_table",
+        "_merkle_root",
+    )
+
     def __init__(
         self,
         previous_hash=None,
-        timestamp=time(),
+        timestamp=None,
         transactions={"coinbase": None, "regular": []},
         nonce=0,
+        target=DEFAULT_TARGET,
     ) -> None:
         self.previous_hash = previous_hash
-        self.timestamp = timestamp
+        self.timestamp = time() if timestamp is None else timestamp
         self.transactions = transactions
         self.nonce = nonce
+        # The block's hash, as a 256 bit number, must be below this
+        self.target = target
+        # Once sealed, a block can't be modified and its hash is memoized
+        self._sealed = False
+        self._hash = None
+        self._table = None
+        self._merkle_root = None
+
+    def __setattr__(self, name, value):
+        if getattr(self, "_sealed", False) and not name.startswith("_"):
+            raise AttributeError(f"Cannot set {name}, block {self._hash} is sealed")
+        super().__setattr__(name, value)
 
     def __str__(self) -> str:
         return json.dumps(self.json_serialize())
 
+    def seal(self):
+        """
+        Freeze the block once its proof-of-work is final (i.e. it's being added to a
+        chain), so its Merkle root and hash only need to be computed once
+        """
+        if self._sealed:
+            return self
+        self.transactions = {
+            "coinbase": self.transactions["coinbase"],
+            "regular": tuple(self.transactions["regular"]),
+        }
+        self._merkle_root = self.merkle_root()
+        self._sealed = True
+        return self
+
+    def table(self):
+        """
+        Columnar view of the regular transactions (see TransactionTable), memoized
+        once the block is sealed
+        """
+        if self._table is not None:
+            return self._table
+        table = TransactionTable(self.transactions["regular"])
+        if self._sealed:
+            self._table = table
+        return table
+
+    def all_transactions(self):
+        """
+        The coinbase transaction (if any) followed by the regular transactions, in
+        the order they're committed to by the Merkle root
+        """
+        coinbase_tx = self.transactions["coinbase"]
+        regular_txs = list(self.transactions["regular"])
+        return [coinbase_tx] + regular_txs if coinbase_tx else regular_txs
+
+    def merkle_leaves(self):
+        return [sha256(tx.binary_serialize()).digest() for tx in self.all_transactions()]
+
+    def merkle_root(self):
+        """
+        The raw Merkle root of the block's transaction ids, memoized once the block is
+        sealed
+        """
+        if self._merkle_root is not None:
+            return self._merkle_root
+        root = merkle_root(self.merkle_leaves())
+        if self._sealed:
+            self._merkle_root = root
+        return root
+
+    def merkle_proof(self, tx_id):
+        """
+        :param tx_id: <str> id of a transaction in this block
+        :returns: <list> the transaction's inclusion path (see merkle.merkle_proof),
+                  or None if it isn't in the block
+        """
+        leaves = self.merkle_leaves()
+        try:
+            index = leaves.index(bytes.fromhex(tx_id))
+        except ValueError:
+            return None
+        return merkle_proof(leaves, index)
+
     def hash(self):
-        block_data = json.dumps(self.json_serialize()).encode()
-        return sha256(block_data).hexdigest()
+        if self._hash is not None:
+            return self._hash
+        block_hash = sha256(self.header_bytes()).hexdigest()
+        if self._sealed:
+            self._hash = block_hash
+        return block_hash
+
+    def cache_hash(self, block_hash):
+        """
+        Memoize a hash known from elsewhere (e.g. the block log's index) for a sealed
+        block
+        """
+        if self._sealed:
+            self._hash = block_hash
+
+    def hash_prefix(self):
+        """
+        The bytes of the header that come before the nonce. The nonce is the last
+        field, so these stay the same while mining, and they're the same size no
+        matter how many transactions the block holds
+        """
+        return (
+            VERSION.pack(FORMAT_VERSION)
+            + encode_previous_hash(self.previous_hash)
+            + self.merkle_root()
+            + TIMESTAMP.pack(self.timestamp)
+            + encode_target(self.target)
+        )
+
+    def header_bytes(self):
+        """
+        The binary block header, which is the block's hash preimage
+        """
+        return self.hash_prefix() + NONCE.pack(self.nonce)
 
-    def valid_proof(self, difficulty):
+    def binary_serialize(self):
         """
-        Determine whether a proof used in PoW is a valid difficulty
+        The canonical binary encoding of the block: its header, then its transactions
         """
-        return self.hash()[:difficulty] == "0" * difficulty
+        coinbase_tx = self.transactions["coinbase"]
+        regular_txs = self.transactions["regular"]
+        parts = [
+            self.header_bytes(),
+            KIND.pack(1) + coinbase_tx.binary_serialize()
+            if coinbase_tx
+            else KIND.pack(0),
+            COUNT.pack(len(regular_txs)),
+        ]
+        parts.extend(tx.binary_serialize() for tx in regular_txs)
+        return b"".join(parts)
+
+    def valid_proof(self):
+        """
+        Determine whether the block's hash, as a 256 bit number, is below its target
+        """
+        return int(self.hash(), 16) < self.target
 
     def json_serialize(self):
         coinbase_tx = (
@@ -44,6 +201,21 @@ class Block:
             "timestamp": self.timestamp,
             "transactions": {"coinbase": coinbase_tx, "regular": regular_txs},
             "proof": self.nonce,
+            "target": f"{self.target:064x}",
+            "merkle_root": self.merkle_root().hex(),
+        }
+
+    def header_serialize(self):
+        """
+        The block's hash and header fields, without its transactions
+        """
+        return {
+            "hash": self.hash(),
+            "previous_hash": self.previous_hash,
+            "merkle_root": self.merkle_root().hex(),
+            "timestamp": self.timestamp,
+            "target": f"{self.target:064x}",
+            "proof": self.nonce,
         }
 
     @staticmethod
@@ -51,7 +223,7 @@ class Block:
         previous_hash = json_block["previous_hash"]
         timestamp = json_block["timestamp"]
         coinbase_tx = Transaction.json_deserialize(
-            json_block["transactions"]["coinbase"]
+            json_block["transactions"]["coinbase"], coinbase=True
         )
         regular_txs = [
             Transaction.json_deserialize(tx)
@@ -62,5 +234,97 @@ class Block:
             "regular": regular_txs,
         }
         proof = json_block["proof"]
-        block = Block(previous_hash, timestamp, transactions, proof)
-        return block
+        check_header(previous_hash, timestamp, proof)
+        target_hex = json_block.get("target", f"{DEFAULT_TARGET:064x}")
+        if not isinstance(target_hex, str):
+            raise ValueError(f"Invalid target {target_hex!r}")
+        target = int(target_hex, 16)
+        if not 0 < target <= MAX_TARGET:
+            raise ValueError(f"Invalid target {target_hex}")
+        block = Block(previous_hash, timestamp, transactions, proof, target)
+        # Older JSON blocks don't carry their root
+        root = json_block.get("merkle_root")
+        if root is not None and not isinstance(root, str):
+            raise ValueError(f"Invalid Merkle root {root!r}")
+        return seal_deserialized(block, bytes.fromhex(root) if root else None)
+
+    @staticmethod
+    def binary_deserialize(data):
+        """
+        Read a block written by binary_serialize()
+        """
+        reader = Reader(data)
+        version = reader.unpack(VERSION)
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported binary block version {version}")
+        previous_hash = decode_previous_hash(reader)
+        root = reader.read(HASH_LENGTH)
+        timestamp = reader.unpack(TIMESTAMP)
+        target = decode_target(reader)
+        if not target:
+            raise ValueError("Invalid target 0")
+        nonce = reader.unpack(NONCE)
+        check_header(previous_hash, timestamp, nonce)
+        coinbase_tx = (
+            Transaction.binary_deserialize(reader, coinbase=True)
+            if reader.unpack(KIND)
+            else None
+        )
+        regular_txs = [
+            Transaction.binary_deserialize(reader) for _ in range(reader.unpack(COUNT))
+        ]
+        if not reader.at_end():
+            raise ValueError("Trailing data after binary block")
+        transactions = {"coinbase": coinbase_tx, "regular": regular_txs}
+        block = Block(previous_hash, timestamp, transactions, nonce, target)
+        return seal_deserialized(block, root)
+
+
+def check_header(previous_hash, timestamp, nonce):
+    """
+    Check the types and ranges of a deserialized block's header fields, so a
+    malformed block is rejected up front instead of failing once it's hashed
+
+    :raises ValueError: if a field can't be encoded
+    """
+    if previous_hash is not None and not isinstance(previous_hash, str):
+        raise ValueError(f"Invalid previous hash {previous_hash!r}")
+    if isinstance(timestamp, bool) or not isinstance(timestamp, (int, float)):
+        raise ValueError(f"Invalid timestamp {timestamp!r}")
+    # Timestamps are encoded as doubles. Ints too large for one overflow
+    try:
+        finite = math.isfinite(timestamp)
+    except OverflowError:
+        finite = False
+    if not finite:
+        raise ValueError(f"Invalid timestamp {timestamp!r}")
+    if isinstance(nonce, bool) or not isinstance(nonce, int):
+        raise ValueError(f"Invalid proof {nonce!r}")
+    if not 0 <= nonce < 1 << (8 * NONCE.size):
+        raise ValueError(f"Proof {nonce} is out of range")
+
+
+def seal_deserialized(block, root=None):
+    """
+    Seal a deserialized block, making sure its transactions are the only ones with
+    its Merkle root, and the ones its header commits to (if it came with a root).
+
+    A tree level with an odd number of nodes pairs its last node with itself, so
+    repeating the last transactions of a block gives another block with the same
+    root and hash (CVE-2012-2459). Any such copy repeats a transaction, so blocks
+    that do are rejected before they could be mistaken for (or shadow) the real one
+
+    :param root: <bytes> the raw Merkle root the block was sent with, if any
+    :returns: <object> the sealed block
+    :raises ValueError: if a transaction repeats or the root doesn't match
+    """
+    leaves = block.merkle_leaves()
+    if len(set(leaves)) != len(leaves):
+        raise ValueError("Duplicate transaction in block")
+    # Memoized by seal(), so the transactions are only hashed once
+    block._merkle_root = merkle_root(leaves)
+    block.seal()
+    if root is not None and block.merkle_root() != root:
+        raise ValueError(f"Merkle root mismatch in block {block.hash()}")
+    return block
+
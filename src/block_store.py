@@ -0,0 +1,214 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from block import Block
+
+# Record header: payload length and CRC32 of the payload
+RECORD_HEADER = struct.Struct(">II")
+# Index entry: offset of a record in the log and the hash of its block
+INDEX_ENTRY = struct.Struct(">Q32s")
+
+
+class BlockLog:
+    def __init__(self, directory="db", sync_every=16, codec="binary") -> None:
+        """
+        Append-only block storage.
+
+        Blocks are stored one after another in `blocks.log` as length-prefixed,
+        checksummed records, and `blocks.idx` holds the offset and hash of every
+        record, so adding a block only writes that block, and the chain can be indexed
+        without decoding it. Records are read through a memory map of the log. Writes reach the OS immediately, but
+        are only fsynced every `sync_every` blocks (and on sync()/close()).
+
+        A crash can leave a torn record at the end of the log, or an index that is
+        out of step with it. Both are repaired when the log is opened.
+
+        :param directory: <str> directory holding the log and index files
+        :param sync_every: <int> number of appended blocks between fsyncs
+        :param codec: <str> "binary" or "json", how new blocks are encoded. Logs can
+                      mix both, each record is decoded according to its contents
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.log_path = os.path.join(directory, "blocks.log")
+        self.index_path = os.path.join(directory, "blocks.idx")
+        self.sync_every = sync_every
+        self.codec = codec
+        self.unsynced = 0
+        self.log = open(self.log_path, "a+b")
+        self.index = open(self.index_path, "a+b")
+        self.offsets = []
+        self.hashes = []
+        self.map = None
+        # Several threads can read blocks at once, and the first to find the log has
+        # grown past the map replaces it
+        self.map_lock = threading.Lock()
+        self.recover()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def recover(self):
+        """
+        Load the index, and bring it and the log back in step after a crash
+        """
+        self.index.seek(0)
+        index_data = self.index.read()
+        entries = [
+            INDEX_ENTRY.unpack_from(index_data, i * INDEX_ENTRY.size)
+            for i in range(len(index_data) // INDEX_ENTRY.size)
+        ]
+        log_size = os.path.getsize(self.log_path)
+        offsets = [offset for offset, _ in entries]
+        hashes = [block_hash.hex() for _, block_hash in entries]
+
+        # Drop index entries that point past the end of the log, then re-check the
+        # last record the index knows about, since it may be torn
+        while offsets and offsets[-1] >= log_size:
+            offsets.pop()
+            hashes.pop()
+        end = offsets.pop() if offsets else 0
+        del hashes[len(offsets) :]
+
+        # Re-index every intact record from there on, and cut off whatever follows
+        while True:
+            payload = self.read_record(end)
+            if payload is None:
+                break
+            offsets.append(end)
+            hashes.append(decode_block(payload).hash())
+            end += RECORD_HEADER.size + len(payload)
+
+        recovered = len(offsets) != len(entries) or end != log_size
+        self.log.truncate(end)
+        self.offsets = offsets
+        self.hashes = hashes
+        self.index.truncate(0)
+        self.write_index(0)
+        if recovered:
+            print(f"Recovered block log: {len(offsets)} blocks, {end} bytes")
+
+    def read_record(self, offset):
+        """
+        :returns: <bytes> the payload of the record at `offset`, or None if the
+                  record is incomplete or corrupt
+        """
+        self.log.seek(offset)
+        header = self.log.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return None
+        length, checksum = RECORD_HEADER.unpack(header)
+        payload = self.log.read(length)
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            return None
+        return payload
+
+    def read(self, height):
+        """
+        :returns: <object> the block at `height`
+        """
+        offset = self.offsets[height] + RECORD_HEADER.size
+        end = (
+            self.offsets[height + 1]
+            if height + 1 < len(self.offsets)
+            else os.fstat(self.log.fileno()).st_size
+        )
+        with self.map_lock:
+            if self.map is None or len(self.map) < end:
+                # The log grew since we mapped it. The old map isn't closed, since
+                # other readers may still be slicing it: it's unmapped once they're
+                # done with it
+                self.map = mmap.mmap(self.log.fileno(), 0, access=mmap.ACCESS_READ)
+            mapped = self.map
+        return decode_block(mapped[offset:end])
+
+    def read_all(self):
+        """
+        :returns: <iterator> every block in the log, in order
+        """
+        for height in range(len(self.offsets)):
+            yield self.read(height)
+
+    def append(self, block):
+        payload = encode_block(block, self.codec)
+        self.log.seek(0, os.SEEK_END)
+        offset = self.log.tell()
+        self.log.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+        self.log.write(payload)
+        self.log.flush()
+        self.offsets.append(offset)
+        self.hashes.append(block.hash())
+        self.write_index(len(self.offsets) - 1)
+
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every:
+            self.sync()
+
+    def truncate(self, height):
+        """
+        Remove every block from `height` on, e.g. when a fork replaces them
+        """
+        if height >= len(self.offsets):
+            return
+        # Reading past the end of a truncated file through a stale map would crash
+        self.unmap()
+        self.log.truncate(self.offsets[height])
+        self.index.truncate(height * INDEX_ENTRY.size)
+        del self.offsets[height:]
+        del self.hashes[height:]
+        self.sync()
+
+    def write_index(self, start):
+        """
+        Append the index entries of every record from height `start` on
+        """
+        self.index.write(
+            b"".join(
+                INDEX_ENTRY.pack(offset, bytes.fromhex(block_hash))
+                for offset, block_hash in zip(
+                    self.offsets[start:], self.hashes[start:]
+                )
+            )
+        )
+        self.index.flush()
+
+    def unmap(self):
+        """
+        Close the map. Only safe while nothing reads the log (e.g. with the
+        blockchain's lock held for writing)
+        """
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def sync(self):
+        """
+        fsync everything appended so far
+        """
+        self.log.flush()
+        self.index.flush()
+        os.fsync(self.log.fileno())
+        os.fsync(self.index.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        self.sync()
+        self.unmap()
+        self.log.close()
+        self.index.close()
+
+
+def encode_block(block, codec="binary"):
+    if codec == "json":
+        return json.dumps(block.json_serialize()).encode()
+    return block.binary_serialize()
+
+
+def decode_block(payload):
+    # A JSON block is an object, a binary one starts with its format version
+    if payload[:1] == b"{":
+        return Block.json_deserialize(json.loads(payload))
+    return Block.binary_deserialize(payload)
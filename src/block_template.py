@@ -0,0 +1,154 @@
+import heapq
+import threading
+from itertools import count
+
+# Most bytes of regular transactions a block template holds
+MAX_BLOCK_BYTES = 1000000
+
+
+class BlockTemplate:
+    def __init__(self, blockchain, max_bytes=MAX_BLOCK_BYTES, max_txs=None) -> None:
+        """
+        Picks the mempool transactions to mine in the next block.
+
+        Transactions are taken in order of fee per byte from a priority heap until
+        the block is full. Each sender's picks are grouped against their verified
+        balance, so a block never takes more from an account (amounts plus fees)
+        than it holds; transactions that would overdraw are left in the mempool.
+
+        The template is kept up to date as the mempool changes instead of being
+        rebuilt for every block: a new transaction that fits is appended to it, and
+        it's only rebuilt when a transaction in it is removed, the chain tip changes,
+        or a new transaction outbids one that was picked.
+
+        :param blockchain: <object> the blockchain whose mempool and balances are used
+        :param max_bytes: <int> most bytes of regular transactions in a block
+        :param max_txs: <int> most regular transactions in a block (no limit if None)
+        """
+        self.blockchain = blockchain
+        self.max_bytes = max_bytes
+        self.max_txs = max_txs
+        # (-fee per byte, arrival order, tx id, transaction). Entries of transactions
+        # that left the mempool stay in the heap until it's compacted
+        self.heap = []
+        self.arrivals = count()
+        # tx id -> size in bytes, of the transactions in the mempool
+        self.sizes = {}
+        self.smallest = None
+
+        self.transactions = None
+        self.selected = set()
+        self.bytes = 0
+        # compressed pubkey -> amounts plus fees the template takes from the account
+        self.spent = {}
+        self.lowest_rate = None
+        # Number of times the template was built from scratch
+        self.rebuilds = 0
+        # Several threads can read the blockchain (and so the template) at once
+        self.lock = threading.RLock()
+
+        for tx in blockchain.mempool:
+            self._push(tx)
+        blockchain.mempool.add_listener(self.on_mempool_change)
+        blockchain.add_tip_listener(self.invalidate)
+
+    def __len__(self):
+        return len(self.get())
+
+    def get(self):
+        """
+        :returns: <list> the transactions to include in the next block
+        """
+        with self.lock:
+            if self.transactions is None:
+                self.rebuild()
+            return list(self.transactions)
+
+    def fees(self):
+        """
+        :returns: <int> the fees the next block would collect
+        """
+        return sum(tx.fee for tx in self.get())
+
+    def invalidate(self):
+        with self.lock:
+            self.transactions = None
+
+    def on_mempool_change(self, tx, added):
+        with self.lock:
+            self._on_mempool_change(tx, added)
+
+    def _on_mempool_change(self, tx, added):
+        tx_id = tx.id()
+        if not added:
+            self.sizes.pop(tx_id, None)
+            if tx_id in self.selected:
+                self.invalidate()
+            return
+        rate = self._push(tx)
+        if self.transactions is None:
+            return
+        if self._fits(tx, self.sizes[tx_id]):
+            self._select(tx, tx_id, self.sizes[tx_id], rate)
+        elif self.lowest_rate is not None and rate > self.lowest_rate:
+            # It would have been picked over a transaction in the template
+            self.invalidate()
+
+    def rebuild(self):
+        """
+        Build the template from scratch, greedily by fee per byte
+        """
+        self.rebuilds += 1
+        self.transactions = []
+        self.selected = set()
+        self.bytes = 0
+        self.spent = {}
+        self.lowest_rate = None
+        # Drop the entries of transactions that left the mempool
+        self.heap = [entry for entry in self.heap if entry[2] in self.sizes]
+        heapq.heapify(self.heap)
+
+        candidates = list(self.heap)
+        while candidates and not self._full():
+            negative_rate, _, tx_id, tx = heapq.heappop(candidates)
+            if tx_id in self.selected:
+                # Removed from the mempool and added again
+                continue
+            size = self.sizes[tx_id]
+            if self._fits(tx, size):
+                self._select(tx, tx_id, size, -negative_rate)
+
+    def _push(self, tx):
+        """
+        :returns: <float> the transaction's fee per byte
+        """
+        tx_id = tx.id()
+        size = len(tx.binary_serialize())
+        rate = tx.fee / size
+        self.sizes[tx_id] = size
+        self.smallest = size if self.smallest is None else min(self.smallest, size)
+        heapq.heappush(self.heap, (-rate, next(self.arrivals), tx_id, tx))
+        return rate
+
+    def _full(self):
+        if self.max_txs is not None and len(self.transactions) >= self.max_txs:
+            return True
+        return self.max_bytes - self.bytes < (self.smallest or 0)
+
+    def _fits(self, tx, size):
+        if self.max_txs is not None and len(self.transactions) >= self.max_txs:
+            return False
+        if self.bytes + size > self.max_bytes:
+            return False
+        sender = tx.sender_address
+        spent = self.spent.get(sender, 0) + tx.amount + tx.fee
+        return spent <= self.blockchain.balances.get(sender)
+
+    def _select(self, tx, tx_id, size, rate):
+        self.transactions.append(tx)
+        self.selected.add(tx_id)
+        self.bytes += size
+        sender = tx.sender_address
+        self.spent[sender] = self.spent.get(sender, 0) + tx.amount + tx.fee
+        if self.lowest_rate is None or rate < self.lowest_rate:
+            self.lowest_rate = rate
@@ -0,0 +1,58 @@
+from collections import OrderedDict
+
+
+class BlockTree:
+    def __init__(self, max_blocks=1000) -> None:
+        """
+        The blocks we know of that aren't in our chain: side branches forking off it
+        at some height, e.g. a competing block found at the same time as ours, or
+        our own blocks after a reorganization switched away from them.
+
+        Together with the chain, they form a tree of competing tips. Each branch is
+        compared with our chain by the work done since they forked (see
+        Blockchain.add_fork_block), so it can take over once it has more.
+
+        :param max_blocks: <int> most blocks kept. When full, the oldest is dropped
+        """
+        self.max_blocks = max_blocks
+        # block hash -> block, oldest first
+        self.blocks = OrderedDict()
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __contains__(self, block_hash):
+        return block_hash in self.blocks
+
+    def get(self, block_hash):
+        return self.blocks.get(block_hash)
+
+    def add(self, block):
+        self.blocks[block.seal().hash()] = block
+        while len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+
+    def remove(self, block_hash):
+        self.blocks.pop(block_hash, None)
+
+    def branch(self, tip_hash, heights):
+        """
+        Follow a side branch back from its tip to where it forks off the chain
+
+        :param tip_hash: <str> hash of a block in the tree
+        :param heights: <dict> block hash -> height, of the blocks in the chain
+        :returns: <tuple> (fork point, i.e. the height of the branch's first block,
+                  list of the branch's blocks oldest first), or None if the branch
+                  doesn't connect to the chain (some of its blocks are missing)
+        """
+        blocks = []
+        block = self.blocks.get(tip_hash)
+        while block is not None:
+            blocks.append(block)
+            parent_hash = block.previous_hash
+            if parent_hash in heights:
+                blocks.reverse()
+                return heights[parent_hash] + 1, blocks
+            block = self.blocks.get(parent_hash)
+        return None
+
@@ -1,39 +1,435 @@
 from node import Node
 from block import Block
+from transaction import Transaction
+from balance_index import BalanceIndex
+from tx_index import TxIndex
+from mempool import Mempool
+from block_template import BlockTemplate
+from signature_verifier import SignatureVerifier
+from chain_validator import ChainValidator
+from peers import PeerClient
+from chain_sync import ChainSync
+from lazy_chain import LazyChain, ChainSnapshot, ForkedChain
+from block_tree import BlockTree
+from rwlock import RWLock, reading, writing
 from server_helper import compress
-import requests
+from difficulty import (
+    DEFAULT_DIFFICULTY,
+    RETARGET_WINDOW,
+    block_work,
+    chain_work,
+    target_from_difficulty,
+)
+from collections import OrderedDict
 import json
 
+# Number of most recent blocks whose undo records are kept
+MAX_UNDO_RECORDS = 1000
+
 
 class Blockchain:
     def __init__(self) -> None:
+        """
+        The chain and the indexes and mempool that go with it.
+
+        The blockchain is shared by the server's request threads, the miner and
+        gossip, so its state is guarded by a readers-writer lock: reads (e.g. the
+        chain, balances or headers) run in parallel, while anything that changes the
+        chain, its indexes or the mempool holds the lock for writing, so readers
+        never see a half-applied block or a half-swapped chain. Tip listeners run
+        while the lock is held for writing.
+        """
+        self.lock = RWLock()
         self.chain = []
-        self.pending_transactions = []
-        # The number of prepended zeroes to the 256 bit target number
-        self.difficulty = 4
+        # Index of sealed blocks in the chain: block hash -> height. The chain list
+        # itself is the height -> block index
+        self.heights = {}
+        # Total work of the chain (see difficulty.chain_work), which is what peers
+        # compare chains by
+        self.work = 0
+        # Verified balance of every account with a transaction in the chain
+        self.balances = BalanceIndex()
+        # block hash -> undo record (see BalanceIndex.apply_block) of the most recent
+        # blocks in the chain, oldest first. Older blocks are undone from the block
+        self.undo_records = OrderedDict()
+        # Blocks off the chain, on side branches that compete with it
+        self.tree = BlockTree()
+        # Where every transaction in the chain is, and which ones touch each address
+        self.tx_index = TxIndex()
+        self.mempool = Mempool()
+        self.verifier = SignatureVerifier()
+        self.validator = ChainValidator(self)
+        # Leading zero hex digits of the easiest target a block can have, which is
+        # also the Genesis block's target (see max_target)
+        self.difficulty = DEFAULT_DIFFICULTY
+        # Seconds between blocks the target is adjusted to aim for, or None to keep
+        # it fixed (see difficulty.next_target)
+        self.target_block_time = None
+        # Number of most recent blocks the next target is worked out from
+        self.retarget_window = RETARGET_WINDOW
         self.block_reward = 50
         self.peers = set()
+        self.peer_client = PeerClient()
+        self.sync = ChainSync(self)
+        # Where blocks are persisted (e.g. a BlockLog), if anywhere
+        self.store = None
+        # Saves the state derived from the chain every so often, if anything does
+        self.checkpointer = None
+        # Callbacks run whenever the tip of the chain changes (e.g. to cancel stale mining)
+        self.tip_listeners = []
+        # The mempool transactions to mine next, kept up to date as the mempool changes
+        self.template = BlockTemplate(self)
 
     def __str__(self):
         return json.dumps(self.json_serialize())
 
+    @property
+    @reading
+    def pending_transactions(self):
+        return list(self.mempool)
+
+    @reading
     def get_latest_block(self):
         if len(self.chain):
             return self.chain[-1]
         return
 
-    def add_block(self, block, node):
-        # Check the block hash for proof of work
-        if block.hash()[: self.difficulty] >= "0" * self.difficulty:
-            self.chain.append(block)
-            self.pending_transactions = []
-            print(f"Block {block.hash()} added!")
-            print(f"Rewarded {self.block_reward} to {compress(node.pubkey)}")
+    @writing
+    def use_store(self, store, tx_index=None, checkpoint=None):
+        """
+        Persist the chain to a block log, loading the blocks already in it lazily.
+        Blocks added from now on are appended to the log
+
+        :param tx_index: <object> a persistent TxIndex to keep in line with the log
+        :param checkpoint: <dict> the latest checkpoint (see Checkpointer), if any.
+                           Balances are then only recomputed from the blocks after
+                           it, as long as its tip is still in the log
+        """
+        self.store = store
+        self.chain = LazyChain(store)
+        self.heights = {
+            block_hash: height for height, block_hash in enumerate(store.hashes)
+        }
+        start, balances, work = 0, None, 0
+        if checkpoint is not None:
+            height, tip = checkpoint["height"], checkpoint["tip"]
+            if 0 < height <= len(store) and store.hashes[height - 1] == tip:
+                start, balances = height, checkpoint["balances"]
+                work = checkpoint["work"]
+        self.balances.rebuild(self.chain, start, balances)
+        self.work = work + chain_work(
+            self.chain[height] for height in range(start, len(self.chain))
+        )
+        if tx_index is not None:
+            self.tx_index = tx_index
+        self.tx_index.sync(self)
+        if checkpoint is not None:
+            self.restore(checkpoint, start)
+
+    @writing
+    def restore(self, checkpoint, height):
+        """
+        Bring back the difficulty, peers and mempool of a checkpoint
+
+        :param height: <int> height the chain's blocks were replayed from. Pending
+                       transactions they include are left out of the mempool
+        """
+        self.difficulty = checkpoint["difficulty"]
+        self.peers = set(checkpoint["peers"])
+        for json_tx in checkpoint["pending_transactions"]:
+            self.add_transaction(Transaction.json_deserialize(json_tx))
+        for replayed in range(height, len(self.chain)):
+            self.mempool.remove_block(self.chain[replayed])
+
+    @reading
+    def checkpoint(self):
+        """
+        :returns: <dict> the state derived from the chain, as of its tip, plus the
+                  difficulty, peers and mempool
+        """
+        tip = self.get_latest_block()
+        return {
+            "height": len(self.chain),
+            "tip": tip.hash() if tip is not None else None,
+            "work": self.work,
+            "difficulty": self.difficulty,
+            "balances": dict(self.balances.balances),
+            "peers": list(self.peers),
+            "pending_transactions": [tx.json_serialize() for tx in self.mempool],
+        }
+
+    @writing
+    def set_chain(self, chain):
+        """
+        Replace the chain. Blocks shared with the current chain are kept as they are
+        in the indexes; ours after the fork point are rolled back and the new ones
+        are applied (see reorganize())
+        """
+        fork_point = self.fork_point(chain)
+        self.reorganize(fork_point, chain[fork_point:])
+
+    @writing
+    def reorganize(self, fork_point, blocks):
+        """
+        Switch the chain onto `blocks` from height `fork_point` on.
+
+        Our blocks past the fork point are disconnected tip first, each undone in the
+        indexes with its undo record, and moved to the block tree so we can switch
+        back to them. Then the new blocks are connected. Transactions of the
+        disconnected blocks that the new ones don't include go back to the mempool.
+        So a reorganization costs in proportion to the depth of the fork, not the
+        length of the chain. Tip listeners aren't notified
+        """
+        disconnected = []
+        for height in reversed(range(fork_point, len(self.chain))):
+            block = self.chain[height]
+            block_hash = block.hash()
+            self.balances.revert_block(block, self.undo_records.pop(block_hash, None))
+            del self.heights[block_hash]
+            self.work -= block_work(block.target)
+            self.tree.add(block)
+            disconnected.append(block)
+        self.tx_index.revert_block(fork_point)
+        if self.store is not None:
+            # Rewrite the block log from the fork point on
+            self.chain.truncate(fork_point)
+        else:
+            del self.chain[fork_point:]
+
+        included = set()
+        for block in blocks:
+            self.connect_block(block)
+            included.update(tx.id() for tx in block.transactions["regular"])
+        # Oldest first, so they're mined in about the order they were before
+        for block in reversed(disconnected):
+            for tx in block.transactions["regular"]:
+                if tx.id() not in included:
+                    self.mempool.add(tx)
+
+    def connect_block(self, block):
+        """
+        Append a block to the chain, and apply it to the indexes and the mempool.
+        The lock must be held for writing
+        """
+        block_hash = block.seal().hash()
+        height = len(self.chain)
+        self.heights[block_hash] = height
+        self.chain.append(block)
+        self.work += block_work(block.target)
+        self.undo_records[block_hash] = self.balances.apply_block(block)
+        while len(self.undo_records) > MAX_UNDO_RECORDS:
+            self.undo_records.popitem(last=False)
+        self.tx_index.apply_block(height, block)
+        self.mempool.remove_block(block)
+        self.tree.remove(block_hash)
+
+    @property
+    def max_target(self):
+        return target_from_difficulty(self.difficulty)
+
+    @reading
+    def next_target(self):
+        """
+        :returns: <int> the target of the next block to extend the chain
+        """
+        return self.validator.expected_target(self.chain, len(self.chain))
+
+    @reading
+    def block_hash(self, height):
+        """
+        The hash of our block at `height`, without loading the block from the store
+        """
+        if self.store is not None:
+            return self.chain.hash_at(height)
+        return self.chain[height].hash()
+
+    @reading
+    def fork_point(self, chain):
+        """
+        :returns: <int> the number of leading blocks `chain` has in common with ours
+        """
+        # Each block commits to its parent's hash, so once two chains share a block
+        # they share everything before it. Binary search for the last shared one
+        low, high = 0, min(len(self.chain), len(chain))
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.block_hash(middle - 1) == chain[middle - 1].seal().hash():
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    @reading
+    def get_block(self, block_hash):
+        """
+        Look up a block in the chain by its hash
+
+        :returns: <object> the block, or None if it's not in the chain
+        """
+        height = self.heights.get(block_hash)
+        return self.chain[height] if height is not None else None
+
+    @reading
+    def find_transaction(self, tx_id):
+        """
+        Find a transaction in the chain with the transaction index
+
+        :returns: <tuple> (transaction, block, height, position in the block), or
+                  None if the transaction isn't in the chain
+        """
+        found = self.tx_index.find(tx_id)
+        if found is None:
+            return None
+        height, position = found
+        block = self.chain[height]
+        return block.all_transactions()[position], block, height, position
+
+    @reading
+    def address_transactions(self, address, cursor=None, limit=100):
+        """
+        A page of the transactions an account sent or received, newest first
+
+        :param address: <str> compressed pubkey (hex) of the account
+        :returns: <tuple> (list of (transaction, height), cursor of the next page or
+                  None if this was the last one)
+        """
+        rows, next_cursor = self.tx_index.address_txs(address, cursor, limit)
+        txs = [
+            (self.chain[height].all_transactions()[position], height)
+            for _, height, position in rows
+        ]
+        return txs, next_cursor
+
+    @reading
+    def pending_address_transactions(self, pubkey):
+        """
+        :param pubkey: <object> VerifyingKey of the account
+        :returns: <list> the mempool transactions the account sends or receives
+        """
+        return self.mempool.address_txs(compress(pubkey))
+
+    @reading
+    def get_block_by_height(self, height):
+        if 0 <= height < len(self.chain):
+            return self.chain[height]
+        return None
+
+    def add_tip_listener(self, callback):
+        self.tip_listeners.append(callback)
+
+    def remove_tip_listener(self, callback):
+        self.tip_listeners.remove(callback)
+
+    def notify_new_tip(self):
+        for callback in list(self.tip_listeners):
+            callback()
+
+    @writing
+    def add_block(self, block, node=None):
+        """
+        Add a block that extends the tip of the chain. Checking it against the tip
+        and adding it happen atomically, so of two blocks mined on the same tip at
+        once only the first is added
+
+        :param node: <object> the node that mined the block, if it was mined here
+                     (blocks can also come from peers, see Gossip)
+        :returns: <bool> True if the block was added. It's rejected if it's already
+                  in the chain, doesn't build on the tip (e.g. another block was
+                  added while it was being mined), or has the wrong target or too
+                  little work
+        """
+        block_hash = block.seal().hash()
+        tip = self.get_latest_block()
+        if block_hash in self.heights:
+            print(f"Block {block_hash} rejected. Already in the chain")
+            return False
+        if block.previous_hash != (tip.hash() if tip is not None else None):
+            print(f"Block {block_hash} rejected. It doesn't extend the tip")
+            return False
+        # Check the block's target, and that its hash is below it
+        if block.target != self.next_target() or not block.valid_proof():
+            print(f"Block {block_hash} rejected. Wrong target or insufficient work")
+            return False
+        self.connect_block(block)
+        self.notify_new_tip()
+        print(f"Block {block_hash} added!")
+        coinbase_tx = block.transactions["coinbase"]
+        if coinbase_tx:
+            print(f"Rewarded {coinbase_tx.amount} to {coinbase_tx.recipient_address}")
+        return True
+
+    @writing
+    def add_fork_block(self, block):
+        """
+        Add a block that forks off our chain below its tip, or extends a side branch.
+
+        The block is kept in the block tree. If its branch now has more work than our
+        chain has past the point where they fork, the branch is validated and the
+        chain is reorganized onto it. Ties go to the chain we already have
+
+        :returns: <bool> True if the block was kept, whether or not it's now the tip
+        """
+        block_hash = block.seal().hash()
+        if block_hash in self.heights or block_hash in self.tree:
+            return False
+        parent_hash = block.previous_hash
+        if parent_hash in self.heights:
+            parent_chain = ForkedChain(self.chain, self.heights[parent_hash] + 1, [])
+        elif parent_hash in self.tree:
+            branch = self.tree.branch(parent_hash, self.heights)
+            if branch is None:
+                return False
+            parent_chain = ForkedChain(self.chain, *branch)
         else:
-            print(
-                f"Block {block.hash()} rejected. Does not satisfy difficulty {self.difficulty}"
-            )
+            return False
+        # The header is checked against the blocks before it now, so blocks with an
+        # easier target than their branch calls for can't crowd real branches out of
+        # the tree. Signatures are checked if the branch ever overtakes our chain
+        if not self.validator.valid_block(block, parent_chain, len(parent_chain)):
+            return False
+        self.tree.add(block)
+        branch = self.tree.branch(block_hash, self.heights)
+        if branch is None:
+            # Part of the branch was dropped from the tree, it can't be connected
+            return True
+        fork_point, blocks = branch
+        if chain_work(blocks) <= chain_work(self.chain[fork_point:]):
+            return True
+        candidate = ForkedChain(self.chain, fork_point, blocks)
+        if not self.validator.valid_chain(candidate, start=fork_point):
+            self.tree.remove(block_hash)
+            return False
+        print(f"Reorganizing onto block {block_hash} from height {fork_point}")
+        self.reorganize(fork_point, blocks)
+        self.notify_new_tip()
+        return True
+
+    @writing
+    def add_transaction(self, tx):
+        """
+        Admit a transaction to the mempool if its amounts and signature are valid
+
+        :returns: <bool> False if the transaction is invalid or was already pending
+        """
+        if tx.id() in self.mempool:
+            return False
+        if not tx.valid_amounts():
+            print(f"Transaction {tx.id()} rejected. Invalid amount or fee")
+            return False
+        if not self.verifier.verify_transaction(tx):
+            print(f"Transaction {tx.id()} rejected. Invalid signature")
+            return False
+        return self.mempool.add(tx)
+
+    @reading
+    def get_balance(self, pubkey):
+        """
+        :param pubkey: <object> VerifyingKey of the account
+        :returns: <int> verified balance of the account
+        """
+        return self.balances.get(compress(pubkey))
 
+    @writing
     def register_peers(self, peers):
         """
         Register a neighboring node to compare their blockchains
@@ -42,56 +438,171 @@ class Blockchain:
         for peer in peers:
             self.peers.add(peer)
 
+    @reading
     def valid_chain(self, chain):
         """
         Determines whether the given chain is valid by checking:
             1) If the hash of a block is the previous hash of the next block (i.e. are they linked?)
-            2) If the proof used in each block is a valid difficulty
+            2) If each block has the target the chain before it calls for, and its
+               hash is below it
+            3) If every transaction is signed by its sender
+            4) If every regular transaction moves a positive amount and pays a
+               non-negative fee
+            5) If each coinbase transaction claims at most the block reward plus
+               the block's fees
+            6) If no block takes more from an account than it held before the block
         """
-        prev_block = None
-        for block in chain:
-
-            # Check if current block is Genesis
-            if block.previous_hash == None:
-                # Can't have two Genesis blocks!
-                if prev_block:
-                    return False
-                prev_block = block
-                continue
-            
-            if block.previous_hash != prev_block.hash():
-                return False
-            if not block.valid_proof(self.difficulty):
-                return False
-
-            prev_block = block
-        return True
+        return self.validator.valid_chain(chain)
 
     def consensus(self):
         """
         The consensus algorithm that compares our chain to our neighbors and gets
-        the one with the longest valid proof-of-work
+        the valid one with the most proof-of-work
+
+        Peers are queried without holding the lock. Each candidate chain is
+        validated and swapped in atomically by adopt_chain()
 
         Returns True if new chain added,
         else False
         """
-        current_chain = self.chain
-        for node in self.peers:
-            # Request the neighbor's blockchain
-            response = requests.get(f"http://{node}/chain")
-            if response.status_code == 200:
-                neighbor_chain = Blockchain.json_deserialize(response.json()).chain
-                if self.valid_chain(neighbor_chain) and len(neighbor_chain) > len(
-                    current_chain
-                ):
-                    current_chain = neighbor_chain
+        # Ask every neighbor how long its chain is and how much work it has
+        heights = {}
+        works = {}
+        legacy_peers = []
+        peers = self.peer_list()
+        for node, response in self.peer_client.get_all(peers, "/chain/height"):
+            if response.status_code != 200:
+                legacy_peers.append(node)
+                continue
+            try:
+                answer = response.json()
+                height = answer["height"]
+                if not isinstance(height, int):
+                    raise TypeError(f"Height {height!r} is not an integer")
+                # Older peers only report their height
+                work = int(answer["work"], 16) if "work" in answer else None
+            except (ValueError, KeyError, TypeError) as error:
+                # A malformed answer only rules out this peer
+                self.peer_client.record_failure(node, error)
+                continue
+            heights[node] = height
+            works[node] = work
+
+        our_height, _, our_work = self.tip()
+        # Peers whose chain has more work than ours
+        ahead = []
+        for node, height in heights.items():
+            if works[node] is None:
+                # Older peers only report their height, theirs has to be longer
+                if height > our_height:
+                    ahead.append(node)
+            elif works[node] > our_work:
+                ahead.append(node)
+
+        replaced = False
+        # Sync with the chain with the most work first, downloading only the blocks
+        # past the fork point. If it turns out to be invalid, try the next one
+        ahead.sort(key=lambda node: (works[node] or 0, heights[node]), reverse=True)
+        for node in ahead:
+            neighbor_chain = self.sync.fetch_fork(node, heights[node])
+            if neighbor_chain is None:
+                continue
+            if self.adopt_chain(neighbor_chain):
+                replaced = True
+                break
+
+        # Neighbors without the header-first endpoints send their whole chain. If it
+        # hasn't changed since we last downloaded it, they answer 304 instead.
+        # Otherwise it's read and validated a block at a time as it streams in
+        etags = self.sync.etags
+        responses = self.peer_client.get_all(
+            legacy_peers,
+            "/chain",
+            headers_for=lambda peer: {"If-None-Match": etags[peer]}
+            if peer in etags
+            else {},
+            stream=True,
+        )
+        for node, response in responses:
+            if response.status_code != 200:
+                response.close()
+                continue
+            neighbor_chain = self.sync.read_chain(response)
+            if neighbor_chain is not None and self.adopt_chain(neighbor_chain):
+                replaced = True
+            if response.headers.get("ETag"):
+                etags[node] = response.headers["ETag"]
 
         # Return True if new chain added
-        if self.chain != current_chain:
-            self.chain = current_chain
-            return True
-        return False
+        return replaced
+
+    @writing
+    def adopt_chain(self, chain):
+        """
+        Switch to `chain` if it has more work than ours and is valid. Only the part of
+        it that differs from our chain is compared and validated, against our chain
+        as it is now
+
+        :returns: <bool> True if our chain was replaced
+        """
+        fork_point = self.fork_point(chain)
+        if chain_work(chain[fork_point:]) <= chain_work(self.chain[fork_point:]):
+            return False
+        candidate = self.validator.valid_fork(chain)
+        if not candidate:
+            return False
+        self.set_chain(candidate)
+        self.notify_new_tip()
+        return True
+
+    @reading
+    def snapshot(self, start=0, stop=None):
+        """
+        :returns: <object> a ChainSnapshot of the blocks [start, stop) (up to the tip
+                  if stop is None), to be read without holding the lock
+        """
+        return ChainSnapshot(self, start, len(self.chain) if stop is None else stop)
+
+    @reading
+    def peer_list(self):
+        return list(self.peers)
+
+    @reading
+    def tip(self):
+        """
+        :returns: <tuple> (height of the chain, hash of its tip or None if it's empty,
+                  total work of the chain)
+        """
+        tip = self.get_latest_block()
+        return len(self.chain), tip.hash() if tip else None, self.work
+
+    @reading
+    def headers(self, start, limit):
+        """
+        :returns: <list> the headers of up to `limit` blocks starting at height `start`
+        """
+        return [
+            {"height": start + i, **block.header_serialize()}
+            for i, block in enumerate(self.chain[start : start + limit])
+        ]
+
+    @reading
+    def blocks(self, start, limit):
+        """
+        :returns: <list> up to `limit` serialized blocks starting at height `start`
+        """
+        return [block.json_serialize() for block in self.chain[start : start + limit]]
+
+    @reading
+    def binary_blocks(self, start, limit):
+        """
+        :returns: <list> up to `limit` binary serialized blocks starting at height `start`
+        """
+        return [
+            block.binary_serialize() for block in self.chain[start : start + limit]
+        ]
 
+    @reading
     def json_serialize(self):
         chain = [block.json_serialize() for block in self.chain]
         pending_transactions = [tx.json_serialize() for tx in self.pending_transactions]
@@ -106,6 +617,8 @@ class Blockchain:
     @staticmethod
     def json_deserialize(json_blockchain, json_peers=None):
         blockchain = Blockchain()
-        blockchain.chain = [Block.json_deserialize(block) for block in json_blockchain["chain"]]
+        blockchain.set_chain(
+            [Block.json_deserialize(block) for block in json_blockchain["chain"]]
+        )
         blockchain.peers = set(json_blockchain["peers"])
         return blockchain
@@ -0,0 +1,196 @@
+import struct
+
+from block import Block
+from encoding import BINARY_CONTENT_TYPE, decode_chain
+from json_stream import iter_json_array
+from lazy_chain import ForkedChain
+
+# Most headers and blocks a node serves per request
+MAX_HEADERS = 2000
+MAX_BLOCKS = 500
+# Most bytes of a peer's whole chain we're willing to read
+MAX_CHAIN_BYTES = 256 * 1024 * 1024
+# Bytes read from a streamed response at a time
+CHUNK_SIZE = 65536
+
+
+class ChainSync:
+    def __init__(self, blockchain, window=16, max_chain_bytes=MAX_CHAIN_BYTES) -> None:
+        """
+        Header-first chain sync with a single peer.
+
+        Instead of downloading a peer's whole chain, we compare block headers near our
+        tip to find where the chains fork, then download only the peer's blocks past
+        that point.
+
+        :param blockchain: <object> the local blockchain
+        :param window: <int> number of headers compared in the first attempt to find
+                       the fork point. Doubled each time the fork is further back
+        :param max_chain_bytes: <int> most bytes read from a peer's whole chain
+        """
+        self.blockchain = blockchain
+        self.window = window
+        self.max_chain_bytes = max_chain_bytes
+        # peer -> ETag of the last whole chain we downloaded from it (see /chain)
+        self.etags = {}
+
+    def fetch_fork(self, peer, peer_height):
+        """
+        Download the blocks a peer has that we don't
+
+        :param peer: <str> peer address
+        :param peer_height: <int> length of the peer's chain
+        :returns: <list> our chain up to the fork point followed by the peer's blocks
+                  (still to be validated), or None if the peer misbehaved
+        """
+        local_chain = self.blockchain.chain
+        fork_point = self.find_fork_point(peer, local_chain, peer_height)
+        if fork_point is None:
+            return None
+        blocks = self.fetch_blocks(peer, fork_point, peer_height - fork_point)
+        if blocks is None:
+            return None
+        return ForkedChain(local_chain, fork_point, blocks)
+
+    def read_chain(self, response):
+        """
+        Read a peer's whole chain from a /chain response as it streams in, a block at
+        a time.
+
+        Blocks the peer shares with our chain are dropped as soon as they're read.
+        From the fork point on, each block is validated against the blocks before it
+        (linkage, timestamp, target, proof-of-work and signatures) as it arrives,
+        and reading stops at the first invalid one, or once the response is over
+        `max_chain_bytes`. So only the peer's new blocks are kept in memory, never
+        the whole document or chain.
+
+        :param response: <object> a streamed 200 response to GET /chain
+        :returns: <list> our chain up to the fork point followed by the peer's blocks,
+                  or None if the peer's chain is invalid, too large or has nothing
+                  we don't
+        """
+        blockchain = self.blockchain
+        # Our chain up to the fork point, then the peer's blocks read so far
+        chain = None
+        json_blocks = iter_json_array(
+            response.iter_content(CHUNK_SIZE), "chain", self.max_chain_bytes
+        )
+        try:
+            for height, json_block in enumerate(json_blocks):
+                block = Block.json_deserialize(json_block).seal()
+                if chain is None:
+                    with blockchain.lock.read():
+                        shared = (
+                            height < len(blockchain.chain)
+                            and blockchain.block_hash(height) == block.hash()
+                        )
+                    if shared:
+                        continue
+                    chain = ForkedChain(blockchain.chain, height, [])
+                valid = blockchain.validator.valid_block(
+                    block, chain, height
+                ) and blockchain.verifier.verify_block(block)
+                if not valid:
+                    return None
+                chain.blocks.append(block)
+        # OSError covers the connection failing mid-stream
+        except (KeyError, TypeError, ValueError, struct.error, OSError) as error:
+            print(f"Discarding chain from {response.url}: {error}")
+            return None
+        finally:
+            response.close()
+        return chain
+
+    def find_fork_point(self, peer, local_chain, peer_height):
+        """
+        :returns: <int> the number of leading blocks the peer's chain shares with
+                  `local_chain`, or None if the peer's headers couldn't be fetched
+        """
+        top = min(len(local_chain), peer_height)
+        window = self.window
+        while top > 0:
+            start = max(top - window, 0)
+            headers = self.fetch_headers(peer, start, top - start)
+            if headers is None:
+                return None
+            with self.blockchain.lock.read():
+                shared = [
+                    start + i < len(local_chain)
+                    and header["hash"] == local_chain[start + i].hash()
+                    for i, header in enumerate(headers)
+                ]
+            # The chains diverge somewhere before this window, look further back
+            if start > 0 and not shared[0]:
+                window *= 2
+                continue
+            return shared.index(False) + start if False in shared else top
+        return 0
+
+    def fetch_headers(self, peer, start, count):
+        return self.fetch_range(
+            peer,
+            "/chain/headers",
+            start,
+            count,
+            MAX_HEADERS,
+            parse_headers,
+        )
+
+    def fetch_blocks(self, peer, start, count):
+        # Ask for the compact binary encoding, but accept JSON from older peers
+        return self.fetch_range(
+            peer,
+            "/chain/blocks",
+            start,
+            count,
+            MAX_BLOCKS,
+            decode_blocks,
+            format="binary",
+        )
+
+    def fetch_range(self, peer, path, start, count, page_size, parse, **params):
+        """
+        Fetch `count` items starting at height `start` from a paginated endpoint
+
+        :param parse: <function> extracts the list of items from a response
+        :returns: <list> the items, or None if the peer didn't return all of them
+        """
+        items = []
+        while len(items) < count:
+            limit = min(count - len(items), page_size)
+            params.update({"from": start + len(items), "limit": limit})
+            response = self.blockchain.peer_client.get(peer, path, params=params)
+            if response is None or response.status_code != 200:
+                return None
+            try:
+                page = parse(response)
+            # Whatever a peer sends, a malformed page only means it's ignored
+            except (ValueError, KeyError, TypeError, struct.error):
+                return None
+            if not page:
+                return None
+            items.extend(page[:limit])
+        return items
+
+
+def parse_headers(response):
+    """
+    The headers of a /chain/headers response, each checked to have a hash
+    """
+    headers = response.json()["headers"]
+    if not isinstance(headers, list) or not all(
+        isinstance(header, dict) and isinstance(header.get("hash"), str)
+        for header in headers
+    ):
+        raise ValueError("Malformed headers")
+    return headers
+
+
+def decode_blocks(response):
+    """
+    Deserialize the blocks of a /chain/blocks response, binary or JSON
+    """
+    if response.headers.get("Content-Type", "").startswith(BINARY_CONTENT_TYPE):
+        encoded_blocks = decode_chain(response.content)
+        return [Block.binary_deserialize(block) for block in encoded_blocks]
+    return [Block.json_deserialize(block) for block in response.json()["blocks"]]
@@ -0,0 +1,130 @@
+from time import time
+
+from balance_index import BalanceIndex, BalanceView
+from difficulty import MAX_CLOCK_DRIFT, next_target
+from lazy_chain import ForkedChain
+
+
+class ChainValidator:
+    def __init__(self, blockchain) -> None:
+        """
+        Validates chains against the rules of a blockchain (linkage, timestamps,
+        targets, proof-of-work, transaction amounts, coinbase rewards, balances and
+        signatures).
+
+        Blocks are checked in order, and validation stops at the first invalid one.
+        Hashing a block only takes its fixed-size header (sealed blocks already
+        have their Merkle root), so it's done in-process. When checking a peer's
+        chain, the prefix it shares with our chain is trusted and only the divergent
+        suffix is validated.
+
+        :param blockchain: <object> the local blockchain, whose rules and chain we trust
+        """
+        self.blockchain = blockchain
+
+    def valid_chain(self, chain, start=0):
+        """
+        Validate chain[start:], trusting chain[:start]
+
+        :param start: <int> a height up to which `chain` is our chain (any chain
+                      if it's 0)
+        :returns: <bool> True if the blocks are valid
+        """
+        blocks = chain[start:]
+        index = self.blockchain.balances
+        balances = self.balances_at(start)
+        for height, block in enumerate(blocks, start):
+            if not self.valid_block(block.seal(), chain, height):
+                return False
+            if not self.valid_spends(block, balances):
+                return False
+            balances.apply(index.changes(block))
+        return self.blockchain.verifier.verify_chain(blocks)
+
+    def valid_fork(self, chain):
+        """
+        Validate a peer's chain, skipping the prefix it shares with our chain
+
+        :returns: <list> the chain to adopt (our blocks up to the fork point followed
+                  by the peer's), or None if the peer's chain is invalid
+        """
+        fork_point = self.blockchain.fork_point(chain)
+        candidate = ForkedChain(self.blockchain.chain, fork_point, chain[fork_point:])
+        if self.valid_chain(candidate, start=fork_point):
+            return candidate
+        return None
+
+    def valid_block(self, block, chain, height):
+        """
+        Check a block against the chain it extends, at `height`
+
+        :param chain: <list> a chain whose first `height` blocks are the block's
+                      ancestors (the block itself needn't be in it)
+        """
+        parent = chain[height - 1] if height else None
+        if block.previous_hash is None:
+            # Can't have two Genesis blocks!
+            if parent is not None:
+                return False
+        else:
+            if parent is None or block.previous_hash != parent.hash():
+                return False
+            # Timestamps set the targets, so they can't go backwards or too far ahead
+            if not parent.timestamp <= block.timestamp <= time() + MAX_CLOCK_DRIFT:
+                return False
+        # The Genesis block is held to its target and proof too, or a forged one
+        # could claim any amount of work
+        if block.target != self.expected_target(chain, height):
+            return False
+        if not block.valid_proof():
+            return False
+        regular_txs = block.transactions["regular"]
+        if not all(tx.valid_amounts() for tx in regular_txs):
+            return False
+        # The miner can only claim the block reward and the fees
+        coinbase_tx = block.transactions["coinbase"]
+        reward = self.blockchain.block_reward + sum(tx.fee for tx in regular_txs)
+        return coinbase_tx is None or coinbase_tx.amount <= reward
+
+    def valid_spends(self, block, balances):
+        """
+        Check that no sender spends (amounts plus fees) more than they held before
+        the block. BLU received in the block itself can't be spent until the next
+        one, the same rule BlockTemplate builds blocks by
+
+        :param balances: <object> the balances as of the block's parent (a
+                         BalanceIndex or BalanceView)
+        """
+        table = block.table()
+        spent = {}
+        for sender, amount, fee in zip(table.senders, table.amounts, table.fees):
+            sender = sender.hex()
+            spent[sender] = spent.get(sender, 0) + amount + fee
+        return all(total <= balances.get(sender) for sender, total in spent.items())
+
+    def balances_at(self, start):
+        """
+        :returns: <object> a BalanceView of our balances as of height `start`. Our
+                  blocks past it are taken back off the balance index, so this
+                  costs in proportion to the depth of a fork
+        """
+        blockchain = self.blockchain
+        if start == 0:
+            return BalanceView(BalanceIndex())
+        balances = BalanceView(blockchain.balances)
+        for height in range(start, len(blockchain.chain)):
+            balances.apply(blockchain.balances.changes(blockchain.chain[height]), -1)
+        return balances
+
+    def expected_target(self, chain, height):
+        """
+        :returns: <int> the target the block at `height` of `chain` must have
+        """
+        blockchain = self.blockchain
+        return next_target(
+            chain,
+            height,
+            blockchain.max_target,
+            blockchain.target_block_time,
+            blockchain.retarget_window,
+        )
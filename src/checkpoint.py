@@ -0,0 +1,83 @@
+import json
+import os
+
+# Bump when the checkpoint layout changes, older checkpoints are then ignored
+CHECKPOINT_VERSION = 2
+
+
+class Checkpointer:
+    def __init__(self, blockchain, path, interval=100) -> None:
+        """
+        Periodically saves the state derived from the chain, so a restarting node
+        doesn't have to recompute it from the Genesis block.
+
+        A checkpoint holds the verified balance of every account, the height, hash
+        and total work of the tip it was taken at, the difficulty, the peers and the
+        mempool.
+        One is written whenever the chain has grown (or been cut back) by `interval`
+        blocks since the last one, and on shutdown. It's written to a temporary file
+        that then replaces the previous checkpoint, so a crash never leaves a
+        half-written one behind.
+
+        :param blockchain: <object> the blockchain to checkpoint
+        :param path: <str> the checkpoint file
+        :param interval: <int> number of blocks between checkpoints
+        """
+        self.blockchain = blockchain
+        self.path = path
+        self.interval = interval
+        # Height of the last checkpoint written or loaded
+        self.height = len(blockchain.chain)
+        self.saved = 0
+        blockchain.add_tip_listener(self.on_new_tip)
+
+    def on_new_tip(self):
+        height = len(self.blockchain.chain)
+        if abs(height - self.height) >= self.interval:
+            self.save()
+
+    def save(self):
+        """
+        Write a checkpoint of the blockchain as it is now
+        """
+        blockchain = self.blockchain
+        with blockchain.lock.read():
+            if blockchain.store is not None:
+                # The checkpoint must never be ahead of the blocks on disk
+                blockchain.store.sync()
+            state = blockchain.checkpoint()
+        write_checkpoint(self.path, state)
+        self.height = state["height"]
+        self.saved += 1
+
+    def close(self):
+        self.blockchain.remove_tip_listener(self.on_new_tip)
+
+
+def write_checkpoint(path, state):
+    """
+    Atomically replace the checkpoint at `path`
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as file:
+        json.dump({"version": CHECKPOINT_VERSION, **state}, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+def read_checkpoint(path):
+    """
+    :returns: <dict> the checkpoint at `path`, or None if there's no usable one
+    """
+    try:
+        with open(path) as file:
+            state = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(state, dict) or state.get("version") != CHECKPOINT_VERSION:
+        return None
+    return state
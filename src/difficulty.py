@@ -0,0 +1,66 @@
+# Block hashes are 256 bit numbers, and a block's hash must be below its target
+MAX_TARGET = 2 ** 256 - 1
+# Leading zero hex digits of the easiest target allowed, unless configured otherwise
+DEFAULT_DIFFICULTY = 4
+# Seconds between blocks that retargeting aims for, when it's enabled
+TARGET_BLOCK_TIME = 10
+# Number of most recent blocks whose timestamps and targets set the next target
+RETARGET_WINDOW = 10
+# Most the next target can move in one step, as a factor of the window's average
+MAX_ADJUSTMENT = 4
+# How far ahead of our clock a block's timestamp may be, in seconds
+MAX_CLOCK_DRIFT = 2 * 60 * 60
+
+
+def target_from_difficulty(difficulty):
+    """
+    :param difficulty: <int> number of leading zero hex digits
+    :returns: <int> the target the hashes with that many leading zeroes are below
+    """
+    return min(1 << (256 - 4 * difficulty), MAX_TARGET)
+
+
+def block_work(target):
+    """
+    :returns: <int> the expected number of hashes it takes to find a hash below
+              `target`
+    """
+    return (MAX_TARGET + 1) // target
+
+
+def chain_work(blocks):
+    """
+    :returns: <int> the total work of the blocks, which is how competing chains are
+              compared (rather than by length, since targets vary)
+    """
+    return sum(block_work(block.target) for block in blocks)
+
+
+def next_target(chain, height, max_target, block_time=None, window=RETARGET_WINDOW):
+    """
+    The target the block at `height` must have, given the blocks before it.
+
+    The average target of the last `window` blocks is scaled by how long they took
+    to mine compared to `block_time` each: if blocks came twice as fast as they
+    should, the target halves (twice the work per block), and the other way around.
+    The adjustment is limited to MAX_ADJUSTMENT either way, so a few odd timestamps
+    can't swing it, and the target never goes above `max_target`. Until there are
+    enough blocks to fill the window, blocks keep their parent's target.
+
+    :param chain: <list> a chain holding (at least) the blocks below `height`
+    :param max_target: <int> the easiest target allowed, also the Genesis block's
+    :param block_time: <float> seconds between blocks to aim for, or None to keep
+                       the target fixed at `max_target`
+    :returns: <int> the target
+    """
+    if height == 0 or block_time is None:
+        return max_target
+    if height <= window:
+        return chain[height - 1].target
+    expected = window * block_time
+    timespan = chain[height - 1].timestamp - chain[height - 1 - window].timestamp
+    timespan = min(max(timespan, expected / MAX_ADJUSTMENT), expected * MAX_ADJUSTMENT)
+    average = sum(chain[h].target for h in range(height - window, height)) // window
+    # In whole milliseconds, so every node computes exactly the same target
+    target = average * round(timespan * 1000) // round(expected * 1000)
+    return min(max(target, 1), max_target)
@@ -0,0 +1,164 @@
+import struct
+
+# Version of the binary block and transaction format
+FORMAT_VERSION = 4
+# Content type of binary chain responses
+BINARY_CONTENT_TYPE = "application/octet-stream"
+
+VERSION = struct.Struct(">B")
+KIND = struct.Struct(">B")
+HASH_LENGTH = 32
+# A block's proof-of-work target, a 256 bit unsigned number
+TARGET_LENGTH = 32
+PUBKEY_LENGTH = 33
+TIMESTAMP = struct.Struct(">d")
+AMOUNT = struct.Struct(">q")
+COUNT = struct.Struct(">I")
+SIGNATURE_LENGTH = struct.Struct(">H")
+NONCE = struct.Struct(">Q")
+# Prefix of a sequence of binary blocks: magic bytes, version and block count
+CHAIN_MAGIC = b"BLUC"
+BLOCK_LENGTH = struct.Struct(">I")
+
+# previous_hash kinds
+NO_HASH = 0
+RAW_HASH = 1
+TEXT_HASH = 2
+
+# Signature kinds
+TEXT_SIGNATURE = 0
+RAW_SIGNATURE = 1
+
+
+class Reader:
+    def __init__(self, data, offset=0) -> None:
+        """
+        Reads fields from a binary encoding in order
+
+        :param data: <bytes> the encoded data
+        :param offset: <int> where to start reading
+        """
+        self.data = memoryview(data)
+        self.offset = offset
+
+    def read(self, length):
+        if self.offset + length > len(self.data):
+            raise ValueError("Truncated binary data")
+        value = bytes(self.data[self.offset : self.offset + length])
+        self.offset += length
+        return value
+
+    def unpack(self, field):
+        (value,) = field.unpack(self.read(field.size))
+        return value
+
+    def at_end(self):
+        return self.offset == len(self.data)
+
+
+def encode_amount(amount):
+    return AMOUNT.pack(amount)
+
+
+def encode_target(target):
+    return target.to_bytes(TARGET_LENGTH, "big")
+
+
+def decode_target(reader):
+    return int.from_bytes(reader.read(TARGET_LENGTH), "big")
+
+
+def encode_previous_hash(previous_hash):
+    if previous_hash is None:
+        return KIND.pack(NO_HASH)
+    try:
+        raw_hash = bytes.fromhex(previous_hash)
+    except ValueError:
+        raw_hash = None
+    # Round-tripping catches uppercase hex, which would decode to a different string
+    if raw_hash and len(raw_hash) == HASH_LENGTH and raw_hash.hex() == previous_hash:
+        return KIND.pack(RAW_HASH) + raw_hash
+    # Anything else (an invalid block) is kept verbatim so it still hashes
+    text = previous_hash.encode()
+    return KIND.pack(TEXT_HASH) + encode_length(text) + text
+
+
+def decode_previous_hash(reader):
+    kind = reader.unpack(KIND)
+    if kind == NO_HASH:
+        return None
+    if kind == RAW_HASH:
+        return reader.read(HASH_LENGTH).hex()
+    if kind == TEXT_HASH:
+        return reader.read(reader.unpack(SIGNATURE_LENGTH)).decode()
+    raise ValueError(f"Unknown previous hash kind {kind}")
+
+
+def encode_signature(signature):
+    if isinstance(signature, str):
+        kind, data = TEXT_SIGNATURE, signature.encode()
+    else:
+        kind, data = RAW_SIGNATURE, bytes(signature)
+    return KIND.pack(kind) + encode_length(data) + data
+
+
+def encode_length(data):
+    """
+    The length prefix of a text previous hash or a signature
+    """
+    if len(data) >= 1 << (8 * SIGNATURE_LENGTH.size):
+        raise ValueError(f"{len(data)} bytes is too long to encode")
+    return SIGNATURE_LENGTH.pack(len(data))
+
+
+def decode_signature(reader):
+    kind = reader.unpack(KIND)
+    data = reader.read(reader.unpack(SIGNATURE_LENGTH))
+    if kind == TEXT_SIGNATURE:
+        return data.decode()
+    if kind == RAW_SIGNATURE:
+        return data
+    raise ValueError(f"Unknown signature kind {kind}")
+
+
+def encode_chain(encoded_blocks):
+    """
+    Join binary encoded blocks into one binary chain
+
+    :param encoded_blocks: <list> the output of Block.binary_serialize() for each block
+    """
+    return b"".join(encode_chain_parts(len(encoded_blocks), encoded_blocks))
+
+
+def encode_chain_parts(count, encoded_blocks):
+    """
+    encode_chain() a piece at a time, for streaming: the header, then each
+    length-prefixed block
+
+    :param count: <int> the number of blocks
+    :param encoded_blocks: <iterator> the output of Block.binary_serialize() for each
+                           block
+    """
+    yield CHAIN_MAGIC + VERSION.pack(FORMAT_VERSION) + COUNT.pack(count)
+    for encoded_block in encoded_blocks:
+        yield BLOCK_LENGTH.pack(len(encoded_block)) + encoded_block
+
+
+def decode_chain(data):
+    """
+    Split a binary chain made by encode_chain()
+
+    :returns: <list> the binary encoding of each block
+    """
+    reader = Reader(data)
+    if reader.read(len(CHAIN_MAGIC)) != CHAIN_MAGIC:
+        raise ValueError("Not a binary chain")
+    version = reader.unpack(VERSION)
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported binary chain version {version}")
+    encoded_blocks = [
+        reader.read(reader.unpack(BLOCK_LENGTH)) for _ in range(reader.unpack(COUNT))
+    ]
+    if not reader.at_end():
+        raise ValueError("Trailing data after binary chain")
+    return encoded_blocks
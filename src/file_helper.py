@@ -1,4 +1,3 @@
-import json
 import sys, os
 
 # Get relative path to blockchain files
@@ -7,33 +6,66 @@ module_dir = os.path.join(script_dir, "..", "src")
 sys.path.append(module_dir)
 
 from blockchain import Blockchain
+from block_store import BlockLog
+from checkpoint import Checkpointer, read_checkpoint
+from difficulty import TARGET_BLOCK_TIME
+from tx_index import TxIndex
+
+DB_DIR = "db"
+# Where the whole chain was saved as one JSON file, before the block log
+LEGACY_BLOCKCHAIN_FILE = os.path.join(DB_DIR, "blockchain.json")
+TX_INDEX_FILE = os.path.join(DB_DIR, "tx_index.sqlite")
+CHECKPOINT_FILE = os.path.join(DB_DIR, "checkpoint.json")
+# Number of blocks between checkpoints
+CHECKPOINT_INTERVAL = 100
 
 
 def read_blockchain() -> object:
     """
-    Read blockchain data from the saved file when coming back
-    online. If blockchain file is unavailable, it creates it.
+    Read blockchain data from the block log when coming back
+    online. If the block log is unavailable, it creates it.
+    Blocks are only loaded from the log as they're needed.
+
+    The balances, difficulty, peers and mempool come from the latest checkpoint,
+    and only the blocks added after it are replayed.
 
-    :param filepath: <str> filepath (and name) to read from
-    :return: <object> loaded chain data as a json object
+    :return: <object> the blockchain, persisting new blocks to the block log and
+             checkpointing its state every CHECKPOINT_INTERVAL blocks
     """
-    if not os.path.isfile("db/blockchain.json"):
-        return Blockchain()
-    with open("db/blockchain.json") as file:
-        # FIXME: This doesn't deserialize "everything" i.e. the difficulty, peers, etc, just the chain itself
-        json_chain = json.load(file)
-        chain = Blockchain.json_deserialize(json_chain)
-        return chain
+    store = BlockLog(DB_DIR)
+    blockchain = Blockchain()
+    # Adjust the target to mine a block every TARGET_BLOCK_TIME seconds
+    blockchain.target_block_time = TARGET_BLOCK_TIME
+    blockchain.use_store(
+        store, TxIndex(TX_INDEX_FILE), read_checkpoint(CHECKPOINT_FILE)
+    )
+    if len(store) == 0 and os.path.isfile(LEGACY_BLOCKCHAIN_FILE):
+        # Blocks are now hashed from their binary header, so none of the blocks an
+        # older version saved are linked or mined under the current rules. Rather
+        # than serve a chain every peer rejects, start over and sync from peers
+        print(
+            f"Ignoring {LEGACY_BLOCKCHAIN_FILE}: it was saved by an older version "
+            "whose blocks aren't valid under the current block format. Starting with "
+            "an empty chain, connect to peers to sync"
+        )
+    blockchain.checkpointer = Checkpointer(
+        blockchain, CHECKPOINT_FILE, CHECKPOINT_INTERVAL
+    )
+    return blockchain
 
 
-def write_blockchain(chain: object):
+def write_blockchain(blockchain: object, checkpoint=False):
     """
-    Write the blockchain data to a file so that a node can safely go offline
-    without losing all data
+    Make sure every block appended to the block log is on disk, so that a node can
+    safely go offline without losing any data. New blocks are appended to the log
+    as they're added to the chain, so there's nothing else to write
 
-    :param data: <object> the data to write to file in JSON format
-    :param filepath: <str> Type of data to write (either "blockchain" or "node")
+    :param blockchain: <object> the blockchain read with read_blockchain()
+    :param checkpoint: <bool> also checkpoint the blockchain's state (e.g. on
+                       shutdown, so the peers and mempool aren't lost)
     :returns: None
     """
-    with open("db/blockchain.json", "w") as file:
-        json.dump(chain, file)
+    if blockchain.store is not None:
+        blockchain.store.sync()
+    if checkpoint and blockchain.checkpointer is not None:
+        blockchain.checkpointer.save()
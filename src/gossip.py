@@ -0,0 +1,320 @@
+import threading
+from collections import OrderedDict, deque
+from time import time
+
+from block import Block
+from transaction import Transaction
+
+
+class Gossip:
+    def __init__(
+        self,
+        blockchain,
+        batch_size=100,
+        queue_size=1000,
+        flush_interval=0.05,
+        seen_size=100000,
+    ) -> None:
+        """
+        Pushes new transactions and blocks to every registered peer, and relays the
+        ones peers push to us.
+
+        Transactions are announced as they enter the mempool and blocks as they
+        become the tip of the chain, whether they were created here or received
+        from a peer. Every transaction id and block hash is remembered in a seen-set,
+        so a message is processed and relayed at most once and doesn't loop between
+        peers.
+
+        Each peer has its own bounded outbound queue, drained by its own thread in
+        batches of up to `batch_size` messages, so a slow or unreachable peer never
+        holds up the others. When a peer's queue is full, new messages for it are
+        dropped (it can still catch up through /consensus), and a peer whose
+        requests fail is backed off.
+
+        :param blockchain: <object> the local blockchain
+        :param batch_size: <int> most messages sent to a peer in one request
+        :param queue_size: <int> most messages waiting to be sent to each peer
+        :param flush_interval: <float> seconds to wait for a batch to fill up
+        :param seen_size: <int> number of message ids remembered
+        """
+        self.blockchain = blockchain
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.flush_interval = flush_interval
+        self.seen_size = seen_size
+        # message id (tx id or block hash) -> None, oldest first
+        self.seen = OrderedDict()
+        self.seen_lock = threading.Lock()
+        # peer -> PeerQueue
+        self.queues = {}
+        self.queues_lock = threading.Lock()
+        # Held while catching up with peers after an unknown block
+        self.syncing = threading.Lock()
+
+        blockchain.mempool.add_listener(self.on_mempool_change)
+        blockchain.add_tip_listener(self.on_new_tip)
+
+    def mark_seen(self, message_id):
+        """
+        :returns: <bool> True if the message hadn't been seen before
+        """
+        with self.seen_lock:
+            if message_id in self.seen:
+                self.seen.move_to_end(message_id)
+                return False
+            self.seen[message_id] = None
+            while len(self.seen) > self.seen_size:
+                self.seen.popitem(last=False)
+            return True
+
+    def has_seen(self, message_id):
+        with self.seen_lock:
+            return message_id in self.seen
+
+    def on_mempool_change(self, tx, added):
+        if added and self.mark_seen(tx.id()):
+            self.announce("transactions", tx.json_serialize())
+
+    def on_new_tip(self):
+        tip = self.blockchain.get_latest_block()
+        if tip is not None and self.mark_seen(tip.hash()):
+            self.announce("blocks", tip.json_serialize())
+
+    def announce(self, kind, message):
+        """
+        Queue a message for every peer
+
+        :param kind: <str> "transactions" or "blocks"
+        :param message: <dict> the JSON serialized transaction or block
+        """
+        for peer in self.blockchain.peer_list():
+            self.queue(peer).put(kind, message)
+
+    def queue(self, peer):
+        with self.queues_lock:
+            queue = self.queues.get(peer)
+            if queue is None:
+                queue = PeerQueue(
+                    peer,
+                    self.send,
+                    self.queue_size,
+                    self.batch_size,
+                    self.flush_interval,
+                )
+                self.queues[peer] = queue
+            return queue
+
+    def send(self, peer, batch):
+        """
+        Deliver a batch of (kind, message) pairs to a peer
+
+        :returns: <bool> True if the peer accepted it
+        """
+        payload = {"blocks": [], "transactions": []}
+        for kind, message in batch:
+            payload[kind].append(message)
+        response = self.blockchain.peer_client.post(peer, "/gossip", json=payload)
+        return response is not None and response.status_code == 200
+
+    def receive(self, payload):
+        """
+        Process a batch of messages pushed by a peer. New blocks that extend our
+        chain are added to it and new valid transactions to the mempool, which
+        relays them to our peers in turn. Blocks that fork off our chain are kept in
+        the block tree, and the chain is reorganized onto their branch if it gets
+        more work. A block we can't connect at all means a peer is ahead of us, so
+        we catch up in the background
+
+        :param payload: <dict> {"blocks": [...], "transactions": [...]}
+        :returns: <dict> the number of blocks and transactions accepted
+        :raises ValueError: if the blocks or transactions aren't lists
+        """
+        json_blocks = payload.get("blocks", [])
+        json_txs = payload.get("transactions", [])
+        if not isinstance(json_blocks, list) or not isinstance(json_txs, list):
+            raise ValueError("Expected lists of blocks and transactions")
+        accepted = {"blocks": 0, "transactions": 0}
+        # Blocks first, so transactions are checked against the newest chain
+        for json_block in json_blocks:
+            try:
+                block = Block.json_deserialize(json_block)
+            except (KeyError, TypeError, ValueError):
+                continue
+            if self.receive_block(block):
+                accepted["blocks"] += 1
+        for json_tx in json_txs:
+            try:
+                tx = Transaction.json_deserialize(json_tx)
+            except (KeyError, TypeError, ValueError):
+                continue
+            if self.receive_transaction(tx):
+                accepted["transactions"] += 1
+        return accepted
+
+    def receive_transaction(self, tx):
+        tx_id = tx.id()
+        if self.has_seen(tx_id):
+            return False
+        if self.blockchain.add_transaction(tx):
+            # The mempool listener marks it seen and relays it
+            return True
+        self.mark_seen(tx_id)
+        return False
+
+    def receive_block(self, block):
+        # Checking the block against our tip and adding it happen atomically
+        with self.blockchain.lock.write():
+            return self._receive_block(block)
+
+    def _receive_block(self, block):
+        blockchain = self.blockchain
+        block_hash = block.hash()
+        if (
+            self.has_seen(block_hash)
+            or block_hash in blockchain.heights
+            or block_hash in blockchain.tree
+        ):
+            return False
+        tip = blockchain.get_latest_block()
+        tip_hash = tip.hash() if tip is not None else None
+        if block.previous_hash != tip_hash:
+            self.mark_seen(block_hash)
+            parent_hash = block.previous_hash
+            if parent_hash in blockchain.heights or parent_hash in blockchain.tree:
+                # It forks off our chain, or extends a side branch. If that makes
+                # the branch overtake our chain, the tip listener relays its tip
+                return blockchain.add_fork_block(block)
+            # We're missing its ancestors
+            self.catch_up()
+            return False
+        chain = blockchain.chain
+        validator = blockchain.validator
+        valid = (
+            validator.valid_block(block, chain, len(chain))
+            and validator.valid_spends(block, blockchain.balances)
+            and blockchain.verifier.verify_transactions(block.transactions["regular"])
+        )
+        if not valid:
+            self.mark_seen(block_hash)
+            return False
+        # The tip listener marks it seen and relays it
+        blockchain.add_block(block)
+        return True
+
+    def catch_up(self):
+        """
+        Run consensus in the background, unless it's already running
+        """
+        if not self.syncing.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                self.blockchain.consensus()
+            finally:
+                self.syncing.release()
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def stats(self):
+        """
+        :returns: <dict> peer -> outbound queue statistics
+        """
+        with self.queues_lock:
+            return {peer: queue.stats() for peer, queue in self.queues.items()}
+
+    def close(self):
+        with self.queues_lock:
+            for queue in self.queues.values():
+                queue.close()
+            self.queues = {}
+        self.blockchain.mempool.remove_listener(self.on_mempool_change)
+        self.blockchain.remove_tip_listener(self.on_new_tip)
+
+
+class PeerQueue:
+    # Longest a failing peer is backed off for, in seconds
+    MAX_BACKOFF = 5
+
+    def __init__(self, peer, send, max_size, batch_size, flush_interval) -> None:
+        """
+        Bounded outbound message queue for one peer, drained in batches by its own
+        thread
+
+        :param send: <function> called with (peer, batch), returns True on success
+        """
+        self.peer = peer
+        self.send = send
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.messages = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.failures = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, kind, message):
+        """
+        :returns: <bool> False if the queue was full and the message was dropped
+        """
+        with self.condition:
+            if len(self.messages) >= self.max_size:
+                self.dropped += 1
+                return False
+            self.messages.append((kind, message))
+            self.condition.notify()
+            return True
+
+    def stats(self):
+        with self.condition:
+            return {
+                "queued": len(self.messages),
+                "sent": self.sent,
+                "dropped": self.dropped,
+                "failures": self.failures,
+            }
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            if self.send(self.peer, batch):
+                with self.condition:
+                    self.sent += len(batch)
+                    self.failures = 0
+                continue
+            with self.condition:
+                self.dropped += len(batch)
+                self.failures += 1
+                backoff = min(0.1 * 2 ** self.failures, self.MAX_BACKOFF)
+                # Back off, unless we're closed in the meantime
+                self.condition.wait_for(lambda: self.closed, timeout=backoff)
+
+    def next_batch(self):
+        """
+        Wait for messages, then give a batch a moment to fill up
+
+        :returns: <list> up to batch_size (kind, message) pairs, or None once closed
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.messages or self.closed)
+            if self.closed:
+                return None
+            deadline = time() + self.flush_interval
+            while len(self.messages) < self.batch_size and not self.closed:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            count = min(len(self.messages), self.batch_size)
+            return [self.messages.popleft() for _ in range(count)]
@@ -0,0 +1,182 @@
+import codecs
+import json
+
+DECODER = json.JSONDecoder()
+WHITESPACE = " \t\n\r"
+
+
+class ResponseTooLarge(ValueError):
+    pass
+
+
+class JSONStream:
+    def __init__(self, chunks, max_bytes=None) -> None:
+        """
+        Incremental reader of a JSON document arriving in chunks of bytes (e.g. an
+        HTTP response body), which decodes one value at a time instead of the whole
+        document.
+
+        Only the part of the document that hasn't been consumed yet is buffered, so
+        reading an array an item at a time needs about as much memory as its
+        largest item.
+
+        :param chunks: <iterator> the document, as chunks of UTF-8 bytes
+        :param max_bytes: <int> raise ResponseTooLarge once more than this many bytes
+                          have been read (no limit if None)
+        """
+        self.chunks = iter(chunks)
+        self.max_bytes = max_bytes
+        self.received = 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.position = 0
+        self.finished = False
+
+    def fill(self):
+        """
+        Append the next chunk to the buffer, dropping what was already consumed
+
+        :returns: <bool> False if the document has been read to the end
+        """
+        if self.finished:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.finished = True
+            self.buffer = self.buffer[self.position :] + self.decoder.decode(
+                b"", final=True
+            )
+            self.position = 0
+            return False
+        self.received += len(chunk)
+        if self.max_bytes is not None and self.received > self.max_bytes:
+            raise ResponseTooLarge(f"Response is over {self.max_bytes} bytes")
+        self.buffer = self.buffer[self.position :] + self.decoder.decode(chunk)
+        self.position = 0
+        return True
+
+    def peek(self):
+        """
+        Skip whitespace
+
+        :returns: <str> the next character, or "" at the end of the document
+        """
+        while True:
+            while (
+                self.position < len(self.buffer)
+                and self.buffer[self.position] in WHITESPACE
+            ):
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.fill():
+                return ""
+
+    def next(self):
+        """
+        :returns: <str> the next character (other than whitespace), consumed
+        """
+        char = self.peek()
+        if not char:
+            raise ValueError("Unexpected end of JSON document")
+        self.position += 1
+        return char
+
+    def expect(self, char):
+        found = self.next()
+        if found != char:
+            raise ValueError(f"Expected {char!r} in JSON document, found {found!r}")
+
+    def separator(self, close):
+        """
+        Consume the comma between two items of an array or object, or its closing
+        bracket
+
+        :returns: <bool> True if it was the closing bracket
+        """
+        char = self.next()
+        if char == close:
+            return True
+        if char != ",":
+            raise ValueError(
+                f"Expected ',' or {close!r} in JSON document, found {char!r}"
+            )
+        return False
+
+    def value(self):
+        """
+        :returns: <object> the next JSON value, decoded
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = DECODER.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                # Most likely the value continues in the next chunks. Read at least as
+                # much again as we have before retrying, so a large value is decoded a
+                # bounded number of times
+                if not self.fill_to(2 * (len(self.buffer) - self.position)):
+                    raise
+                continue
+            # A number could go on in the next chunk
+            if end == len(self.buffer) and self.fill():
+                continue
+            self.position = end
+            return value
+
+    def fill_to(self, size):
+        """
+        Read until at least `size` characters haven't been consumed yet
+
+        :returns: <bool> False if the document ended first
+        """
+        filled = False
+        while len(self.buffer) - self.position < size:
+            if not self.fill():
+                return filled
+            filled = True
+        return True
+
+
+def iter_json_array(chunks, key, max_bytes=None):
+    """
+    Decode the items of the array `key` of a JSON object one at a time, as the
+    document streams in. The object's other fields are read and discarded
+
+    :param chunks: <iterator> the document, as chunks of UTF-8 bytes
+    :param key: <str> name of the array
+    :param max_bytes: <int> raise ResponseTooLarge once more than this many bytes
+                      have been read (no limit if None)
+    :returns: <iterator> the items of the array
+    :raises ValueError: if the document isn't valid JSON
+    :raises KeyError: if the object has no `key`
+    """
+    stream = JSONStream(chunks, max_bytes)
+    found = False
+    stream.expect("{")
+    if stream.peek() == "}":
+        stream.next()
+    else:
+        while True:
+            name = stream.value()
+            if not isinstance(name, str):
+                raise ValueError("JSON object keys must be strings")
+            stream.expect(":")
+            if name == key and not found:
+                found = True
+                stream.expect("[")
+                if stream.peek() == "]":
+                    stream.next()
+                else:
+                    while True:
+                        yield stream.value()
+                        if stream.separator("]"):
+                            break
+            else:
+                stream.value()
+            if stream.separator("}"):
+                break
+    if stream.peek():
+        raise ValueError("Extra data after JSON document")
+    if not found:
+        raise KeyError(key)
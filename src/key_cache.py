@@ -0,0 +1,91 @@
+from collections import OrderedDict
+from threading import Lock
+
+from ecdsa import SECP256k1, VerifyingKey
+
+
+class InternedKey(VerifyingKey):
+    """
+    A VerifyingKey that is the canonical object for its address, and carries its
+    compressed encoding so it never has to be recomputed.
+
+    Interned keys compare by identity first, which is what almost every comparison
+    comes down to, and fall back to their compressed bytes (e.g. if a key was
+    evicted from the cache and interned again).
+    """
+
+    compressed = None
+    address = None
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if isinstance(other, InternedKey):
+            return self.compressed == other.compressed
+        return super().__eq__(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.compressed)
+
+
+class KeyCache:
+    def __init__(self, max_size=100000) -> None:
+        """
+        Bounded cache of interned keys, one per address, least recently used evicted first
+
+        :param max_size: <int> how many keys to hold
+        """
+        self.max_size = max_size
+        # address (compressed hex) -> InternedKey
+        self.keys = OrderedDict()
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, address):
+        """
+        :param address: <str> compressed pubkey (hex)
+        :returns: <object> the interned key for the address
+        """
+        with self.lock:
+            key = self.keys.get(address)
+            if key is not None:
+                self.keys.move_to_end(address)
+                return key
+
+        compressed = bytes.fromhex(address)
+        key = InternedKey.from_string(compressed, curve=SECP256k1)
+        key.compressed = compressed
+        key.address = address
+        with self.lock:
+            # Another thread may have interned it in the meantime
+            key = self.keys.setdefault(address, key)
+            self.keys.move_to_end(address)
+            while len(self.keys) > self.max_size:
+                self.keys.popitem(last=False)
+        return key
+
+    def intern(self, pubkey):
+        """
+        :param pubkey: <object> any VerifyingKey
+        :returns: <object> the interned key for the same address
+        """
+        if isinstance(pubkey, InternedKey):
+            return pubkey
+        return self.get(pubkey.to_string("compressed").hex())
+
+
+# The key cache shared by the whole node
+key_cache = KeyCache()
+
+
+def intern_address(address):
+    return key_cache.get(address)
+
+
+def intern_key(pubkey):
+    return key_cache.intern(pubkey)
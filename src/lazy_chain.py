@@ -0,0 +1,153 @@
+import threading
+from collections import OrderedDict
+
+
+class LazyChain:
+    def __init__(self, store, cache_size=1024) -> None:
+        """
+        A chain backed by a block log, which behaves like the list of blocks it holds.
+
+        Blocks are only read from the (memory-mapped) log and deserialized when they're
+        accessed, and the most recently used ones are kept in an LRU cache. Block hashes
+        come from the log's index, so looking them up decodes nothing.
+
+        :param store: <object> the BlockLog holding the chain
+        :param cache_size: <int> number of decoded blocks to keep in memory
+        """
+        self.store = store
+        self.cache_size = cache_size
+        # height -> block, least recently used first
+        self.cache = OrderedDict()
+        # Several threads can read the blockchain (and so the cache) at once
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.store)
+
+    def __iter__(self):
+        for height in range(len(self)):
+            yield self[height]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[height] for height in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("chain index out of range")
+
+        with self.lock:
+            block = self.cache.get(index)
+            if block is not None:
+                self.cache.move_to_end(index)
+                return block
+        # Decoded without holding the lock, so other blocks can be read meanwhile
+        block = self.store.read(index)
+        # The index already knows the hash, don't compute it again
+        block.cache_hash(self.store.hashes[index])
+        self.remember(index, block)
+        return block
+
+    def hash_at(self, height):
+        return self.store.hashes[height]
+
+    def append(self, block):
+        self.store.append(block)
+        self.remember(len(self) - 1, block)
+
+    def truncate(self, height):
+        """
+        Remove every block from `height` on
+        """
+        self.store.truncate(height)
+        with self.lock:
+            for cached in [cached for cached in self.cache if cached >= height]:
+                del self.cache[cached]
+
+    def remember(self, height, block):
+        with self.lock:
+            self.cache[height] = block
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+
+class ForkedChain:
+    def __init__(self, base, fork_point, blocks) -> None:
+        """
+        A chain made of the first `fork_point` blocks of `base` followed by `blocks`,
+        without copying (or, for a LazyChain, loading) the shared prefix
+
+        :param base: <list> the chain we forked from
+        :param fork_point: <int> number of leading blocks shared with `base`
+        :param blocks: <list> the blocks after the fork point
+        """
+        self.base = base
+        self.fork_point = fork_point
+        self.blocks = list(blocks)
+
+    def __len__(self):
+        return self.fork_point + len(self.blocks)
+
+    def __iter__(self):
+        for height in range(len(self)):
+            yield self[height]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[height] for height in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("chain index out of range")
+        if index < self.fork_point:
+            return self.base[index]
+        return self.blocks[index - self.fork_point]
+
+
+class ChainChanged(Exception):
+    """
+    Raised when a ChainSnapshot's blocks were replaced while it was being read
+    """
+
+
+class ChainSnapshot:
+    def __init__(self, blockchain, start, stop, chunk_size=100) -> None:
+        """
+        The blocks [start, stop) of a blockchain as they are now, to be read later a
+        chunk at a time (e.g. while streaming them to a peer) without holding the
+        blockchain's lock in between chunks.
+
+        Only the block hashes are captured up front. Each chunk is read under the
+        read lock and checked against them, so a snapshot never mixes blocks from
+        before and after a chain swap: reading it raises ChainChanged instead.
+        Blocks added to the tip in the meantime don't affect it.
+
+        Must be created with the blockchain's lock held (see Blockchain.snapshot())
+
+        :param chunk_size: <int> number of blocks read per lock acquisition
+        """
+        self.blockchain = blockchain
+        self.height = len(blockchain.chain)
+        self.start = min(start, self.height)
+        self.stop = max(min(stop, self.height), self.start)
+        self.chunk_size = chunk_size
+        self.tip = blockchain.block_hash(self.height - 1) if self.height else None
+        self.hashes = [blockchain.block_hash(h) for h in range(self.start, self.stop)]
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __iter__(self):
+        for chunk_start in range(self.start, self.stop, self.chunk_size):
+            chunk_stop = min(chunk_start + self.chunk_size, self.stop)
+            with self.blockchain.lock.read():
+                if len(self.blockchain.chain) < chunk_stop:
+                    raise ChainChanged("The chain was replaced while being read")
+                blocks = []
+                for height in range(chunk_start, chunk_stop):
+                    if self.blockchain.block_hash(height) != self.hashes[
+                        height - self.start
+                    ]:
+                        raise ChainChanged("The chain was replaced while being read")
+                    blocks.append(self.blockchain.chain[height])
+            yield from blocks
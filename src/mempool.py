@@ -0,0 +1,134 @@
+from collections import OrderedDict
+from itertools import islice
+
+
+class Mempool:
+    def __init__(self, max_size=10000) -> None:
+        """
+        Transactions waiting to be included in a block.
+
+        Entries are indexed by transaction id (for O(1) dedupe and eviction) and by
+        sender and recipient, and a running pending balance change is kept per
+        account so unverified balances don't need a scan.
+
+        :param max_size: <int> maximum number of transactions held. When full, the
+                         oldest transaction is evicted to make room
+        """
+        self.max_size = max_size
+        # tx id -> transaction, in order of arrival
+        self.transactions = OrderedDict()
+        # compressed pubkey -> set of tx ids
+        self.by_sender = {}
+        self.by_recipient = {}
+        # compressed pubkey -> sum of pending credits minus debits
+        self.pending = {}
+        # Callbacks run with (transaction, True if it was added or False if removed)
+        # whenever the mempool changes (e.g. to update the block template)
+        self.listeners = []
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def __iter__(self):
+        return iter(list(self.transactions.values()))
+
+    def __contains__(self, tx_id):
+        return tx_id in self.transactions
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self.listeners.remove(callback)
+
+    def add(self, tx):
+        """
+        Add a transaction to the mempool
+
+        :returns: <bool> False if the transaction was already in the mempool
+        """
+        tx_id = tx.id()
+        if tx_id in self.transactions:
+            return False
+        while len(self.transactions) >= self.max_size:
+            self.remove(next(iter(self.transactions)))
+
+        sender, recipient = tx.sender_address, tx.recipient_address
+        self.transactions[tx_id] = tx
+        self.by_sender.setdefault(sender, set()).add(tx_id)
+        self.by_recipient.setdefault(recipient, set()).add(tx_id)
+        self._update_pending(sender, -(tx.amount + tx.fee))
+        self._update_pending(recipient, tx.amount)
+        for listener in self.listeners:
+            listener(tx, True)
+        return True
+
+    def remove(self, tx_id):
+        """
+        Remove a transaction from the mempool, if it's there
+
+        :returns: <object> the removed transaction, or None
+        """
+        tx = self.transactions.pop(tx_id, None)
+        if tx is None:
+            return None
+
+        sender, recipient = tx.sender_address, tx.recipient_address
+        self._discard(self.by_sender, sender, tx_id)
+        self._discard(self.by_recipient, recipient, tx_id)
+        self._update_pending(sender, tx.amount + tx.fee)
+        self._update_pending(recipient, -tx.amount)
+        for listener in self.listeners:
+            listener(tx, False)
+        return tx
+
+    def remove_block(self, block):
+        """
+        Evict the transactions included in a newly accepted block
+        """
+        for tx in block.transactions["regular"]:
+            self.remove(tx.id())
+
+    def get(self, tx_id):
+        return self.transactions.get(tx_id)
+
+    def address_txs(self, address):
+        """
+        :param address: <str> compressed pubkey (hex)
+        :returns: <list> the pending transactions the account sends or receives, in
+                  no particular order
+        """
+        tx_ids = self.by_sender.get(address, set()) | self.by_recipient.get(
+            address, set()
+        )
+        return [self.transactions[tx_id] for tx_id in tx_ids]
+
+    def pending_balance(self, address):
+        """
+        :param address: <str> compressed pubkey (hex)
+        :returns: <int> how much the account's balance will change once its
+                  pending transactions are confirmed
+        """
+        return self.pending.get(address, 0)
+
+    def page(self, offset=0, limit=100):
+        """
+        :returns: <list> up to `limit` transactions in order of arrival, starting at `offset`
+        """
+        return list(islice(self.transactions.values(), offset, offset + limit))
+
+    def _update_pending(self, address, amount):
+        pending = self.pending.get(address, 0) + amount
+        if pending:
+            self.pending[address] = pending
+        else:
+            self.pending.pop(address, None)
+
+    @staticmethod
+    def _discard(index, address, tx_id):
+        tx_ids = index.get(address)
+        if tx_ids is None:
+            return
+        tx_ids.discard(tx_id)
+        if not tx_ids:
+            del index[address]
@@ -0,0 +1,69 @@
+from hashlib import sha256
+
+# Root of a block with no transactions
+EMPTY_ROOT = bytes(32)
+
+
+def merkle_root(leaves):
+    """
+    Fold a list of leaf hashes into a Merkle root. A level with an odd number of
+    nodes pairs its last node with itself, so repeating the last leaves can give the
+    same root: lists of leaves with duplicates must be rejected by the caller (see
+    block.seal_deserialized)
+
+    :param leaves: <list> raw 32 byte leaf hashes
+    :returns: <bytes> the raw 32 byte root
+    """
+    if not leaves:
+        return EMPTY_ROOT
+    level = list(leaves)
+    while len(level) > 1:
+        level = next_level(level)
+    return level[0]
+
+
+def merkle_proof(leaves, index):
+    """
+    The inclusion path of leaves[index]: the sibling at each level, from the leaf up
+
+    :returns: <list> (sibling hash, position) pairs, where position is "left" or
+              "right" depending on which side of the running hash the sibling goes
+    """
+    if not 0 <= index < len(leaves):
+        raise IndexError(f"No leaf {index} in a tree of {len(leaves)}")
+    proof = []
+    level = list(leaves)
+    while len(level) > 1:
+        if index % 2:
+            proof.append((level[index - 1], "left"))
+        else:
+            sibling = level[index + 1] if index + 1 < len(level) else level[index]
+            proof.append((sibling, "right"))
+        level = next_level(level)
+        index //= 2
+    return proof
+
+
+def verify_proof(leaf, proof, root):
+    """
+    Check that `leaf` is included under `root`, given its merkle_proof()
+
+    :returns: <bool> True if the path leads to the root
+    """
+    node = leaf
+    for sibling, position in proof:
+        if position == "left":
+            node = sha256(sibling + node).digest()
+        elif position == "right":
+            node = sha256(node + sibling).digest()
+        else:
+            return False
+    return node == root
+
+
+def next_level(level):
+    if len(level) % 2:
+        level.append(level[-1])
+    return [
+        sha256(level[i] + level[i + 1]).digest() for i in range(0, len(level), 2)
+    ]
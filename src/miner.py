@@ -0,0 +1,160 @@
+import multiprocessing
+import os
+from hashlib import sha256
+from time import time
+
+from encoding import NONCE
+
+# How many nonces to try between checks for cancellation
+BATCH_SIZE = 10000
+
+
+class Miner:
+    def __init__(self, block) -> None:
+        """
+        Proof-of-work engine for a single block.
+
+        The block's header commits to its transactions through their Merkle root, so
+        the hash preimage is the same size however many transactions there are.
+        Everything in the header before the nonce is fed into a SHA-256 object (the
+        "midstate") once, and each attempt only copies that state and hashes the
+        nonce bytes.
+
+        :param block: <object> The block to find a valid proof for
+        """
+        self.block = block
+        self.prefix = block.hash_prefix()
+        self.midstate = sha256(self.prefix)
+        # Number of nonces tried by the last search
+        self.attempts = 0
+
+    def hash(self, nonce):
+        """
+        Hash the block as if its nonce was `nonce`. Identical to Block.hash()
+        """
+        attempt = self.midstate.copy()
+        attempt.update(block_suffix(nonce))
+        return attempt.hexdigest()
+
+    def search(self, target, start, stop, cancelled=None):
+        """
+        Try every nonce in [start, stop) until one hashes below the target
+
+        :param target: <int> the 256 bit number the hash must be below
+        :param start: <int> first nonce to try
+        :param stop: <int> nonce to stop at (exclusive)
+        :param cancelled: <Event> optional event that aborts the search when set
+        :returns: <int> the valid nonce, or None if the range was exhausted or cancelled
+        """
+        nonce, self.attempts = search(self.midstate, target, start, stop, cancelled)
+        return nonce
+
+
+class ParallelMiner:
+    def __init__(self, workers=None) -> None:
+        """
+        Proof-of-work engine that splits the nonce space into disjoint ranges and
+        searches them in separate worker processes.
+
+        The first worker to find a valid proof cancels the others. The search can also
+        be cancelled from outside with cancel(), e.g. when a new block arrives.
+
+        :param workers: <int> number of worker processes (defaults to the CPU count)
+        """
+        self.workers = workers if workers else os.cpu_count() or 1
+        self.cancelled = multiprocessing.Event()
+        # worker id -> hashes per second during the last search
+        self.hash_rates = {}
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def search(self, block, target, start, stop):
+        """
+        Search [start, stop) for a valid nonce across all workers
+
+        :returns: <int> the valid nonce, or None if the range was exhausted or cancelled
+        """
+        prefix = block.hash_prefix()
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(
+                target=search_range,
+                args=(prefix, target, range_start, range_stop, worker_id),
+                kwargs={"cancelled": self.cancelled, "results": results},
+                daemon=True,
+            )
+            for worker_id, (range_start, range_stop) in enumerate(
+                partition(start, stop, self.workers)
+            )
+        ]
+        for process in processes:
+            process.start()
+
+        found = None
+        hash_rates = {}
+        # Every worker reports exactly once, whether it found a proof or not
+        for _ in processes:
+            worker_id, nonce, attempts, elapsed = results.get()
+            if nonce is not None and found is None:
+                found = nonce
+                self.cancel()
+            hash_rates[worker_id] = attempts / elapsed if elapsed else 0
+        for process in processes:
+            process.join()
+        # Ready for another search
+        self.cancelled.clear()
+
+        self.hash_rates = hash_rates
+        return found
+
+
+def partition(start, stop, parts):
+    """
+    Split [start, stop) into `parts` disjoint, contiguous ranges
+    """
+    size = (stop - start) // parts
+    bounds = [start + i * size for i in range(parts)] + [stop]
+    return [(bounds[i], bounds[i + 1]) for i in range(parts)]
+
+
+def search(midstate, target, start, stop, cancelled=None):
+    """
+    Try nonces in [start, stop) against a midstate until one hashes below the target
+
+    :returns: <tuple> (nonce or None, number of nonces tried)
+    """
+    attempts = 0
+    batch_start = start
+    while batch_start < stop:
+        if cancelled is not None and cancelled.is_set():
+            break
+        batch_stop = min(batch_start + BATCH_SIZE, stop)
+        for nonce in range(batch_start, batch_stop):
+            attempt = midstate.copy()
+            attempt.update(block_suffix(nonce))
+            # Compare the digest as a number, rather than hex encoding it
+            if int.from_bytes(attempt.digest(), "big") < target:
+                return nonce, attempts + nonce - batch_start + 1
+        attempts += batch_stop - batch_start
+        batch_start = batch_stop
+    return None, attempts
+
+
+def search_range(prefix, target, start, stop, worker_id, cancelled, results):
+    """
+    Worker process entry point for ParallelMiner. Reports
+    (worker_id, nonce, attempts, elapsed seconds) on the results queue
+    """
+    began = time()
+    nonce, attempts = search(sha256(prefix), target, start, stop, cancelled)
+    if nonce is not None:
+        cancelled.set()
+    results.put((worker_id, nonce, attempts, time() - began))
+
+
+def block_suffix(nonce):
+    """
+    The bytes of a block's header that follow the fixed prefix
+    """
+    return NONCE.pack(nonce)
@@ -0,0 +1,130 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+
+class MiningService:
+    def __init__(self, node, refresh_interval=1.0) -> None:
+        """
+        Mines blocks on a background thread, so nothing waits on a proof-of-work.
+
+        The service mines one block after another on the node's current block
+        template. A search is abandoned and restarted on a fresh template when
+        another block extends the chain (see Node.proof_of_work), or when new
+        transactions arrive and the search has been running for `refresh_interval`
+        seconds (so a steady stream of transactions can't stop blocks from being
+        found). Mined blocks are handed to the block listeners on a separate thread,
+        so persisting and announcing them doesn't hold up the next search.
+
+        :param node: <object> the node to mine with
+        :param refresh_interval: <float> seconds a search runs before new
+                                 transactions restart it
+        """
+        self.node = node
+        self.refresh_interval = refresh_interval
+        # Callbacks run with each mined block (e.g. to persist and announce it)
+        self.block_listeners = []
+        self.thread = None
+        self.stopping = threading.Event()
+        # Number of blocks the current run should mine (None to mine until stopped)
+        self.target = None
+        self.search_started = None
+        self.blocks_mined = 0
+        self.restarts = 0
+        self.last_block = None
+        self.announcer = ThreadPoolExecutor(max_workers=1)
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def add_block_listener(self, callback):
+        self.block_listeners.append(callback)
+
+    def remove_block_listener(self, callback):
+        self.block_listeners.remove(callback)
+
+    def start(self, workers=None, blocks=None):
+        """
+        Start mining in the background
+
+        :param workers: <int> number of proof-of-work processes (keeps the node's
+                        setting if None)
+        :param blocks: <int> stop after mining this many blocks (None to mine until
+                       stop() is called)
+        :returns: <bool> False if the service was already running
+        """
+        if self.running:
+            return False
+        if not self.node.pubkey:
+            raise ValueError("No pubkey set to collect block rewards")
+        if workers:
+            self.node.workers = workers
+        self.target = blocks
+        self.stopping.clear()
+        self.node.blockchain.mempool.add_listener(self.on_mempool_change)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self, timeout=None):
+        """
+        Stop mining, abandoning the search in progress
+
+        :returns: <bool> False if the service wasn't running
+        """
+        if not self.running:
+            return False
+        self.stopping.set()
+        deadline = None if timeout is None else time() + timeout
+        while self.running and (deadline is None or time() < deadline):
+            # Keep cancelling in case a new search was starting as we stopped
+            self.node.cancel()
+            self.thread.join(0.1)
+        return True
+
+    def status(self):
+        block = self.last_block
+        return {
+            "running": self.running,
+            "workers": self.node.workers,
+            "hash_rates": self.node.hash_rates,
+            "blocks_mined": self.blocks_mined,
+            "restarts": self.restarts,
+            "last_block": {"hash": block.hash(), **block.json_serialize()}
+            if block
+            else None,
+        }
+
+    def on_mempool_change(self, tx, added):
+        started = self.search_started
+        if added and started is not None and time() - started >= self.refresh_interval:
+            # Pick up the new transactions with a fresh template
+            self.node.cancel()
+
+    def announce(self, block):
+        for listener in list(self.block_listeners):
+            try:
+                listener(block)
+            except Exception as error:
+                print(f"Block listener failed for block {block.hash()}: {error}")
+
+    def run(self):
+        mined = 0
+        try:
+            while not self.stopping.is_set():
+                if self.target is not None and mined >= self.target:
+                    break
+                self.search_started = time()
+                block = self.node.mine()
+                self.search_started = None
+                if block is None:
+                    self.restarts += 1
+                    continue
+                mined += 1
+                self.blocks_mined += 1
+                self.last_block = block
+                self.announcer.submit(self.announce, block)
+        finally:
+            self.search_started = None
+            self.node.blockchain.mempool.remove_listener(self.on_mempool_change)
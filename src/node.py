@@ -1,71 +1,153 @@
 import random
+import threading
+from time import time
 from block import Block
 from transaction import Transaction
 from server_helper import compress
+from miner import Miner, ParallelMiner
+
+MIN_NONCE = 1
+MAX_NONCE = 9999999999999
 
 
 class Node:
-    def __init__(self, blockchain, pubkey=None, accounts={}) -> None:
+    def __init__(self, blockchain, pubkey=None, accounts={}, workers=1) -> None:
         self.blockchain = blockchain
         # This is the pubkey that will collect block rewards
         self.pubkey = pubkey
         self.accounts = accounts
+        # Number of processes to search for a proof-of-work with
+        self.workers = workers
+        # Hashes per second of each worker during the last proof-of-work search
+        self.hash_rates = {}
+        # Aborts the proof-of-work search in progress, if there is one
+        self.cancel_search = None
 
     def mine(self, message=""):
         """
         Mine a block by creating the block, finding a proof-of-work for it,
         and adding it to the chain.
-        :returns: <object> block
+        :returns: <object> block, or None if the search was cancelled or the block
+                  was rejected (e.g. another block became the tip in the meantime)
         """
         if not self.pubkey:
             print(
                 "MINING ERROR: No pubkey set to collect block reward, please create a wallet first"
             )
             return
+        # Read the tip and pick the transactions for it together, the proof-of-work
+        # search itself runs without holding the lock
+        with self.blockchain.lock.read():
+            tip = self.blockchain.get_latest_block()
+            # The highest fee transactions that fit in a block (see BlockTemplate)
+            pending_transactions = self.blockchain.template.get() if tip else []
+            target = self.blockchain.next_target()
+
         # Create the Genesis block if the chain is empty
-        if len(self.blockchain.chain) == 0:
+        if tip is None:
             return self.mine_block(
                 previous_hash=None,
                 message="Chancellor on brink of second bailout for banks",
+                target=target,
             )
 
         # If the chain is not empty, create normal block
-        previous_hash = self.blockchain.get_latest_block().hash()
-        pending_transactions = self.blockchain.pending_transactions
-        return self.mine_block(previous_hash, pending_transactions, message)
+        return self.mine_block(tip.hash(), pending_transactions, message, target)
 
-    def mine_block(self, previous_hash=None, pending_transactions=[], message=""):
+    def mine_block(
+        self, previous_hash=None, pending_transactions=[], message="", target=None
+    ):
+        """
+        :param target: <int> the block's proof-of-work target (defaults to the
+                       chain's next target)
+        """
+        if target is None:
+            target = self.blockchain.next_target()
+        # The miner collects the block reward plus the fees of its transactions
+        fees = sum(tx.fee for tx in pending_transactions)
         coinbase_tx = Transaction(
-            self.pubkey, self.pubkey, self.blockchain.block_reward, signature=message
+            self.pubkey,
+            self.pubkey,
+            self.blockchain.block_reward + fees,
+            signature=message,
         )
         block = Block(
             previous_hash=previous_hash,
             transactions={"coinbase": coinbase_tx, "regular": pending_transactions},
+            target=target,
         )
-        self.proof_of_work(block)
-        self.blockchain.add_block(block, self)
+        if self.proof_of_work(block) is None:
+            print("Mining cancelled before a proof was found")
+            return
+        if not self.blockchain.add_block(block, self):
+            return
         return block
 
     def proof_of_work(self, block) -> int:
         """
         Mine a block by finding a Proof-of-Work:
-            Find a valid proof by hashing a random nonce with the block's data until
-            the provided hash is smaller than the target difficulty. In our case, target
-            difficulty is simulated by a number of leading zero's to compare to our hash,
-            instead of comparing an actual 256 bit hex number.
+            Find a valid proof by hashing nonces with the block's data until
+            the hash, as a 256 bit number, is smaller than the block's target.
 
         :param block: <object> The block to find a valid proof for
-        :returns: <int> The nonce that satisfies the proof-of-work (i.e. the "proof")
+        :returns: <int> The nonce that satisfies the proof-of-work (i.e. the "proof"),
+                  or None if the search was cancelled by a new block
         """
-        hash = block.hash()
+        target = block.target
         print("Mining...")
-        # A valid hash is found when the hash is smaller than the difficulty number
-        while hash[: self.blockchain.difficulty] > "0" * self.blockchain.difficulty:
-            nonce = random.randint(1, 9999999999999)
+        if self.workers > 1:
+            return self.parallel_proof_of_work(block, target)
+
+        miner = Miner(block)
+        cancelled = threading.Event()
+        # Stop searching if another block extends the chain in the meantime
+        self.blockchain.add_tip_listener(cancelled.set)
+        self.cancel_search = cancelled.set
+        began = time()
+        try:
+            # Search sequentially from a random starting point, wrapping around the nonce space
+            start = random.randint(MIN_NONCE, MAX_NONCE)
+            nonce = miner.search(target, start, MAX_NONCE + 1, cancelled)
+            attempts = miner.attempts
+            if nonce is None and not cancelled.is_set():
+                nonce = miner.search(target, MIN_NONCE, start, cancelled)
+                attempts += miner.attempts
+        finally:
+            self.blockchain.remove_tip_listener(cancelled.set)
+            self.cancel_search = None
+        elapsed = time() - began
+        self.hash_rates = {0: attempts / elapsed if elapsed else 0}
+        if nonce is not None:
+            block.nonce = nonce
+        return nonce
+
+    def parallel_proof_of_work(self, block, target):
+        """
+        Find a Proof-of-Work by splitting the nonce space across `self.workers` processes
+
+        :returns: <int> The nonce that satisfies the proof-of-work, or None if cancelled
+        """
+        miner = ParallelMiner(self.workers)
+        self.blockchain.add_tip_listener(miner.cancel)
+        self.cancel_search = miner.cancel
+        try:
+            nonce = miner.search(block, target, MIN_NONCE, MAX_NONCE + 1)
+        finally:
+            self.blockchain.remove_tip_listener(miner.cancel)
+            self.cancel_search = None
+        self.hash_rates = miner.hash_rates
+        if nonce is not None:
             block.nonce = nonce
-            hash = block.hash()
         return nonce
 
+    def cancel(self):
+        """
+        Abandon the proof-of-work search in progress (if any), so mine() returns None
+        """
+        cancel_search = self.cancel_search
+        if cancel_search is not None:
+            cancel_search()
+
     def add_account(self, wallet):
         """
         Add a new wallet to the wallets managed by this node
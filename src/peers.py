@@ -0,0 +1,124 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
+from time import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class PeerClient:
+    def __init__(self, timeout=5, max_concurrency=8) -> None:
+        """
+        HTTP client for talking to peer nodes.
+
+        Requests go through one pooled keep-alive session, have a per-peer timeout, and
+        can be fanned out to many peers at once. The outcome of every request is
+        recorded in a peer health table.
+
+        :param timeout: <float> seconds to wait on a peer before giving up on it
+        :param max_concurrency: <int> maximum number of peers queried at once
+        """
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=max_concurrency, pool_maxsize=max_concurrency
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # peer -> {"status", "latency_ms", "last_seen", "failures", "last_error"}
+        self.health = {}
+        self.health_lock = Lock()
+
+    def get(self, peer, path, **kwargs):
+        """
+        GET a path from a peer
+
+        :returns: <object> the response, or None if the peer couldn't be reached
+        """
+        began = time()
+        try:
+            response = self.session.get(
+                f"http://{peer}{path}", timeout=self.timeout, **kwargs
+            )
+        except requests.RequestException as error:
+            self.record_failure(peer, error)
+            return None
+        self.record_success(peer, time() - began)
+        return response
+
+    def post(self, peer, path, **kwargs):
+        """
+        POST to a path of a peer
+
+        :returns: <object> the response, or None if the peer couldn't be reached
+        """
+        began = time()
+        try:
+            response = self.session.post(
+                f"http://{peer}{path}", timeout=self.timeout, **kwargs
+            )
+        except requests.RequestException as error:
+            self.record_failure(peer, error)
+            return None
+        self.record_success(peer, time() - began)
+        return response
+
+    def get_all(self, peers, path, headers_for=None, **kwargs):
+        """
+        GET a path from every peer concurrently
+
+        :param headers_for: <function> returns the request headers for a peer, if
+                            they differ per peer (e.g. If-None-Match)
+        :returns: <iterator> (peer, response) pairs in the order the peers answer.
+                  Unreachable peers are skipped (and recorded in the health table)
+        """
+        peers = list(peers)
+        if not peers:
+            return
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            futures = {
+                executor.submit(
+                    self.get,
+                    peer,
+                    path,
+                    **kwargs,
+                    **({"headers": headers_for(peer)} if headers_for else {}),
+                ): peer
+                for peer in peers
+            }
+            for future in as_completed(futures):
+                response = future.result()
+                if response is not None:
+                    yield futures[future], response
+
+    def record_success(self, peer, latency):
+        with self.health_lock:
+            health = self.health.setdefault(peer, {"failures": 0, "last_error": None})
+            health.update(
+                status="ok",
+                latency_ms=round(latency * 1000, 1),
+                last_seen=time(),
+                failures=0,
+            )
+
+    def record_failure(self, peer, error):
+        with self.health_lock:
+            health = self.health.setdefault(
+                peer, {"latency_ms": None, "last_seen": None, "failures": 0}
+            )
+            health.update(
+                status="unreachable",
+                failures=health["failures"] + 1,
+                last_error=str(error),
+            )
+
+    def health_report(self, peers):
+        """
+        :returns: <dict> peer -> health entry, for each of `peers`
+        """
+        with self.health_lock:
+            return {
+                peer: dict(self.health.get(peer, {"status": "unknown"}))
+                for peer in peers
+            }
@@ -0,0 +1,111 @@
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+
+class RWLock:
+    def __init__(self) -> None:
+        """
+        Readers-writer lock: any number of threads can hold it for reading at once,
+        or a single thread for writing.
+
+        Writers are preferred: once a writer is waiting, threads that don't already
+        hold the lock wait for it, so a steady stream of reads can't starve writes.
+        Both modes are reentrant, and the writer can also take the lock for reading
+        (e.g. a tip listener reading the chain from inside add_block). A reader
+        can't upgrade to writing, that would deadlock with another upgrading reader.
+        """
+        self.condition = threading.Condition()
+        # thread id -> number of times it holds the lock for reading
+        self.readers = {}
+        self.writer = None
+        self.write_depth = 0
+        self.waiting_writers = 0
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        with self.condition:
+            if self.writer == me or me in self.readers:
+                self.readers[me] = self.readers.get(me, 0) + 1
+                return
+            self.condition.wait_for(
+                lambda: self.writer is None and not self.waiting_writers
+            )
+            self.readers[me] = 1
+
+    def release_read(self):
+        me = threading.get_ident()
+        with self.condition:
+            depth = self.readers[me] - 1
+            if depth:
+                self.readers[me] = depth
+            else:
+                del self.readers[me]
+                self.condition.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self.condition:
+            if self.writer == me:
+                self.write_depth += 1
+                return
+            if me in self.readers:
+                raise RuntimeError("Can't upgrade a read lock to a write lock")
+            self.waiting_writers += 1
+            try:
+                self.condition.wait_for(
+                    lambda: self.writer is None and not self.readers
+                )
+            finally:
+                self.waiting_writers -= 1
+            self.writer = me
+            self.write_depth = 1
+
+    def release_write(self):
+        with self.condition:
+            self.write_depth -= 1
+            if not self.write_depth:
+                self.writer = None
+                self.condition.notify_all()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+def reading(method):
+    """
+    Run a method holding its object's `lock` for reading
+    """
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock.read():
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def writing(method):
+    """
+    Run a method holding its object's `lock` for writing
+    """
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock.write():
+            return method(self, *args, **kwargs)
+
+    return wrapper
@@ -1,7 +1,7 @@
-from ecdsa import VerifyingKey, SECP256k1
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from uuid import uuid4
 
+import atexit
 import sys, os
 
 # Get relative path to blockchain files
@@ -10,31 +10,89 @@ module_dir = os.path.join(script_dir, "..", "src/blockchain")
 sys.path.append(module_dir)
 
 from node import Node
-from server_helper import get_port, compress
+from mining_service import MiningService
+from gossip import Gossip
+from server_helper import (
+    get_port,
+    compress,
+    parse_address,
+    chain_etag,
+    buffered,
+    gzipped,
+    json_chain_parts,
+)
+from chain_sync import MAX_HEADERS, MAX_BLOCKS
+from encoding import BINARY_CONTENT_TYPE, encode_chain, encode_chain_parts
 from file_helper import read_blockchain, write_blockchain
 from wallet_helper import read_wallet, write_wallet
 from transaction import Transaction
+from key_cache import intern_address
 
 app = Flask(__name__)
 
 node_identifier = uuid4()
 
-# Initialize the blockchain from DB file (or create new one)
-blockchain = read_blockchain()
-node = Node(blockchain)
+# Set up by start_node() when the server is started
+blockchain = None
+node = None
+wallet = None
+gossip = None
+mining_service = None
 
-wallet = read_wallet(blockchain)
-write_wallet(wallet.privkey, "Brandon LUcas")
 
-node.add_account(wallet)
-node.set_blockreward_pubkey(wallet.pubkey)
+def start_node():
+    """
+    Load the blockchain and wallet, and start the services that share them.
+
+    This isn't done on import: worker processes (e.g. the signature verifier's)
+    are spawned, so they import this module again, and must not reopen the block
+    log and indexes, read the wallet or start gossip and mining of their own
+    """
+    global blockchain, node, wallet, gossip, mining_service
+
+    # Initialize the blockchain from DB file (or create new one)
+    blockchain = read_blockchain()
+    node = Node(blockchain)
+    # Blocks are appended to the block log as they're mined, make sure they're on
+    # disk and checkpoint the rest of the state (e.g. peers and mempool)
+    atexit.register(write_blockchain, blockchain, checkpoint=True)
+
+    wallet = read_wallet(blockchain)
+    write_wallet(wallet.privkey, "Brandon LUcas")
+
+    node.add_account(wallet)
+    node.set_blockreward_pubkey(wallet.pubkey)
+
+    # Pushes new transactions and blocks to our peers, and relays theirs
+    gossip = Gossip(blockchain)
+
+    # Mines in the background, see /mine/start
+    mining_service = MiningService(node)
+    # Mined blocks are appended to the block log as they're added to the chain
+    mining_service.add_block_listener(lambda block: write_blockchain(blockchain))
 
 
 @app.route("/mine", methods=["GET"])
 def mine():
-    block = node.mine()
+    """
+    Mine a new block. With ?workers=N the search runs in the background across N
+    processes, and the result can be polled from /mine/status
+    """
+    workers = request.args.get("workers", type=int)
+    if workers:
+        if not mining_service.start(workers, blocks=1):
+            return jsonify({"message": "Already mining"}), 409
+        response = {
+            "message": f"Mining started with {workers} workers",
+            "status": "/mine/status",
+        }
+        return jsonify(response), 202
+    if mining_service.running:
+        return jsonify({"message": "Already mining"}), 409
 
-    write_blockchain(blockchain.json_serialize())
+    block = node.mine()
+    if block is None:
+        return jsonify({"message": "No block mined, chain tip changed"}), 409
 
     response = {
         "message": "New Block Mined!",
@@ -46,9 +104,218 @@ def mine():
     return jsonify(response), 201
 
 
+@app.route("/mine/start", methods=["POST"])
+def mine_start():
+    """
+    Mine continuously in the background until /mine/stop
+
+    ?workers=<n> to search for each proof-of-work across n processes
+    """
+    workers = request.args.get("workers", type=int)
+    if not mining_service.start(workers):
+        return jsonify({"message": "Already mining"}), 409
+    response = {"message": "Mining started", "status": "/mine/status"}
+    return jsonify(response), 202
+
+
+@app.route("/mine/stop", methods=["POST"])
+def mine_stop():
+    if not mining_service.stop(timeout=10):
+        return jsonify({"message": "Not mining"}), 409
+    return jsonify({"message": "Mining stopped", **mining_service.status()}), 200
+
+
+@app.route("/mine/status", methods=["GET"])
+def mine_status():
+    """
+    Report on the background mining service and per-worker hash rates
+    """
+    return jsonify(mining_service.status()), 200
+
+
 @app.route("/chain", methods=["GET"])
 def full_chain():
-    return jsonify(blockchain.json_serialize()), 200
+    """
+    The chain, streamed as it's serialized rather than built in memory first.
+
+    ?from=<height>&limit=<n> for a range of blocks. With ?format=binary, just the
+    blocks in the compact binary format. Responses are gzipped if the client
+    accepts it, and carry an ETag keyed on the tip of the chain (and a digest of
+    the mempool and peers, for the whole chain), so a client that already has the
+    current version gets a 304 (see server_helper.chain_etag)
+    """
+    ranged = "from" in request.args or "limit" in request.args
+    binary = request.args.get("format") == "binary"
+    start = max(request.args.get("from", 0, type=int), 0)
+    limit = request.args.get("limit", type=int)
+    stop = None if limit is None else start + max(limit, 0)
+    with blockchain.lock.read():
+        snapshot = blockchain.snapshot(start, stop)
+        if ranged or binary:
+            fields = {"from": snapshot.start, "height": snapshot.height}
+            etag = chain_etag(snapshot.tip)
+        else:
+            # The whole chain also has the mempool and the peers in it
+            fields = {
+                "pending_transactions": [
+                    tx.json_serialize() for tx in blockchain.mempool
+                ],
+                "difficulty": blockchain.difficulty,
+                "block_reward": blockchain.block_reward,
+                "peers": sorted(blockchain.peers),
+            }
+            etag = chain_etag(snapshot.tip, fields)
+
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+
+    if binary:
+        parts = encode_chain_parts(
+            len(snapshot), (block.binary_serialize() for block in snapshot)
+        )
+        mimetype = BINARY_CONTENT_TYPE
+    else:
+        parts = json_chain_parts(snapshot, fields)
+        mimetype = "application/json"
+    body = buffered(parts)
+    response_gzipped = "gzip" in request.headers.get("Accept-Encoding", "")
+    if response_gzipped:
+        body = gzipped(body)
+    response = Response(body, 200, mimetype=mimetype)
+    response.set_etag(etag, weak=True)
+    response.headers["Vary"] = "Accept-Encoding"
+    if response_gzipped:
+        response.headers["Content-Encoding"] = "gzip"
+    return response
+
+
+@app.route("/chain/height", methods=["GET"])
+def chain_height():
+    """
+    The length of the local chain, the hash of its tip and its total work (hex),
+    which is what peers compare chains by
+    """
+    height, tip, work = blockchain.tip()
+    response = {"height": height, "tip": tip, "work": f"{work:064x}"}
+    return jsonify(response), 200
+
+
+def block_range(max_limit):
+    """
+    Parse the ?from=<height>&limit=<n> range of a chain request
+    """
+    start = max(request.args.get("from", 0, type=int), 0)
+    limit = min(max(request.args.get("limit", max_limit, type=int), 0), max_limit)
+    return start, limit
+
+
+@app.route("/chain/headers", methods=["GET"])
+def chain_headers():
+    """
+    Headers (hash, previous_hash, merkle_root, timestamp, target, proof) of a range
+    of blocks
+    """
+    start, limit = block_range(MAX_HEADERS)
+    return jsonify({"headers": blockchain.headers(start, limit)}), 200
+
+
+@app.route("/chain/blocks", methods=["GET"])
+def chain_blocks():
+    """
+    A range of full blocks, as JSON or with ?format=binary in the compact binary format
+    """
+    start, limit = block_range(MAX_BLOCKS)
+    if request.args.get("format") == "binary":
+        blocks = blockchain.binary_blocks(start, limit)
+        return Response(encode_chain(blocks), 200, mimetype=BINARY_CONTENT_TYPE)
+    return jsonify({"blocks": blockchain.blocks(start, limit)}), 200
+
+
+@app.route("/block/<block_hash>", methods=["GET"])
+def get_block(block_hash):
+    """
+    Look up a block in the local chain by its hash
+    """
+    with blockchain.lock.read():
+        block = blockchain.get_block(block_hash)
+        if block is None:
+            return jsonify({"message": f"Block {block_hash} not found"}), 404
+        response = {
+            "hash": block_hash,
+            "height": blockchain.heights[block_hash],
+            **block.json_serialize(),
+        }
+    return jsonify(response), 200
+
+
+@app.route("/tx/<tx_id>", methods=["GET"])
+def get_tx(tx_id):
+    """
+    Look up a transaction in the local chain by its id
+    """
+    found = blockchain.find_transaction(tx_id)
+    if found is None:
+        return jsonify({"message": f"Transaction {tx_id} not found"}), 404
+    tx, block, height, position = found
+    response = {
+        "id": tx_id,
+        "block_hash": block.hash(),
+        "height": height,
+        "position": position,
+        **tx.json_serialize(),
+    }
+    return jsonify(response), 200
+
+
+@app.route("/tx/<tx_id>/proof", methods=["GET"])
+def get_tx_proof(tx_id):
+    """
+    Merkle inclusion proof of a transaction, which a light client can check against
+    the merkle_root of the block's header
+    """
+    found = blockchain.find_transaction(tx_id)
+    if found is None:
+        return jsonify({"message": f"Transaction {tx_id} not found"}), 404
+    _, block, height, _ = found
+    proof = block.merkle_proof(tx_id)
+    response = {
+        "tx_id": tx_id,
+        "block_hash": block.hash(),
+        "height": height,
+        "merkle_root": block.merkle_root().hex(),
+        "proof": [
+            {"hash": sibling.hex(), "position": position}
+            for sibling, position in proof
+        ],
+    }
+    return jsonify(response), 200
+
+
+@app.route("/address/<pubkey>/txs", methods=["GET"])
+def get_address_txs(pubkey):
+    """
+    Transactions sent or received by an address, newest first, a page at a time
+
+    ?cursor=<cursor>&limit=<n> (limit defaults to 100, at most 1000). Pass the
+    next_cursor of a page to get the one after it
+    """
+    limit = min(max(request.args.get("limit", 100, type=int), 1), 1000)
+    try:
+        txs, next_cursor = blockchain.address_transactions(
+            parse_address(pubkey), request.args.get("cursor"), limit
+        )
+    except ValueError as error:
+        return jsonify({"message": str(error)}), 400
+    response = {
+        "transactions": [
+            {"id": tx.id(), "height": height, **tx.json_serialize()}
+            for tx, height in txs
+        ],
+        "next_cursor": next_cursor,
+    }
+    return jsonify(response), 200
 
 
 @app.route("/consensus", methods=["GET"])
@@ -59,7 +326,7 @@ def consensus():
             "new_chain": True,
             "message": "Longer valid chain found in neighbor. Updated local chain.",
         }
-        write_blockchain(new_chain)
+        write_blockchain(blockchain)
     else:
         response = {
             "new_chain": False,
@@ -72,13 +339,39 @@ def consensus():
 @app.route("/peers/list")
 def list_peers():
     """
-    List all the peers saved by the current node
+    List all the peers saved by the current node, and how they responded last time
+    we contacted them
     """
-    response = {"peers": list(blockchain.peers)}
+    peers = blockchain.peer_list()
+    response = {
+        "peers": peers,
+        "health": blockchain.peer_client.health_report(peers),
+        "gossip": gossip.stats(),
+    }
     return jsonify(response), 200
 
 
-# FIXME: what to do if requested peer offline (when asking for it's chain)?
+@app.route("/gossip", methods=["POST"])
+def receive_gossip():
+    """
+    Blocks and transactions pushed by a peer
+
+    request:
+    {
+        "blocks": [<block>, ...],
+        "transactions": [<transaction>, ...]
+    }
+    """
+    values = request.get_json(silent=True)
+    if not isinstance(values, dict):
+        return jsonify({"message": "Expected a JSON object"}), 400
+    try:
+        accepted = gossip.receive(values)
+    except ValueError as error:
+        return jsonify({"message": str(error)}), 400
+    return jsonify({"accepted": accepted}), 200
+
+
 @app.route("/peers/register", methods=["POST"])
 def register_peer():
     values = request.get_json()
@@ -110,20 +403,24 @@ def send():
     request:
     {
         "recipient_pubkey": "0x324...",
-        "amount": 20
+        "amount": 20,
+        "fee": 1 (optional, defaults to 0)
     }
     """
     values = request.get_json()
-    recipient_pubkey = VerifyingKey.from_string(
-        bytearray.fromhex(values["recipient_pubkey"]), curve=SECP256k1
-    )
+    recipient_pubkey = intern_address(values["recipient_pubkey"])
     amount = values["amount"]
-    # TODO: broadcast tx to other mempools of other miners (Instead of just ours)
-    if wallet.send(recipient_pubkey, amount) is True:
+    fee = values.get("fee", 0)
+    if not isinstance(amount, int) or amount <= 0:
+        return jsonify({"message": "Amount must be a positive whole number of BLU"}), 400
+    if not isinstance(fee, int) or fee < 0:
+        return jsonify({"message": "Fee must be a whole number of BLU"}), 400
+    # Accepted transactions are pushed to our peers through gossip
+    if wallet.send(recipient_pubkey, amount, fee) is True:
         response = {"message": f"Sent {amount} BLU to {values['recipient_pubkey']}"}
     else:
         response = {
-            "message": f"{compress(wallet.pubkey)} attempted to send {amount} but only had {wallet.verified_balance()} verified"
+            "message": f"{compress(wallet.pubkey)} attempted to send {amount} (plus a {fee} fee) but only had {wallet.verified_balance()} verified"
         }
     return jsonify(response), 201
 
@@ -165,12 +462,22 @@ def verified_balance():
 @app.route("/mempool", methods=["GET"])
 def mempool():
     """
-    Get the pending_transactions (mempool) for the local blockchain
+    Get the pending_transactions (mempool) for the local blockchain, a page at a time
+
+    ?offset=<n>&limit=<n> (limit defaults to 100, at most 1000)
     """
-    pending_transactions = [
-        tx.json_serialize() for tx in blockchain.pending_transactions
-    ]
-    response = {"pending_transactions": pending_transactions}
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    limit = min(max(request.args.get("limit", 100, type=int), 0), 1000)
+    with blockchain.lock.read():
+        pending_transactions = [
+            tx.json_serialize() for tx in blockchain.mempool.page(offset, limit)
+        ]
+        response = {
+            "pending_transactions": pending_transactions,
+            "offset": offset,
+            "limit": limit,
+            "total": len(blockchain.mempool),
+        }
     return jsonify(response), 200
 
 
@@ -179,5 +486,6 @@ def mempool():
 # @app.route("/wallet/unverified_balance")
 
 if __name__ == "__main__":
+    start_node()
     port = get_port()
     app.run(host="0.0.0.0", port=port)
@@ -1,4 +1,7 @@
+import json
 import sys
+import zlib
+from hashlib import sha256
 
 def get_port():
     """
@@ -15,7 +18,91 @@ def compress(pubkey):
     Convert pubkey to hex string in compressed format
     Read more: https://github.com/tlsfuzzer/python-ecdsa
     """
+    # Interned keys (see key_cache.py) already know their compressed form
+    address = getattr(pubkey, "address", None)
+    if address is not None:
+        return address
     return pubkey.to_string("compressed").hex()
 
 
+def parse_address(address):
+    """
+    Check that an address given by a client looks like a compressed pubkey in hex,
+    without decoding it into a curve point (any value of the right form can be
+    looked up, it just won't have transactions if it isn't a real key)
+
+    :returns: <str> the address in lowercase, the way addresses are indexed
+    :raises ValueError: if it isn't 33 bytes of hex starting with 02 or 03
+    """
+    if len(address) != 66 or address[:2] not in ("02", "03"):
+        raise ValueError("Address must be a compressed pubkey: 66 hex digits")
+    try:
+        bytes.fromhex(address)
+    except ValueError:
+        raise ValueError("Address must be a compressed pubkey: 66 hex digits")
+    return address.lower()
+
+
+def buffered(parts, size=65536):
+    """
+    Join small pieces of a streamed response into chunks of about `size` bytes
 
+    :param parts: <iterator> str or bytes pieces of the response
+    """
+    chunk = []
+    length = 0
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        chunk.append(part)
+        length += len(part)
+        if length >= size:
+            yield b"".join(chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield b"".join(chunk)
+
+
+def gzipped(chunks, level=6):
+    """
+    gzip a streamed response as it's generated
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def chain_etag(tip_hash, fields=None):
+    """
+    The ETag of a /chain response: the hash of the chain's tip, plus a digest of
+    the response's other fields (e.g. the mempool and peers) if it has any. It
+    changes whenever any of them does, and means the same thing across restarts
+
+    :param tip_hash: <str> hash of the tip, or None if the chain is empty
+    :param fields: <dict> the other fields of the response, JSON serializable
+    """
+    etag = tip_hash or "empty"
+    if fields:
+        digest = sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+        etag += f".{digest[:32]}"
+    return etag
+
+
+def json_chain_parts(blocks, fields):
+    """
+    Serialize {"chain": [<blocks>], <fields>} a block at a time
+
+    :param blocks: <iterator> the blocks
+    :param fields: <dict> the other fields of the document
+    """
+    yield '{"chain": ['
+    for i, block in enumerate(blocks):
+        yield ("," if i else "") + json.dumps(block.json_serialize())
+    yield "]"
+    for name, value in fields.items():
+        yield f", {json.dumps(name)}: {json.dumps(value)}"
+    yield "}"
@@ -0,0 +1,117 @@
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from ecdsa import BadSignatureError
+from ecdsa.errors import MalformedPointError
+
+from key_cache import intern_address
+
+
+class SignatureVerifier:
+    def __init__(self, workers=None, cache_size=100000, min_batch=64) -> None:
+        """
+        Verifies transaction signatures in batches, across a process pool.
+
+        Every (tx id, signature) pair that passes is remembered, so a transaction
+        verified when it entered the mempool isn't verified again when the block
+        containing it arrives.
+
+        :param workers: <int> number of verification processes (defaults to the CPU count)
+        :param cache_size: <int> how many verified pairs to remember
+        :param min_batch: <int> batches smaller than this are verified in-process,
+                          since shipping them to the pool costs more than it saves
+        """
+        self.workers = workers
+        self.cache_size = cache_size
+        self.min_batch = min_batch
+        # (tx id, signature) -> None, least recently used first
+        self.verified = OrderedDict()
+        # Chains are validated with the blockchain only locked for reading, so
+        # several threads can use the cache at once
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def verify_transaction(self, tx):
+        return self.verify_transactions([tx])
+
+    def verify_block(self, block):
+        return self.verify_transactions(block.transactions["regular"])
+
+    def verify_chain(self, chain):
+        return self.verify_transactions(
+            [tx for block in chain for tx in block.transactions["regular"]]
+        )
+
+    def verify_transactions(self, txs):
+        """
+        Check the signatures of a batch of (non-coinbase) transactions
+
+        :returns: <bool> True if every signature is valid
+        """
+        unverified = {}
+        for tx in txs:
+            if not isinstance(tx.signature, bytes):
+                return False
+            unverified[(tx.id(), tx.signature)] = tx
+        with self.lock:
+            for key in list(unverified):
+                if key in self.verified:
+                    self.verified.move_to_end(key)
+                    del unverified[key]
+        if not unverified:
+            return True
+
+        jobs = [
+            (tx.sender_address, tx.signature, tx.signing_message())
+            for tx in unverified.values()
+        ]
+        if len(jobs) < self.min_batch:
+            results = map(verify_signature, jobs)
+        else:
+            chunksize = max(len(jobs) // (4 * (self.workers or 4)), 1)
+            results = self._pool().map(verify_signature, jobs, chunksize=chunksize)
+        if not all(results):
+            return False
+
+        with self.lock:
+            for key in unverified:
+                self.verified[key] = None
+            while len(self.verified) > self.cache_size:
+                self.verified.popitem(last=False)
+        return True
+
+    def _pool(self):
+        with self.lock:
+            if self.executor is None:
+                # The pool is started from a request thread, with the blockchain
+                # lock held. A forked worker could inherit a lock (e.g. the key
+                # cache's) that another thread held at the time and never be able to
+                # take it, so the workers are spawned afresh instead
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self.executor
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def verify_signature(job):
+    """
+    Worker entry point: verify one signature
+
+    :param job: <tuple> (sender address, signature bytes, signed message bytes)
+    :returns: <bool> whether the signature is valid
+    """
+    address, signature, message = job
+    try:
+        # Each process interns keys in its own cache, so a sender's key is only
+        # decoded once per process
+        return intern_address(address).verify(signature, message)
+    except (BadSignatureError, MalformedPointError, ValueError):
+        return False
@@ -1,24 +1,116 @@
-from ecdsa import SECP256k1, VerifyingKey
+from hashlib import sha256
+from array import array
 import json
-from server_helper import compress
+from key_cache import intern_address
+from encoding import (
+    PUBKEY_LENGTH,
+    AMOUNT,
+    encode_amount,
+    encode_signature,
+    decode_signature,
+)
 
 
 class Transaction:
+    # Transactions are held by the hundreds of thousands, so they're kept compact:
+    # pubkeys are stored as their 33 byte compressed encoding and only turned into
+    # VerifyingKeys when one is actually needed (e.g. to check a signature)
+    __slots__ = ("_sender", "_recipient", "amount", "fee", "signature")
+
     def __init__(
         self,
         sender,
         recipient,
         amount,
         signature="",
+        fee=0,
     ) -> None:
+        """
+        :param sender: <object> VerifyingKey of the sender, or its compressed
+                       encoding (bytes or hex string)
+        :param recipient: <object> VerifyingKey of the recipient, or its compressed
+                          encoding (bytes or hex string)
+        :param amount: <int> whole number of BLU
+        :param fee: <int> whole number of BLU paid to the miner on top of the amount
+        """
         self.sender = sender
         self.recipient = recipient
-        self.amount = amount
+        self.amount = to_amount(amount)
+        self.fee = to_amount(fee)
         self.signature = signature
 
+    @property
+    def sender(self):
+        return intern_address(self._sender.hex())
+
+    @sender.setter
+    def sender(self, pubkey):
+        self._sender = compressed_pubkey(pubkey)
+
+    @property
+    def recipient(self):
+        return intern_address(self._recipient.hex())
+
+    @recipient.setter
+    def recipient(self, pubkey):
+        self._recipient = compressed_pubkey(pubkey)
+
+    @property
+    def sender_pubkey(self):
+        """
+        The sender's raw compressed pubkey
+        """
+        return self._sender
+
+    @property
+    def recipient_pubkey(self):
+        return self._recipient
+
+    @property
+    def sender_address(self):
+        """
+        The sender's compressed pubkey (hex), without decoding the key
+        """
+        return self._sender.hex()
+
+    @property
+    def recipient_address(self):
+        return self._recipient.hex()
+
     def __str__(self) -> str:
         return json.dumps(self.json_serialize())
 
+    def id(self):
+        """
+        The transaction id: the hash of the binary transaction, signature included
+        """
+        return sha256(self.binary_serialize()).hexdigest()
+
+    def valid_amounts(self):
+        """
+        Regular transactions must move a positive amount and can't pay a negative
+        fee (which would take BLU from the miner)
+        """
+        return self.amount > 0 and self.fee >= 0
+
+    def signing_message(self):
+        """
+        The bytes the sender signs: the binary transaction minus its signature
+        """
+        return (
+            self._sender
+            + self._recipient
+            + encode_amount(self.amount)
+            + encode_amount(self.fee)
+        )
+
+    def binary_serialize(self):
+        """
+        Fixed-width fields (raw 33 byte compressed pubkeys, 64 bit amount and fee),
+        then the length-prefixed signature
+        """
+        return self.signing_message() + encode_signature(self.signature)
+
     def json_serialize(self):
         # A coinbase transaction will have a signature of type "str"
         # A regular transaction will have a signature of type "bytes"?
@@ -28,24 +120,107 @@ class Transaction:
             else self.signature.hex()
         )
         return {
-            "sender": compress(self.sender),
-            "recipient": compress(self.recipient),
+            "sender": self.sender_address,
+            "recipient": self.recipient_address,
             "amount": self.amount,
+            "fee": self.fee,
             "signature": signature,
         }
 
     @staticmethod
-    def json_deserialize(json_transaction):
-        # TODO: what to do about transaction signatures that are not coinbase? Do we need
-        # to do from_string for sigs too?
+    def json_deserialize(json_transaction, coinbase=False):
+        """
+        :param coinbase: <bool> whether this is a coinbase transaction, whose
+                         "signature" is a plain message rather than a hex signature
+        """
+        # The pubkeys stay hex until they're needed, decoding them is expensive
         sender, recipient, amount, signature = (
-            VerifyingKey.from_string(
-                bytearray.fromhex(json_transaction["sender"]), curve=SECP256k1
-            ),
-            VerifyingKey.from_string(
-                bytearray.fromhex(json_transaction["recipient"]), curve=SECP256k1
-            ),
+            json_transaction["sender"],
+            json_transaction["recipient"],
             json_transaction["amount"],
             json_transaction["signature"],
         )
-        return Transaction(sender, recipient, amount, signature)
+        if not all(isinstance(field, str) for field in (sender, recipient, signature)):
+            raise ValueError("Sender, recipient and signature must be strings")
+        if not coinbase:
+            try:
+                signature = bytes.fromhex(signature)
+            except ValueError:
+                # Leave malformed signatures as they are, they'll fail verification
+                pass
+        # Transactions from before fees were introduced don't have one
+        fee = json_transaction.get("fee", 0)
+        return checked(Transaction(sender, recipient, amount, signature, fee), coinbase)
+
+    @staticmethod
+    def binary_deserialize(reader, coinbase=False):
+        """
+        Read a transaction written by binary_serialize()
+
+        :param reader: <object> a Reader positioned at the start of the transaction
+        :param coinbase: <bool> whether this is a coinbase transaction
+        """
+        sender = reader.read(PUBKEY_LENGTH)
+        recipient = reader.read(PUBKEY_LENGTH)
+        amount = reader.unpack(AMOUNT)
+        fee = reader.unpack(AMOUNT)
+        signature = decode_signature(reader)
+        return checked(Transaction(sender, recipient, amount, signature, fee), coinbase)
+
+
+class TransactionTable:
+    __slots__ = ("senders", "recipients", "amounts", "fees")
+
+    def __init__(self, transactions) -> None:
+        """
+        Column-oriented copy of a block's regular transactions, for bulk scans
+        (e.g. applying a block to the balance index) that only need these fields
+
+        :param transactions: <list> the transactions, in block order
+        """
+        self.senders = [tx.sender_pubkey for tx in transactions]
+        self.recipients = [tx.recipient_pubkey for tx in transactions]
+        self.amounts = array("q", [tx.amount for tx in transactions])
+        self.fees = array("q", [tx.fee for tx in transactions])
+
+    def __len__(self):
+        return len(self.amounts)
+
+
+def checked(tx, coinbase):
+    """
+    :returns: <object> the deserialized transaction
+    :raises ValueError: if it's a regular transaction with invalid amounts
+    """
+    if not coinbase and not tx.valid_amounts():
+        raise ValueError(f"Invalid amount {tx.amount} or fee {tx.fee}")
+    return tx
+
+
+def compressed_pubkey(pubkey):
+    """
+    The 33 byte compressed encoding of a pubkey given as a VerifyingKey, hex string
+    or bytes
+    """
+    if isinstance(pubkey, str):
+        pubkey = bytes.fromhex(pubkey)
+    elif not isinstance(pubkey, bytes):
+        # Interned keys already carry their compressed encoding
+        pubkey = getattr(pubkey, "compressed", None) or pubkey.to_string("compressed")
+    if len(pubkey) != PUBKEY_LENGTH:
+        raise ValueError(f"Invalid compressed pubkey {pubkey.hex()}")
+    return pubkey
+
+
+def to_amount(amount):
+    """
+    Amounts are whole numbers of BLU. Integral floats (e.g. 25.0 from JSON) are accepted
+    """
+    if isinstance(amount, float) and amount.is_integer():
+        amount = int(amount)
+    if isinstance(amount, bool) or not isinstance(amount, int):
+        raise ValueError(f"Amounts must be whole numbers of BLU, got {amount}")
+    # They're encoded as signed 64 bit integers
+    if not -(1 << 63) <= amount < 1 << 63:
+        raise ValueError(f"Amount {amount} is out of range")
+    return amount
@@ -0,0 +1,178 @@
+import sqlite3
+from threading import Lock
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blocks (
+    height INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS txs (
+    id TEXT NOT NULL,
+    height INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (id, height, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS txs_by_height ON txs (height);
+CREATE TABLE IF NOT EXISTS address_txs (
+    address TEXT NOT NULL,
+    height INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    id TEXT NOT NULL,
+    PRIMARY KEY (address, height, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS address_txs_by_height ON address_txs (height);
+"""
+
+
+class TxIndex:
+    def __init__(self, path=":memory:") -> None:
+        """
+        Secondary index of the transactions in the chain, in SQLite:
+            - tx id -> (block height, position in the block)
+            - compressed pubkey (hex) -> ids of the transactions it sent or received
+
+        A transaction's position is its index among the block's coinbase and regular
+        transactions, which is also its leaf in the block's Merkle tree. The index is
+        kept up to date a block at a time, like the balance index, and records the
+        hash of every block it has indexed so it can catch up with the chain when
+        reopened (see sync()).
+
+        :param path: <str> the database file, or ":memory:" to keep it in memory
+        """
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        # The connection is shared by the server's threads
+        self.lock = Lock()
+
+    def __len__(self):
+        with self.lock:
+            (count,) = self.db.execute("SELECT COUNT(*) FROM blocks").fetchone()
+        return count
+
+    def apply_block(self, height, block):
+        """
+        Index the transactions of a block added to the chain at `height`
+        """
+        with self.lock, self.db:
+            self._insert(height, block)
+
+    def revert_block(self, height):
+        """
+        Drop the block at `height` (and any above it) from the index
+        """
+        with self.lock, self.db:
+            self._delete_from(height)
+
+    def sync(self, blockchain):
+        """
+        Bring the index in line with the chain, e.g. after reopening it: blocks
+        indexed past the point where it diverges from the chain are dropped, and the
+        chain's blocks from there on are indexed
+
+        :returns: <int> number of blocks indexed
+        """
+        # Each block commits to its parent's hash, so once the index and the chain
+        # agree on a block they agree on everything before it. Binary search for
+        # the last block they agree on
+        with self.lock:
+            (indexed,) = self.db.execute(
+                "SELECT COALESCE(MAX(height) + 1, 0) FROM blocks"
+            ).fetchone()
+            low, high = 0, min(indexed, len(blockchain.chain))
+            while low < high:
+                middle = (low + high + 1) // 2
+                row = self.db.execute(
+                    "SELECT hash FROM blocks WHERE height = ?", (middle - 1,)
+                ).fetchone()
+                if row is not None and row[0] == blockchain.block_hash(middle - 1):
+                    low = middle
+                else:
+                    high = middle - 1
+        start = low
+        with self.lock, self.db:
+            self._delete_from(start)
+            for height in range(start, len(blockchain.chain)):
+                self._insert(height, blockchain.chain[height])
+        return len(blockchain.chain) - start
+
+    def find(self, tx_id):
+        """
+        :returns: <tuple> (height, position) of the transaction, or None if it isn't
+                  in the chain
+        """
+        # Transactions aren't unique (e.g. coinbases paying the same reward to the
+        # same miner have the same id), so go with the most recent
+        with self.lock:
+            return self.db.execute(
+                "SELECT height, position FROM txs WHERE id = ? "
+                "ORDER BY height DESC, position DESC LIMIT 1",
+                (tx_id,),
+            ).fetchone()
+
+    def address_txs(self, address, cursor=None, limit=100):
+        """
+        Transactions sent or received by an address, newest first
+
+        :param address: <str> compressed pubkey (hex)
+        :param cursor: <str> the cursor returned with the previous page, if any
+        :param limit: <int> maximum number of transactions to return
+        :returns: <tuple> (list of (tx id, height, position), cursor of the next page
+                  or None if this was the last one)
+        """
+        if cursor is None:
+            query = (
+                "SELECT id, height, position FROM address_txs WHERE address = ? "
+                "ORDER BY height DESC, position DESC LIMIT ?"
+            )
+            params = (address, limit + 1)
+        else:
+            height, position = parse_cursor(cursor)
+            query = (
+                "SELECT id, height, position FROM address_txs WHERE address = ? "
+                "AND (height, position) < (?, ?) "
+                "ORDER BY height DESC, position DESC LIMIT ?"
+            )
+            params = (address, height, position, limit + 1)
+        with self.lock:
+            rows = self.db.execute(query, params).fetchall()
+        if len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        _, height, position = rows[-1]
+        return rows, f"{height}-{position}"
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def _insert(self, height, block):
+        self.db.execute(
+            "INSERT OR REPLACE INTO blocks VALUES (?, ?)", (height, block.hash())
+        )
+        for position, tx in enumerate(block.all_transactions()):
+            tx_id = tx.id()
+            self.db.execute(
+                "INSERT OR REPLACE INTO txs VALUES (?, ?, ?)", (tx_id, height, position)
+            )
+            # A self-send is indexed once
+            addresses = {tx.sender_address, tx.recipient_address}
+            self.db.executemany(
+                "INSERT OR REPLACE INTO address_txs VALUES (?, ?, ?, ?)",
+                [(address, height, position, tx_id) for address in addresses],
+            )
+
+    def _delete_from(self, height):
+        for table in ("blocks", "txs", "address_txs"):
+            self.db.execute(f"DELETE FROM {table} WHERE height >= ?", (height,))
+
+
+def parse_cursor(cursor):
+    """
+    :returns: <tuple> the (height, position) encoded in a cursor
+    """
+    try:
+        height, position = cursor.split("-")
+        return int(height), int(position)
+    except ValueError:
+        raise ValueError(f"Invalid cursor {cursor}")
@@ -9,6 +9,7 @@ sys.path.append(module_dir)
 
 from transaction import Transaction
 from server_helper import compress
+from key_cache import intern_key
 
 
 class Wallet:
@@ -17,74 +18,58 @@ class Wallet:
     ) -> None:
         self.blockchain = blockchain
         self.privkey = privkey if privkey else SigningKey.generate(curve=SECP256k1)
-        self.pubkey = self.privkey.verifying_key
+        self.pubkey = intern_key(self.privkey.verifying_key)
         self.nickname = nickname
         self.peer_nicknames = peer_nicknames
 
-    def send(self, recipient, amount):
+    def send(self, recipient, amount, fee=0):
         verified_balance = self.verified_balance()
-        if verified_balance < amount:
+        if verified_balance < amount + fee:
             print(
-                f"Transaction failed, {self.nickname} attempted to send {amount} BLU but only had {verified_balance}"
+                f"Transaction failed, {self.nickname} attempted to send {amount} BLU (plus a {fee} BLU fee) but only had {verified_balance}"
             )
             return False
 
-        tx = Transaction(self.pubkey, recipient, amount)
+        tx = Transaction(self.pubkey, recipient, amount, fee=fee)
         tx.signature = self.sign(tx)
-        self.blockchain.pending_transactions.append(tx)
-        return True
+        return self.blockchain.add_transaction(tx)
 
     def sign(self, transaction):
         # In this case, the "message" is the bytes of our transaction (minus the empty sig)
-        tx_encoded = str(
-            {
-                "sender": transaction.sender,
-                "recipient": transaction.recipient,
-                "amount": transaction.amount,
-            }
-        ).encode()
-        return self.privkey.sign(tx_encoded)
+        return self.privkey.sign(transaction.signing_message())
 
     def verify(self, signature, transaction):
         # Since "signature" was empty during tx signing, we don't include it for verifying
-        tx_encoded = str(
-            {
-                "sender": transaction.sender,
-                "recipient": transaction.recipient,
-                "amount": transaction.amount,
-            }
-        ).encode()
-        return self.pubkey.verify(signature, tx_encoded)
+        return self.pubkey.verify(signature, transaction.signing_message())
 
     def unverified_balance(self):
-        # Unverified balance are the unverified transactions in pending_transactions
-        unverified_balance = 0
-        for tx in self.blockchain.pending_transactions:
-            if tx.recipient == self.pubkey:
-                unverified_balance += tx.amount
-            elif tx.sender == self.pubkey:
-                unverified_balance -= tx.amount
-        return unverified_balance
+        # Unverified balance is the net of the transactions still waiting in the mempool
+        return self.blockchain.mempool.pending_balance(compress(self.pubkey))
 
     def verified_balance(self):
         # These are transactions that have been included in the blockchain
-        verified_balance = 0
-        for block in self.blockchain.chain:
-            coinbase_tx = block.transactions["coinbase"]
-            if coinbase_tx.recipient == self.pubkey:
-                verified_balance += coinbase_tx.amount
-            for tx in block.transactions["regular"]:
-                if tx.recipient == self.pubkey:
-                    verified_balance += tx.amount
-                elif tx.sender == self.pubkey:
-                    verified_balance -= tx.amount
-        return verified_balance
+        return self.blockchain.get_balance(self.pubkey)
 
     def balance(self):
         # loop thru blockchain and add up tx's sent to account
         # (assuming no coinbase tx's)
         return self.verified_balance() + self.unverified_balance()
 
+    def get_confirmed_txns(self):
+        """
+        Get Txns for user's wallet that have been confirmed and are on the blockchain,
+        newest first. They're looked up in the transaction index a page at a time
+        """
+        txns = []
+        cursor = None
+        while True:
+            page, cursor = self.blockchain.address_transactions(
+                compress(self.pubkey), cursor
+            )
+            txns.extend(tx for tx, _ in page)
+            if cursor is None:
+                return txns
+
     # # TODO: Get txns and associate them with nicknames for ease of use!
     # def set_nickname(self, nickname):
     #     self.nickname = nickname
@@ -94,32 +79,18 @@ class Wallet:
     #     peer_pubkey = self.compress(verifying_key)
     #     self.peer_nicknames[peer_pubkey] = peer_nickname
 
-    # def get_mempool_txns(self):
-    #     """
-    #     Show all transactions between for user's wallet in the mempool waiting to be confirmed
-    #     """
-    #     txns = []
-    #     for tx in self.blockchain.pending_transactions:
-    #         if tx.recipient == self.pubkey or tx.sender == self.pubkey:
-    #             txns.append(tx)
-    #     return txns
-
-    # def get_confirmed_txns(self):
-    #     """
-    #     Get Txns for user's wallet that have been confirmed and are on the blockchain
-    #     """
-    #     txns = []
-    #     for block in self.blockchain.chain:
-    #         for tx in block.transactions:
-    #             if tx.recipient == self.pubkey or tx.sender == self.pubkey:
-    #                 txns.append(tx)
-    #     return txns
-
-    # def get_all_txns(self):
-    #     """
-    #     Get all sent and received Txns for the current wallet
-    #     """
-    #     return self.get_mempool_txns() + self.get_confirmed_txns()
+    def get_mempool_txns(self):
+        """
+        Get Txns for user's wallet in the mempool waiting to be confirmed. They're
+        looked up in the mempool's sender and recipient indexes
+        """
+        return self.blockchain.pending_address_transactions(self.pubkey)
+
+    def get_all_txns(self):
+        """
+        Get all sent and received Txns for the current wallet
+        """
+        return self.get_mempool_txns() + self.get_confirmed_txns()
 
     # def show_txns(self, txns):
     #     """Display txns, mapping peer_nicknames when and user nickname where applicable
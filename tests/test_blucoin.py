@@ -1,4 +1,10 @@
 import unittest
+import tempfile
+from unittest import mock
+import threading
+import time
+import gzip
+import json
 import sys, os
 
 
@@ -11,6 +17,37 @@ from blockchain import Blockchain
 from wallet import Wallet
 from node import Node
 from block import Block
+from miner import Miner, ParallelMiner, partition
+from mempool import Mempool
+from transaction import Transaction
+from signature_verifier import SignatureVerifier
+from chain_validator import ChainValidator
+from block_store import BlockLog
+from lazy_chain import LazyChain, ChainChanged
+from encoding import BINARY_CONTENT_TYPE, encode_chain, decode_chain, encode_chain_parts
+from key_cache import KeyCache
+from tx_index import TxIndex
+from mining_service import MiningService
+from gossip import Gossip, PeerQueue
+from rwlock import RWLock
+from server_helper import (
+    compress,
+    parse_address,
+    chain_etag,
+    buffered,
+    gzipped,
+    json_chain_parts,
+)
+from merkle import merkle_root, merkle_proof, verify_proof
+from json_stream import iter_json_array, ResponseTooLarge
+from checkpoint import Checkpointer, read_checkpoint, write_checkpoint
+from difficulty import (
+    MAX_ADJUSTMENT,
+    block_work,
+    chain_work,
+    next_target,
+    target_from_difficulty,
+)
 
 class TestBlockchain(unittest.TestCase):
     def test_mining_creates_coinbase_tx(self):
@@ -144,9 +181,50 @@ class TestBlockchain(unittest.TestCase):
 
         node.mine()
 
-        blockchain.add_block(Block(previous_hash="random bad hash"), node)
+        block = Block(previous_hash="random bad hash")
+        node.proof_of_work(block)
 
-        self.assertEqual(blockchain.valid_chain(blockchain.chain), False)
+        self.assertFalse(blockchain.add_block(block, node))
+        self.assertEqual(len(blockchain.chain), 1)
+        self.assertEqual(blockchain.valid_chain(blockchain.chain + [block]), False)
+
+    def test_concurrent_mining_adds_one_block_per_tip(self):
+        blockchain = Blockchain()
+        node = Node(blockchain)
+        wallet = Wallet(blockchain)
+        node.add_account(wallet)
+        node.set_blockreward_pubkey(wallet.pubkey)
+        node.mine()
+        tip_hash = blockchain.get_latest_block().hash()
+        # Four blocks found on the same tip, e.g. by concurrent /mine requests
+        blocks = []
+        for i in range(4):
+            coinbase_tx = Transaction(
+                wallet.pubkey, wallet.pubkey, 50, signature=str(i)
+            )
+            block = Block(
+                tip_hash, transactions={"coinbase": coinbase_tx, "regular": []}
+            )
+            node.proof_of_work(block)
+            blocks.append(block)
+        barrier = threading.Barrier(len(blocks))
+        results = []
+
+        def add(block):
+            barrier.wait()
+            results.append(blockchain.add_block(block, node))
+
+        threads = [threading.Thread(target=add, args=(block,)) for block in blocks]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(results), [False, False, False, True])
+        self.assertFalse(blockchain.add_block(blockchain.chain[1], node))
+        self.assertEqual(len(blockchain.chain), 2)
+        self.assertTrue(blockchain.valid_chain(blockchain.chain))
+        self.assertEqual(wallet.verified_balance(), 100)
 
     def test_hash_after_json_deserialize(self):
         # The deserialized chain must be identical to original
@@ -165,11 +243,1902 @@ class TestBlockchain(unittest.TestCase):
             Blockchain.json_deserialize(serialized_chain).chain[0].hash(),
         )
 
+    def test_pubkeys_decoded_on_demand(self):
+        blockchain = Blockchain()
+        node = Node(blockchain)
+        wallet = Wallet(blockchain)
+        node.add_account(wallet)
+        node.set_blockreward_pubkey(wallet.pubkey)
+        node.mine()
+
+        json_tx = blockchain.chain[0].transactions["coinbase"].json_serialize()
+        tx = Transaction.json_deserialize(json_tx, coinbase=True)
+
+        self.assertIsInstance(tx._sender, bytes)
+        self.assertEqual(tx.json_serialize(), json_tx)
+        self.assertEqual(tx.sender, wallet.pubkey)
+
+    def test_compact_representation(self):
+        blockchain = Blockchain()
+        node = Node(blockchain)
+        wallet1 = Wallet(blockchain)
+        wallet2 = Wallet(blockchain)
+        node.add_account(wallet1)
+        node.set_blockreward_pubkey(wallet1.pubkey)
+        node.mine()
+        wallet1.send(wallet2.pubkey, 20)
+        node.mine()
+
+        block = blockchain.chain[1]
+        tx = block.transactions["regular"][0]
+        self.assertFalse(hasattr(tx, "__dict__"))
+        self.assertFalse(hasattr(block, "__dict__"))
+        self.assertEqual(len(tx.sender_pubkey), 33)
+
+        table = block.table()
+        self.assertIs(table, block.table())
+        self.assertEqual(len(table), 1)
+        self.assertEqual(list(table.amounts), [20])
+        self.assertEqual(table.senders, [tx.sender_pubkey])
+        self.assertEqual(table.recipients, [tx.recipient_pubkey])
+        self.assertEqual(blockchain.get_balance(wallet2.pubkey), 20)
+        self.assertEqual(blockchain.get_balance(wallet1.pubkey), 80)
+
+        with self.assertRaises(ValueError):
+            Transaction(wallet1.pubkey, wallet2.pubkey, 1.5)
+        with self.assertRaises(ValueError):
+            Transaction(b"\x02" * 10, wallet2.pubkey, 1)
+
+    def test_binary_serialization_round_trip(self):
+        blockchain = Blockchain()
+        node = Node(blockchain)
+        wallet = Wallet(blockchain)
+        laura_wallet = Wallet(blockchain)
+        node.add_account(wallet)
+        node.set_blockreward_pubkey(wallet.pubkey)
+        node.mine()
+        wallet.send(laura_wallet.pubkey, 25)
+        node.mine()
+
+        for block in blockchain.chain:
+            binary_block = block.binary_serialize()
+            decoded = Block.binary_deserialize(binary_block)
+            self.assertEqual(decoded.hash(), block.hash())
+            self.assertEqual(decoded.json_serialize(), block.json_serialize())
+            self.assertLess(len(binary_block), len(str(block)) / 2)
+
+        encoded_blocks = blockchain.binary_blocks(0, 2)
+        self.assertEqual(decode_chain(encode_chain(encoded_blocks)), encoded_blocks)
+
+    def test_hash_is_canonical(self):
+        blockchain = Blockchain()
+        node = Node(blockchain)
+        wallet = Wallet(blockchain)
+        node.add_account(wallet)
+        node.set_blockreward_pubkey(wallet.pubkey)
+        block = node.mine()
+
+        # Key order of the JSON doesn't change the block
+        json_block = block.json_serialize()
+        reordered = dict(reversed(list(json_block.items())))
+
+        self.assertEqual(Block.json_deserialize(reordered).hash(), block.hash())
+
+    def test_malformed_fields_rejected(self):
+        blockchain = Blockchain()
+        node = Node(blockchain)
+        wallet = Wallet(blockchain)
+        node.add_account(wallet)
+        node.set_blockreward_pubkey(wallet.pubkey)
+        block = node.mine()
+        corruptions = [
+            ("previous_hash", 5),
+            ("timestamp", "abc"),
+            ("timestamp", True),
+            ("timestamp", 10**400),
+            ("proof", "x"),
+            ("proof", -1),
+            ("proof", 1 << 64),
+            ("target", 5),
+        ]
+        for field, value in corruptions:
+            json_block = block.json_serialize()
+            json_block[field] = value
+            with self.assertRaises(ValueError, msg=field):
+                Block.json_deserialize(json_block)
+        for field, value in [("sender", 5), ("amount", 2**70), ("signature", None)]:
+            json_tx = block.transactions["coinbase"].json_serialize()
+            json_tx[field] = value
+            with self.assertRaises(ValueError, msg=field):
+                Transaction.json_deserialize(json_tx, coinbase=True)
+        with self.assertRaises(ValueError):
+            Transaction(wallet.pubkey, wallet.pubkey, 50, signature="x" * 70000).id()
+
     def test_register_peers(self):
         blockchain = Blockchain()
         blockchain.register_peers(["localhost:5009"])
 
         self.assertEqual(blockchain.peers, set(["localhost:5009"]))
 
+    def test_unreachable_peer_recorded_in_health_table(self):
+        blockchain = Blockchain()
+        # Nothing listens on port 1, so the connection is refused
+        blockchain.register_peers(["localhost:1"])
+
+        self.assertFalse(blockchain.consensus())
+
+        health = blockchain.peer_client.health_report(blockchain.peers)
+        self.assertEqual(health["localhost:1"]["status"], "unreachable")
+        self.assertEqual(health["localhost:1"]["failures"], 1)
+
+
+    def test_sealed_block_is_immutable(self):
+        blockchain = Blockchain()
+        node = Node(blockchain)
+        wallet = Wallet(blockchain)
+        node.add_account(wallet)
+        node.set_blockreward_pubkey(wallet.pubkey)
+
+        block = node.mine()
+        block_hash = block.hash()
+
+        with self.assertRaises(AttributeError):
+            block.nonce = 0
+        self.assertEqual(block.hash(), block_hash)
+
+    def test_get_block_by_hash(self):
+        blockchain = Blockchain()
+        node = Node(blockchain)
+        wallet = Wallet(blockchain)
+        node.add_account(wallet)
+        node.set_blockreward_pubkey(wallet.pubkey)
+
+        genesis = node.mine()
+        block = node.mine()
+
+        self.assertIs(blockchain.get_block(genesis.hash()), genesis)
+        self.assertIs(blockchain.get_block(block.hash()), block)
+        self.assertIs(blockchain.get_block_by_height(1), block)
+        self.assertIsNone(blockchain.get_block("random bad hash"))
+
+        deserialized = Blockchain.json_deserialize(blockchain.json_serialize())
+        self.assertEqual(deserialized.get_block(block.hash()).nonce, block.nonce)
+
+    def test_balances_roll_back_when_chain_replaced(self):
+        blockchain = Blockchain()
+        node = Node(blockchain)
+        wallet = Wallet(blockchain)
+        node.add_account(wallet)
+        node.set_blockreward_pubkey(wallet.pubkey)
+        node.mine()
+
+        # A peer forks off after our genesis block
+        peer_blockchain = Blockchain.json_deserialize(blockchain.json_serialize())
+        peer_node = Node(peer_blockchain)
+        peer_wallet = Wallet(peer_blockchain)
+        peer_node.add_account(peer_wallet)
+        peer_node.set_blockreward_pubkey(peer_wallet.pubkey)
+        peer_node.mine()
+        peer_node.mine()
+
+        node.mine()
+        self.assertEqual(wallet.verified_balance(), 100)
+
+        blockchain.set_chain(peer_blockchain.chain)
+
+        self.assertEqual(wallet.verified_balance(), 50)
+        self.assertEqual(blockchain.get_balance(peer_wallet.pubkey), 100)
+        peer_tip = peer_blockchain.chain[-1]
+        self.assertIs(blockchain.get_block(peer_tip.hash()), peer_tip)
+
+
+class TestMempool(unittest.TestCase):
+    def setUp(self):
+        self.blockchain = Blockchain()
+        self.node = Node(self.blockchain)
+        self.wallet = Wallet(self.blockchain)
+        self.laura_wallet = Wallet(self.blockchain)
+        self.node.add_account(self.wallet)
+        self.node.set_blockreward_pubkey(self.wallet.pubkey)
+        self.node.mine()
+
+    def signed_tx(self, amount):
+        tx = Transaction(self.wallet.pubkey, self.laura_wallet.pubkey, amount)
+        tx.signature = self.wallet.sign(tx)
+        return tx
+
+    def test_duplicate_transaction_rejected(self):
+        tx = self.signed_tx(10)
+
+        self.assertTrue(self.blockchain.add_transaction(tx))
+        self.assertFalse(self.blockchain.add_transaction(tx))
+        self.assertEqual(len(self.blockchain.mempool), 1)
+        self.assertEqual(self.laura_wallet.unverified_balance(), 10)
+        self.assertEqual(self.wallet.unverified_balance(), -10)
+
+    def test_full_mempool_evicts_oldest(self):
+        mempool = Mempool(max_size=2)
+        first, second, third = self.signed_tx(1), self.signed_tx(2), self.signed_tx(3)
+        for tx in (first, second, third):
+            mempool.add(tx)
+
+        self.assertNotIn(first.id(), mempool)
+        self.assertEqual(mempool.page(), [second, third])
+        self.assertEqual(mempool.page(offset=1, limit=1), [third])
+
+    def test_block_only_evicts_included_transactions(self):
+        included = self.signed_tx(10)
+        self.blockchain.add_transaction(included)
+        block = Block(
+            previous_hash=self.blockchain.get_latest_block().hash(),
+            transactions={
+                "coinbase": Transaction(self.wallet.pubkey, self.wallet.pubkey, 50),
+                "regular": [included],
+            },
+        )
+        late = self.signed_tx(5)
+        self.blockchain.add_transaction(late)
+
+        self.node.proof_of_work(block)
+        self.blockchain.add_block(block, self.node)
+
+        self.assertEqual(self.blockchain.pending_transactions, [late])
+        self.assertEqual(self.laura_wallet.verified_balance(), 10)
+        self.assertEqual(self.laura_wallet.unverified_balance(), 5)
+
+    def test_mempool_txns_by_address(self):
+        sent, other = self.signed_tx(10), self.signed_tx(5)
+        self.blockchain.add_transaction(sent)
+        self.blockchain.add_transaction(other)
+        self.blockchain.mempool.remove(other.id())
+
+        self.assertEqual(self.wallet.get_mempool_txns(), [sent])
+        self.assertEqual(self.laura_wallet.get_mempool_txns(), [sent])
+        self.assertEqual(Wallet(self.blockchain).get_mempool_txns(), [])
+        by_sender = self.blockchain.mempool.by_sender
+        self.assertEqual(by_sender, {compress(self.wallet.pubkey): {sent.id()}})
+
+
+class TestSignatureVerifier(unittest.TestCase):
+    def setUp(self):
+        self.blockchain = Blockchain()
+        self.node = Node(self.blockchain)
+        self.wallet = Wallet(self.blockchain)
+        self.laura_wallet = Wallet(self.blockchain)
+        self.node.add_account(self.wallet)
+        self.node.set_blockreward_pubkey(self.wallet.pubkey)
+        self.node.mine()
+
+    def test_tampered_transaction_rejected_from_mempool(self):
+        tx = Transaction(self.wallet.pubkey, self.laura_wallet.pubkey, 10)
+        tx.signature = self.wallet.sign(tx)
+        tx.amount = 40
+
+        self.assertFalse(self.blockchain.add_transaction(tx))
+        self.assertEqual(len(self.blockchain.mempool), 0)
+
+    def test_chain_with_forged_transaction_is_invalid(self):
+        self.wallet.send(self.laura_wallet.pubkey, 10)
+        self.node.mine()
+        json_chain = self.blockchain.json_serialize()
+        json_chain["chain"][1]["transactions"]["regular"][0]["amount"] = 40
+        # A forger would recompute the Merkle root too
+        del json_chain["chain"][1]["merkle_root"]
+
+        forged_chain = Blockchain.json_deserialize(json_chain).chain
+
+        self.assertTrue(self.blockchain.valid_chain(self.blockchain.chain))
+        self.assertFalse(SignatureVerifier().verify_chain(forged_chain))
+
+    def test_verified_signatures_are_cached(self):
+        self.wallet.send(self.laura_wallet.pubkey, 10)
+        tx = self.blockchain.pending_transactions[0]
+
+        self.assertIn((tx.id(), tx.signature), self.blockchain.verifier.verified)
+
+    def test_batch_verification_in_process_pool(self):
+        verifier = SignatureVerifier(workers=2, min_batch=1)
+        txs = []
+        for amount in range(1, 5):
+            tx = Transaction(self.wallet.pubkey, self.laura_wallet.pubkey, amount)
+            tx.signature = self.wallet.sign(tx)
+            txs.append(tx)
+        forged = Transaction(self.wallet.pubkey, self.laura_wallet.pubkey, 5)
+        forged.signature = txs[0].signature
+
+        try:
+            self.assertTrue(verifier.verify_transactions(txs))
+            self.assertFalse(verifier.verify_transactions(txs + [forged]))
+        finally:
+            verifier.shutdown()
+
+
+class TestChainValidator(unittest.TestCase):
+    def setUp(self):
+        self.blockchain = Blockchain()
+        self.node = Node(self.blockchain)
+        self.wallet = Wallet(self.blockchain)
+        self.node.add_account(self.wallet)
+        self.node.set_blockreward_pubkey(self.wallet.pubkey)
+        for _ in range(4):
+            self.node.mine()
+
+    def test_chain_validation(self):
+        peer_chain = Blockchain.json_deserialize(self.blockchain.json_serialize()).chain
+        json_chain = self.blockchain.json_serialize()
+        json_chain["chain"][2]["proof"] += 1
+        bad_chain = Blockchain.json_deserialize(json_chain).chain
+
+        self.assertTrue(self.blockchain.validator.valid_chain(peer_chain))
+        self.assertFalse(self.blockchain.validator.valid_chain(bad_chain))
+
+    def test_valid_fork_keeps_shared_prefix(self):
+        peer_blockchain = Blockchain.json_deserialize(self.blockchain.json_serialize())
+        peer_node = Node(peer_blockchain)
+        peer_node.set_blockreward_pubkey(self.wallet.pubkey)
+        peer_node.mine()
+
+        candidate = self.blockchain.validator.valid_fork(peer_blockchain.chain)
+
+        self.assertEqual(self.blockchain.fork_point(peer_blockchain.chain), 4)
+        self.assertEqual(candidate[:4], self.blockchain.chain)
+        self.assertIs(candidate[4], peer_blockchain.chain[4])
+
+    def test_invalid_fork_rejected(self):
+        json_chain = self.blockchain.json_serialize()
+        json_chain["chain"][3]["previous_hash"] = "random bad hash"
+        bad_chain = Blockchain.json_deserialize(json_chain).chain
+
+        self.assertEqual(self.blockchain.fork_point(bad_chain), 3)
+        self.assertIsNone(self.blockchain.validator.valid_fork(bad_chain))
+
+    def make_peer(self):
+        peer_blockchain = Blockchain.json_deserialize(self.blockchain.json_serialize())
+        peer_node = Node(peer_blockchain)
+        peer_node.set_blockreward_pubkey(self.wallet.pubkey)
+        return peer_blockchain, peer_node
+
+    def test_inflated_coinbase_rejected(self):
+        peer_blockchain, peer_node = self.make_peer()
+        peer_blockchain.block_reward = 51
+        peer_node.mine()
+
+        self.assertFalse(self.blockchain.adopt_chain(peer_blockchain.chain))
+        self.assertEqual(len(self.blockchain.chain), 4)
+
+    def test_overdraft_rejected_against_fork_point(self):
+        laura_wallet = Wallet(self.blockchain)
+        peers = [self.make_peer() for _ in range(2)]
+        # Our chain gets a block the peers' forks don't have, so we hold 250 but
+        # only 200 at the fork point
+        self.node.mine()
+        for (peer_blockchain, peer_node), amount, adopted in zip(
+            peers, (220, 200), (False, True)
+        ):
+            tx = Transaction(self.wallet.pubkey, laura_wallet.pubkey, amount)
+            tx.signature = self.wallet.sign(tx)
+            peer_node.mine_block(peer_blockchain.chain[3].hash(), [tx])
+            peer_node.mine()
+
+            replaced = self.blockchain.adopt_chain(peer_blockchain.chain)
+
+            self.assertEqual(replaced, adopted)
+        self.assertEqual(self.blockchain.get_balance(laura_wallet.pubkey), 200)
+
+    def test_forged_genesis_rejected(self):
+        # The hardest target there is claims about 2^256 work, but can't be met
+        json_block = self.blockchain.chain[0].json_serialize()
+        json_block["target"] = f"{1:064x}"
+        forged = Block.json_deserialize(json_block)
+
+        self.assertFalse(self.blockchain.adopt_chain([forged]))
+        self.assertEqual(len(self.blockchain.chain), 4)
+        self.assertEqual(self.blockchain.get_balance(self.wallet.pubkey), 200)
+
+
+class LocalResponse:
+    def __init__(self, status_code, body, content=None, headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.content = content
+        self.headers = headers or {"Content-Type": "application/json"}
+        self.url = "local"
+        self.chunks_read = 0
+        self.closed = False
+
+    def json(self):
+        if self.body is None and self.content is not None:
+            return json.loads(self.content)
+        return self.body
+
+    def iter_content(self, chunk_size):
+        content = self.content or json.dumps(self.body).encode()
+        for start in range(0, len(content), chunk_size):
+            self.chunks_read += 1
+            yield content[start : start + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class LocalPeers:
+    """
+    Serves the chain sync endpoints of in-process blockchains in place of HTTP
+    """
+
+    def __init__(self, blockchains, legacy=()):
+        self.blockchains = blockchains
+        # Peers that only serve their whole chain
+        self.legacy = set(legacy)
+        self.blocks_sent = 0
+        self.responses = []
+        # peer -> errors recorded against it
+        self.failures = {}
+
+    def record_failure(self, peer, error):
+        self.failures.setdefault(peer, []).append(error)
+
+    def get(self, peer, path, params=None, **kwargs):
+        if peer not in self.blockchains:
+            # Not a node at all, e.g. a web server answering every path
+            return LocalResponse(200, None, b"<html></html>", {})
+        blockchain = self.blockchains[peer]
+        start, limit = (params["from"], params["limit"]) if params else (0, 0)
+        if peer in self.legacy:
+            if path != "/chain":
+                return LocalResponse(404, None)
+            response = LocalResponse(200, blockchain.json_serialize())
+            self.responses.append(response)
+            return response
+        if path == "/chain/height":
+            height, tip, work = blockchain.tip()
+            body = {"height": height, "tip": tip, "work": f"{work:064x}"}
+            return LocalResponse(200, body)
+        if path == "/chain/headers":
+            return LocalResponse(200, {"headers": blockchain.headers(start, limit)})
+        if path == "/chain/blocks" and params.get("format") == "binary":
+            blocks = blockchain.binary_blocks(start, limit)
+            self.blocks_sent += len(blocks)
+            headers = {"Content-Type": BINARY_CONTENT_TYPE}
+            return LocalResponse(200, None, encode_chain(blocks), headers)
+        if path == "/chain/blocks":
+            blocks = blockchain.blocks(start, limit)
+            self.blocks_sent += len(blocks)
+            return LocalResponse(200, {"blocks": blocks})
+        return LocalResponse(404, None)
+
+    def get_all(self, peers, path, headers_for=None, **kwargs):
+        for peer in peers:
+            yield peer, self.get(peer, path, **kwargs)
+
+
+class TestChainSync(unittest.TestCase):
+    def make_node(self, blockchain):
+        blockchain.difficulty = 2
+        node = Node(blockchain)
+        wallet = Wallet(blockchain)
+        node.add_account(wallet)
+        node.set_blockreward_pubkey(wallet.pubkey)
+        return node
+
+    def setUp(self):
+        self.blockchain = Blockchain()
+        self.node = self.make_node(self.blockchain)
+        for _ in range(20):
+            self.node.mine()
+        self.peer_blockchain = Blockchain.json_deserialize(
+            self.blockchain.json_serialize()
+        )
+        self.peer_node = self.make_node(self.peer_blockchain)
+        self.peers = LocalPeers({"peer": self.peer_blockchain})
+        self.blockchain.peer_client = self.peers
+        self.blockchain.register_peers(["peer"])
+
+    def test_only_missing_blocks_downloaded(self):
+        for _ in range(3):
+            self.peer_node.mine()
+
+        self.assertTrue(self.blockchain.consensus())
+
+        self.assertEqual(self.peers.blocks_sent, 3)
+        self.assertEqual(
+            self.blockchain.get_latest_block().hash(),
+            self.peer_blockchain.get_latest_block().hash(),
+        )
+
+    def test_fork_point_found_behind_window(self):
+        self.blockchain.sync.window = 2
+        for _ in range(5):
+            self.node.mine()
+        for _ in range(7):
+            self.peer_node.mine()
+
+        self.assertTrue(self.blockchain.consensus())
+
+        self.assertEqual(self.peers.blocks_sent, 7)
+        self.assertEqual(len(self.blockchain.chain), 27)
+        self.assertTrue(self.blockchain.valid_chain(self.blockchain.chain))
+
+    def test_shorter_peer_ignored(self):
+        self.node.mine()
+
+        self.assertFalse(self.blockchain.consensus())
+        self.assertEqual(self.peers.blocks_sent, 0)
+
+    def test_shorter_chain_with_more_work_synced(self):
+        start = self.blockchain.get_latest_block().timestamp
+        for blockchain in (self.blockchain, self.peer_blockchain):
+            blockchain.target_block_time = 10
+            blockchain.retarget_window = 2
+        # Our blocks come slowly, so the target stays the easiest there is
+        for i in range(1, 4):
+            with mock.patch("block.time", return_value=start + 100 * i):
+                self.node.mine()
+        # The peer's come fast, so its target drops and each block has more work
+        for i in range(1, 3):
+            with mock.patch("block.time", return_value=start + i / 1000):
+                self.peer_node.mine()
+        peer_work = chain_work(self.peer_blockchain.chain[20:])
+        self.assertGreater(peer_work, chain_work(self.blockchain.chain[20:]))
+
+        self.assertTrue(self.blockchain.consensus())
+
+        self.assertEqual(len(self.blockchain.chain), 22)
+        self.assertEqual(
+            self.blockchain.get_latest_block().hash(),
+            self.peer_blockchain.get_latest_block().hash(),
+        )
+        self.assertEqual(self.blockchain.work, self.peer_blockchain.work)
+
+    def test_malformed_height_skipped(self):
+        for _ in range(3):
+            self.peer_node.mine()
+        self.blockchain.register_peers(["web server"])
+
+        self.assertTrue(self.blockchain.consensus())
+
+        self.assertEqual(len(self.blockchain.chain), 23)
+        self.assertEqual(list(self.peers.failures), ["web server"])
+
+    def corrupt(self, path, key, corruption):
+        """
+        Make the peer serve JSON pages of `path` with `corruption` applied to them
+        """
+        get = self.peers.get
+
+        def corrupted_get(peer, requested, params=None, **kwargs):
+            # Answer like an older peer, in JSON, so there's a body to corrupt
+            params = {**params, "format": "json"} if params else params
+            response = get(peer, requested, params, **kwargs)
+            if requested == path:
+                corruption(response.body[key])
+            return response
+
+        self.peers.get = corrupted_get
+
+    def test_malformed_headers_ignored(self):
+        for _ in range(3):
+            self.peer_node.mine()
+        self.corrupt("/chain/headers", "headers", lambda headers: headers.insert(0, 1))
+
+        self.assertFalse(self.blockchain.consensus())
+        self.assertEqual(len(self.blockchain.chain), 20)
+
+    def test_malformed_blocks_ignored(self):
+        for _ in range(3):
+            self.peer_node.mine()
+
+        def drop_coinbase(blocks):
+            blocks[0]["transactions"]["coinbase"] = None
+
+        self.corrupt("/chain/blocks", "blocks", drop_coinbase)
+
+        self.assertFalse(self.blockchain.consensus())
+        self.assertEqual(len(self.blockchain.chain), 20)
+
+
+class TestStreamedConsensus(unittest.TestCase):
+    make_node = TestChainSync.make_node
+
+    def setUp(self):
+        self.blockchain = Blockchain()
+        self.node = self.make_node(self.blockchain)
+        for _ in range(10):
+            self.node.mine()
+        self.peer_blockchain = Blockchain.json_deserialize(
+            self.blockchain.json_serialize()
+        )
+        self.peer_node = self.make_node(self.peer_blockchain)
+        self.peers = LocalPeers({"peer": self.peer_blockchain}, legacy=["peer"])
+        self.blockchain.peer_client = self.peers
+        self.blockchain.register_peers(["peer"])
+
+    def test_legacy_chain_streamed(self):
+        for _ in range(3):
+            self.peer_node.mine()
+
+        self.assertTrue(self.blockchain.consensus())
+
+        self.assertEqual(len(self.blockchain.chain), 13)
+        self.assertEqual(
+            self.blockchain.get_latest_block().hash(),
+            self.peer_blockchain.get_latest_block().hash(),
+        )
+        self.assertTrue(self.peers.responses[0].closed)
+
+    def test_shared_blocks_not_kept(self):
+        for _ in range(3):
+            self.peer_node.mine()
+        response = self.peers.get("peer", "/chain")
+
+        chain = self.blockchain.sync.read_chain(response)
+
+        self.assertEqual(chain.fork_point, 10)
+        self.assertEqual(len(chain.blocks), 3)
+
+    def test_invalid_block_stops_reading(self):
+        for _ in range(30):
+            self.peer_node.mine()
+        response = self.peers.get("peer", "/chain")
+        # Unlink the first new block from the chain
+        response.body["chain"][10]["previous_hash"] = "0" * 64
+        total_chunks = len(list(response.iter_content(1024)))
+        response.chunks_read = 0
+
+        with mock.patch("chain_sync.CHUNK_SIZE", 1024):
+            self.assertIsNone(self.blockchain.sync.read_chain(response))
+        self.assertLess(response.chunks_read, total_chunks / 2)
+        self.assertEqual(len(self.blockchain.chain), 10)
+
+    def test_oversized_chain_rejected(self):
+        for _ in range(3):
+            self.peer_node.mine()
+        self.blockchain.sync.max_chain_bytes = 1000
+
+        self.assertFalse(self.blockchain.consensus())
+        self.assertEqual(len(self.blockchain.chain), 10)
+
+
+class TestJSONStream(unittest.TestCase):
+    def chunks(self, document, size):
+        data = json.dumps(document).encode()
+        return [data[i : i + size] for i in range(0, len(data), size)]
+
+    def test_array_items_decoded_across_chunks(self):
+        document = {
+            "before": {"nested": [1, 2, {"chain": []}]},
+            "chain": [{"n": 12345}, "ü", [1.5, None], 67890],
+            "after": 10 ** 20,
+        }
+        for size in (1, 2, 7, 1000):
+            items = list(iter_json_array(self.chunks(document, size), "chain"))
+            self.assertEqual(items, document["chain"])
+
+    def test_empty_and_missing_array(self):
+        self.assertEqual(list(iter_json_array([b'{"chain": [ ]}'], "chain")), [])
+        with self.assertRaises(KeyError):
+            list(iter_json_array([b'{"blocks": []}'], "chain"))
+
+    def test_malformed_document(self):
+        for data in (b'{"chain": [1, 2', b'{"chain": [1 2]}', b"[1]", b'{"chain": []} x'):
+            with self.assertRaises(ValueError):
+                list(iter_json_array([data], "chain"))
+
+    def test_size_cap(self):
+        chunks = self.chunks({"chain": list(range(1000))}, 100)
+        items = iter_json_array(chunks, "chain", max_bytes=500)
+
+        with self.assertRaises(ResponseTooLarge):
+            for _ in items:
+                pass
+
+
+class TestReorganization(unittest.TestCase):
+    make_node = TestChainSync.make_node
+
+    def setUp(self):
+        self.blockchain = Blockchain()
+        self.node = self.make_node(self.blockchain)
+        self.wallet = Wallet(self.blockchain)
+        self.node.set_blockreward_pubkey(self.wallet.pubkey)
+        for _ in range(3):
+            self.node.mine()
+        self.fork = Blockchain.json_deserialize(self.blockchain.json_serialize())
+        self.fork_node = self.make_node(self.fork)
+
+    def signed_tx(self, amount):
+        tx = Transaction(self.wallet.pubkey, Wallet(self.blockchain).pubkey, amount)
+        tx.signature = self.wallet.sign(tx)
+        return tx
+
+    def copy(self, block):
+        return Block.json_deserialize(block.json_serialize())
+
+    def test_branch_with_more_work_takes_over(self):
+        orphaned = self.signed_tx(10)
+        self.blockchain.add_transaction(orphaned)
+        ours = self.node.mine()
+        moved = self.signed_tx(20)
+        self.fork.add_transaction(moved)
+        self.fork_node.mine()
+        self.fork_node.mine()
+        first, second = [self.copy(block) for block in self.fork.chain[3:]]
+
+        # Same work as our chain past the fork point, so ours stays
+        self.assertTrue(self.blockchain.add_fork_block(first))
+        self.assertEqual(self.blockchain.get_latest_block().hash(), ours.hash())
+        self.assertIn(first.hash(), self.blockchain.tree)
+
+        self.assertTrue(self.blockchain.add_fork_block(second))
+
+        self.assertEqual(
+            [block.hash() for block in self.blockchain.chain],
+            [block.hash() for block in self.fork.chain],
+        )
+        self.assertEqual(self.blockchain.balances.balances, self.fork.balances.balances)
+        self.assertEqual(self.blockchain.work, chain_work(self.fork.chain))
+        self.assertIn(ours.hash(), self.blockchain.tree)
+        self.assertNotIn(first.hash(), self.blockchain.tree)
+        # Our transaction is back in the mempool, theirs is in the chain
+        self.assertEqual(
+            [tx.id() for tx in self.blockchain.pending_transactions], [orphaned.id()]
+        )
+        self.assertEqual(self.blockchain.find_transaction(moved.id())[2], 3)
+
+    def test_switch_back_to_old_branch(self):
+        ours = self.node.mine()
+        for _ in range(2):
+            self.fork_node.mine()
+        for block in self.fork.chain[3:]:
+            self.blockchain.add_fork_block(self.copy(block))
+        self.assertEqual(len(self.blockchain.chain), 5)
+
+        # Extend our old block on a copy of our chain as it was
+        old = Blockchain.json_deserialize(self.blockchain.json_serialize())
+        old.set_chain(self.blockchain.chain[:3] + [ours])
+        old_node = self.make_node(old)
+        for _ in range(2):
+            old_node.mine()
+        for block in old.chain[4:]:
+            self.blockchain.add_fork_block(self.copy(block))
+
+        self.assertEqual(self.blockchain.chain[3].hash(), ours.hash())
+        self.assertEqual(len(self.blockchain.chain), 6)
+        self.assertEqual(self.blockchain.balances.balances, old.balances.balances)
+
+    def test_invalid_branch_rejected(self):
+        self.node.mine()
+        first = self.copy(self.fork_node.mine())
+        # Valid proof-of-work, but its transaction isn't signed
+        thief = self.fork_node.pubkey
+        forged = Block(
+            first.hash(),
+            transactions={
+                "coinbase": Transaction(thief, thief, 50),
+                "regular": [Transaction(self.wallet.pubkey, thief, 50)],
+            },
+            target=first.target,
+        )
+        self.fork_node.proof_of_work(forged)
+
+        self.assertTrue(self.blockchain.add_fork_block(first))
+        self.assertFalse(self.blockchain.add_fork_block(forged))
+        self.assertEqual(len(self.blockchain.chain), 4)
+        self.assertNotIn(forged.hash(), self.blockchain.tree)
+
+    def test_easier_target_than_branch_rejected(self):
+        self.node.mine()
+        tip = self.fork.get_latest_block()
+        coinbase_tx = Transaction(self.wallet.pubkey, self.wallet.pubkey, 50)
+        block = Block(
+            tip.hash(),
+            transactions={"coinbase": coinbase_tx, "regular": []},
+            target=target_from_difficulty(1),
+        )
+        self.fork_node.proof_of_work(block)
+
+        self.assertFalse(self.blockchain.add_fork_block(block))
+        self.assertEqual(len(self.blockchain.tree), 0)
+        # Nor can blocks on top of it get in
+        child = Block(block.hash(), target=self.blockchain.max_target)
+        self.fork_node.proof_of_work(child)
+        self.assertFalse(self.blockchain.add_fork_block(child))
+
+    def test_unknown_parent_ignored(self):
+        for _ in range(2):
+            self.fork_node.mine()
+
+        self.assertFalse(self.blockchain.add_fork_block(self.copy(self.fork.chain[4])))
+        self.assertEqual(len(self.blockchain.tree), 0)
+
+    def test_work(self):
+        easy, hard = target_from_difficulty(2), target_from_difficulty(3)
+
+        self.assertEqual(block_work(hard), 16 * block_work(easy))
+        work = chain_work(self.blockchain.chain)
+        self.assertEqual(work, 3 * block_work(self.blockchain.max_target))
+
+
+class TestBlockLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.blockchain = Blockchain()
+        self.blockchain.use_store(BlockLog(self.directory.name))
+        self.node = Node(self.blockchain)
+        wallet = Wallet(self.blockchain)
+        self.node.add_account(wallet)
+        self.node.set_blockreward_pubkey(wallet.pubkey)
+        for _ in range(3):
+            self.node.mine()
+        self.blockchain.store.close()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def hashes(self, blocks):
+        return [block.hash() for block in blocks]
+
+    def test_mined_blocks_are_appended(self):
+        store = BlockLog(self.directory.name)
+
+        self.assertEqual(len(store), 3)
+        self.assertEqual(
+            self.hashes(store.read_all()), self.hashes(self.blockchain.chain)
+        )
+        self.assertEqual(store.read(1).hash(), self.blockchain.chain[1].hash())
+        store.close()
+
+    def test_concurrent_readers(self):
+        store = BlockLog(self.directory.name)
+        blockchain = Blockchain()
+        blockchain.use_store(store)
+        blockchain.difficulty = 1
+        # Too small to hold the chain, so readers keep decoding blocks from the log
+        blockchain.chain.cache_size = 0
+        node = Node(blockchain)
+        node.set_blockreward_pubkey(Wallet(blockchain).pubkey)
+        mining = threading.Event()
+        errors = []
+
+        def read():
+            while mining.is_set():
+                try:
+                    with blockchain.lock.read():
+                        for height in range(len(blockchain.chain)):
+                            blockchain.chain[height]
+                except Exception as error:
+                    errors.append(error)
+
+        mining.set()
+        readers = [threading.Thread(target=read) for _ in range(6)]
+        for reader in readers:
+            reader.start()
+        try:
+            for _ in range(50):
+                node.mine()
+        finally:
+            mining.clear()
+            for reader in readers:
+                reader.join()
+            store.close()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(blockchain.chain), 53)
+
+    def test_torn_tail_is_truncated(self):
+        log_path = os.path.join(self.directory.name, "blocks.log")
+        size = os.path.getsize(log_path)
+        with open(log_path, "ab") as log:
+            log.write(b"\x00\x00\x01\x00half a record")
+
+        store = BlockLog(self.directory.name)
+
+        self.assertEqual(len(store), 3)
+        self.assertEqual(os.path.getsize(log_path), size)
+        self.assertEqual(
+            self.hashes(store.read_all()), self.hashes(self.blockchain.chain)
+        )
+        store.close()
+
+    def test_missing_index_entries_are_rebuilt(self):
+        index_path = os.path.join(self.directory.name, "blocks.idx")
+        with open(index_path, "r+b") as index:
+            index.truncate(12)
+
+        store = BlockLog(self.directory.name)
+
+        self.assertEqual(
+            self.hashes(store.read_all()), self.hashes(self.blockchain.chain)
+        )
+        store.close()
+
+    def test_truncate_removes_replaced_blocks(self):
+        store = BlockLog(self.directory.name)
+        store.truncate(1)
+        store.append(self.blockchain.chain[2])
+        store.close()
+
+        store = BlockLog(self.directory.name)
+        self.assertEqual(
+            self.hashes(store.read_all()),
+            self.hashes([self.blockchain.chain[0], self.blockchain.chain[2]]),
+        )
+        store.close()
+
+    def test_log_mixes_binary_and_json_blocks(self):
+        store = BlockLog(self.directory.name, codec="json")
+        store.truncate(2)
+        store.append(self.blockchain.chain[2])
+        store.close()
+
+        store = BlockLog(self.directory.name)
+        self.assertEqual(
+            self.hashes(store.read_all()), self.hashes(self.blockchain.chain)
+        )
+        store.close()
+
+    def test_lazy_chain_loads_blocks_on_access(self):
+        store = BlockLog(self.directory.name)
+        chain = LazyChain(store, cache_size=2)
+
+        self.assertEqual(len(chain), 3)
+        self.assertEqual(len(chain.cache), 0)
+        self.assertEqual(chain.hash_at(2), self.blockchain.chain[2].hash())
+        self.assertEqual(self.hashes(chain), self.hashes(self.blockchain.chain))
+        self.assertEqual(list(chain.cache), [1, 2])
+        self.assertEqual(chain[-1].hash(), self.blockchain.chain[-1].hash())
+        store.close()
+
+    def test_reopened_chain_keeps_indexes(self):
+        wallet_pubkey = self.blockchain.chain[0].transactions["coinbase"].recipient
+        blockchain = Blockchain()
+        blockchain.use_store(BlockLog(self.directory.name))
+
+        tip = self.blockchain.get_latest_block()
+        self.assertEqual(blockchain.get_block(tip.hash()).hash(), tip.hash())
+        self.assertEqual(blockchain.get_balance(wallet_pubkey), 150)
+        self.assertTrue(blockchain.valid_chain(blockchain.chain))
+        blockchain.store.close()
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "checkpoint.json")
+        self.blockchain = Blockchain()
+        self.blockchain.difficulty = 2
+        self.blockchain.use_store(BlockLog(self.directory.name))
+        self.checkpointer = Checkpointer(self.blockchain, self.path, interval=2)
+        self.node = Node(self.blockchain)
+        self.wallet = Wallet(self.blockchain)
+        self.laura_wallet = Wallet(self.blockchain)
+        self.node.add_account(self.wallet)
+        self.node.set_blockreward_pubkey(self.wallet.pubkey)
+        for _ in range(5):
+            self.node.mine()
+        self.blockchain.register_peers(["localhost:5001"])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def restart(self, checkpoint):
+        self.blockchain.store.close()
+        blockchain = Blockchain()
+        blockchain.use_store(BlockLog(self.directory.name), checkpoint=checkpoint)
+        self.addCleanup(blockchain.store.close)
+        return blockchain
+
+    def test_written_every_interval(self):
+        self.assertEqual(self.checkpointer.saved, 2)
+        self.assertEqual(read_checkpoint(self.path)["height"], 4)
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+    def test_only_blocks_after_checkpoint_replayed(self):
+        checkpoint = read_checkpoint(self.path)
+        # Anything replayed from Genesis would drop this
+        checkpoint["balances"]["sentinel"] = 7
+
+        blockchain = self.restart(checkpoint)
+
+        self.assertEqual(blockchain.balances.get("sentinel"), 7)
+        self.assertEqual(
+            blockchain.balances.balances,
+            {**self.blockchain.balances.balances, "sentinel": 7},
+        )
+        self.assertEqual(blockchain.difficulty, 2)
+        self.assertEqual(blockchain.work, chain_work(self.blockchain.chain))
+
+    def test_mempool_and_peers_restored(self):
+        self.wallet.send(self.laura_wallet.pubkey, 10)
+        self.wallet.send(self.laura_wallet.pubkey, 20)
+        self.checkpointer.save()
+        pending = self.blockchain.pending_transactions
+        # Mine the first transaction only
+        self.blockchain.template.max_txs = 1
+        self.node.mine()
+
+        blockchain = self.restart(read_checkpoint(self.path))
+
+        self.assertEqual(blockchain.peers, {"localhost:5001"})
+        self.assertEqual(
+            [tx.id() for tx in blockchain.pending_transactions], [pending[1].id()]
+        )
+        self.assertEqual(
+            blockchain.balances.balances, self.blockchain.balances.balances
+        )
+
+    def test_stale_checkpoint_ignored(self):
+        checkpoint = read_checkpoint(self.path)
+        checkpoint["balances"]["sentinel"] = 7
+        checkpoint["tip"] = "0" * 64
+
+        blockchain = self.restart(checkpoint)
+
+        self.assertEqual(blockchain.balances.get("sentinel"), 0)
+        self.assertEqual(
+            blockchain.balances.balances, self.blockchain.balances.balances
+        )
+        self.assertEqual(blockchain.work, chain_work(self.blockchain.chain))
+
+    def test_unreadable_checkpoint(self):
+        with open(self.path, "w") as file:
+            file.write('{"height": ')
+        self.assertIsNone(read_checkpoint(self.path))
+
+        write_checkpoint(self.path, {"height": 0})
+        self.assertEqual(read_checkpoint(self.path)["height"], 0)
+
+
+class TestKeyCache(unittest.TestCase):
+    def setUp(self):
+        self.addresses = [
+            compress(Wallet(Blockchain()).privkey.verifying_key) for _ in range(3)
+        ]
+
+    def test_one_key_per_address(self):
+        cache = KeyCache()
+        key = cache.get(self.addresses[0])
+
+        self.assertIs(cache.get(self.addresses[0]), key)
+        self.assertEqual(key.address, self.addresses[0])
+        self.assertEqual(key.compressed, bytes.fromhex(self.addresses[0]))
+        self.assertEqual(compress(key), self.addresses[0])
+
+    def test_cache_is_bounded(self):
+        cache = KeyCache(max_size=2)
+        first = cache.get(self.addresses[0])
+        for address in self.addresses[1:]:
+            cache.get(address)
+
+        self.assertEqual(len(cache), 2)
+        self.assertNotIn(self.addresses[0], cache.keys)
+        # A re-interned key still equals the evicted one
+        self.assertEqual(cache.get(self.addresses[0]), first)
+        self.assertNotEqual(cache.get(self.addresses[1]), first)
+
+    def test_wallet_pubkey_is_interned(self):
+        blockchain = Blockchain()
+        node = Node(blockchain)
+        wallet = Wallet(blockchain)
+        node.add_account(wallet)
+        node.set_blockreward_pubkey(wallet.pubkey)
+        block = node.mine()
+
+        decoded = Block.binary_deserialize(block.binary_serialize())
+
+        self.assertIs(decoded.transactions["coinbase"].recipient, wallet.pubkey)
+
+
+class TestMiner(unittest.TestCase):
+    def test_midstate_hash_matches_block_hash(self):
+        blockchain = Blockchain()
+        node = Node(blockchain)
+        wallet = Wallet(blockchain)
+        laura_wallet = Wallet(blockchain)
+        node.add_account(wallet)
+        node.set_blockreward_pubkey(wallet.pubkey)
+        node.mine()
+        wallet.send(laura_wallet.pubkey, 10)
+
+        block = Block(
+            previous_hash=blockchain.get_latest_block().hash(),
+            transactions={
+                "coinbase": blockchain.chain[0].transactions["coinbase"],
+                "regular": blockchain.pending_transactions,
+            },
+        )
+        miner = Miner(block)
+        for nonce in [0, 1, 12345, 9999999999999]:
+            block.nonce = nonce
+            self.assertEqual(miner.hash(nonce), block.hash())
+
+    def test_mined_block_satisfies_difficulty(self):
+        blockchain = Blockchain()
+        node = Node(blockchain)
+        wallet = Wallet(blockchain)
+        node.add_account(wallet)
+        node.set_blockreward_pubkey(wallet.pubkey)
+
+        block = node.mine()
+
+        self.assertTrue(block.valid_proof())
+        self.assertEqual(block.target, blockchain.max_target)
+
+    def test_partition_covers_nonce_space(self):
+        ranges = partition(1, 101, 3)
+
+        self.assertEqual(ranges[0][0], 1)
+        self.assertEqual(ranges[-1][1], 101)
+        for (_, stop), (start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(stop, start)
+
+    def test_parallel_mining(self):
+        blockchain = Blockchain()
+        node = Node(blockchain, workers=2)
+        wallet = Wallet(blockchain)
+        node.add_account(wallet)
+        node.set_blockreward_pubkey(wallet.pubkey)
+
+        node.mine()
+        node.mine()
+
+        self.assertEqual(len(blockchain.chain), 2)
+        self.assertTrue(blockchain.valid_chain(blockchain.chain))
+        self.assertEqual(set(node.hash_rates), {0, 1})
+
+    def test_new_tip_cancels_parallel_mining(self):
+        blockchain = Blockchain()
+        miner = ParallelMiner(workers=2)
+        blockchain.add_tip_listener(miner.cancel)
+        result = {}
+
+        # Impossible target, so only cancellation can end the search
+        search = threading.Thread(
+            target=lambda: result.update(nonce=miner.search(Block(), 0, 0, 10 ** 12))
+        )
+        search.start()
+        blockchain.notify_new_tip()
+        search.join(timeout=10)
+
+        self.assertFalse(search.is_alive())
+        self.assertIsNone(result["nonce"])
+
+
+class TestDifficulty(unittest.TestCase):
+    def chain(self, block_time, target, count=6):
+        return [
+            Block(timestamp=height * block_time, target=target)
+            for height in range(count)
+        ]
+
+    def test_target_matches_leading_zeroes(self):
+        target = target_from_difficulty(4)
+
+        self.assertLess(int("0000" + "f" * 60, 16), target)
+        self.assertGreaterEqual(int("0001" + "0" * 60, 16), target)
+
+    def test_target_follows_block_time(self):
+        target = target_from_difficulty(6)
+        max_target = target_from_difficulty(2)
+
+        # On schedule, twice as fast and twice as slow as 10 seconds a block
+        for block_time, expected in (
+            (10, target),
+            (5, target // 2),
+            (20, target * 2),
+        ):
+            chain = self.chain(block_time, target)
+            self.assertEqual(next_target(chain, 6, max_target, 10, window=5), expected)
+
+    def test_adjustment_is_limited(self):
+        target = target_from_difficulty(6)
+        max_target = target_from_difficulty(2)
+
+        fast = next_target(self.chain(0, target), 6, max_target, 10, window=5)
+        slow = next_target(self.chain(1000, target), 6, target, 10, window=5)
+
+        self.assertEqual(fast, target // MAX_ADJUSTMENT)
+        # Never easier than the easiest target allowed
+        self.assertEqual(slow, target)
+
+    def test_fixed_target_without_block_time(self):
+        chain = self.chain(0, target_from_difficulty(6))
+
+        self.assertEqual(next_target(chain, 6, 123, None), 123)
+
+    def test_fast_blocks_raise_difficulty(self):
+        blockchain = Blockchain()
+        blockchain.difficulty = 2
+        blockchain.target_block_time = 10
+        blockchain.retarget_window = 3
+        node = Node(blockchain)
+        wallet = Wallet(blockchain)
+        node.add_account(wallet)
+        node.set_blockreward_pubkey(wallet.pubkey)
+        for _ in range(6):
+            node.mine()
+
+        targets = [block.target for block in blockchain.chain]
+        self.assertEqual(targets[:4], [blockchain.max_target] * 4)
+        self.assertLess(targets[4], targets[3])
+        self.assertLess(targets[5], targets[4])
+        self.assertTrue(blockchain.valid_chain(blockchain.chain))
+
+        # A block claiming an easier target than the chain calls for is rejected
+        block = Block(blockchain.get_latest_block().hash(), target=targets[3])
+        node.proof_of_work(block)
+        blockchain.add_block(block, node)
+        self.assertEqual(len(blockchain.chain), 6)
+        self.assertFalse(blockchain.valid_chain(blockchain.chain + [block]))
+
+
+class TestMerkle(unittest.TestCase):
+    def setUp(self):
+        self.blockchain = Blockchain()
+        self.node = Node(self.blockchain)
+        self.wallet = Wallet(self.blockchain)
+        self.laura_wallet = Wallet(self.blockchain)
+        self.node.add_account(self.wallet)
+        self.node.set_blockreward_pubkey(self.wallet.pubkey)
+        self.node.mine()
+
+    def test_every_leaf_has_a_valid_proof(self):
+        for size in range(1, 8):
+            leaves = [bytes([i]) * 32 for i in range(1, size + 1)]
+            root = merkle_root(leaves)
+            for index, leaf in enumerate(leaves):
+                proof = merkle_proof(leaves, index)
+                self.assertTrue(verify_proof(leaf, proof, root))
+                self.assertFalse(verify_proof(bytes(32), proof, root))
+
+    def test_transaction_proof_matches_header(self):
+        for amount in range(1, 4):
+            self.wallet.send(self.laura_wallet.pubkey, amount)
+        self.node.mine()
+        block = self.blockchain.chain[1]
+        tx = block.transactions["regular"][2]
+
+        _, found, height, _ = self.blockchain.find_transaction(tx.id())
+        proof = found.merkle_proof(tx.id())
+        header = self.blockchain.headers(1, 1)[0]
+
+        self.assertEqual(height, 1)
+        self.assertIs(found, block)
+        self.assertTrue(
+            verify_proof(
+                bytes.fromhex(tx.id()), proof, bytes.fromhex(header["merkle_root"])
+            )
+        )
+        self.assertIsNone(self.blockchain.find_transaction("00" * 32))
+
+    def test_header_size_is_independent_of_transactions(self):
+        self.node.mine()
+        for amount in range(1, 6):
+            self.wallet.send(self.laura_wallet.pubkey, amount)
+        self.node.mine()
+        _, empty, full = self.blockchain.chain
+
+        self.assertEqual(len(full.header_bytes()), len(empty.header_bytes()))
+        self.assertTrue(self.blockchain.valid_chain(self.blockchain.chain))
+
+    def test_tampered_transactions_are_rejected(self):
+        self.wallet.send(self.laura_wallet.pubkey, 10)
+        self.node.mine()
+        block = self.blockchain.chain[1]
+        forged = Block(
+            block.previous_hash,
+            block.timestamp,
+            {"coinbase": block.transactions["coinbase"], "regular": []},
+            block.nonce,
+        )
+        # Splice the original header onto the forged transactions
+        header = block.header_bytes()
+        data = header + forged.binary_serialize()[len(forged.header_bytes()) :]
+
+        with self.assertRaises(ValueError):
+            Block.binary_deserialize(data)
+
+    def test_repeated_transactions_are_rejected(self):
+        victim = Blockchain.json_deserialize(self.blockchain.json_serialize())
+        gossip = Gossip(victim)
+        self.wallet.send(self.laura_wallet.pubkey, 10)
+        self.wallet.send(self.laura_wallet.pubkey, 20)
+        block = self.node.mine()
+        honest = block.json_serialize()
+        # Three leaves, so repeating the last one gives the same root and hash
+        mutated = block.json_serialize()
+        mutated["transactions"]["regular"].append(honest["transactions"]["regular"][-1])
+        regular_txs = list(block.transactions["regular"])
+        mutated_block = Block(
+            block.previous_hash,
+            block.timestamp,
+            {
+                "coinbase": block.transactions["coinbase"],
+                "regular": regular_txs + regular_txs[-1:],
+            },
+            block.nonce,
+            block.target,
+        )
+
+        self.assertEqual(mutated_block.hash(), block.hash())
+        with self.assertRaises(ValueError):
+            Block.json_deserialize(mutated)
+        with self.assertRaises(ValueError):
+            Block.binary_deserialize(mutated_block.binary_serialize())
+        try:
+            self.assertEqual(gossip.receive({"blocks": [mutated]})["blocks"], 0)
+            self.assertEqual(gossip.receive({"blocks": [honest]})["blocks"], 1)
+        finally:
+            gossip.close()
+        self.assertEqual(victim.get_balance(self.laura_wallet.pubkey), 30)
+
+
+class TestTxIndex(unittest.TestCase):
+    def setUp(self):
+        self.blockchain = Blockchain()
+        self.node = Node(self.blockchain)
+        self.wallet = Wallet(self.blockchain)
+        self.laura_wallet = Wallet(self.blockchain)
+        self.node.add_account(self.wallet)
+        self.node.set_blockreward_pubkey(self.wallet.pubkey)
+        self.node.mine()
+
+    def test_transactions_are_found_by_id(self):
+        self.wallet.send(self.laura_wallet.pubkey, 10)
+        tx = self.blockchain.pending_transactions[0]
+        self.assertIsNone(self.blockchain.find_transaction(tx.id()))
+        self.node.mine()
+
+        found, block, height, position = self.blockchain.find_transaction(tx.id())
+
+        self.assertEqual(found.id(), tx.id())
+        self.assertIs(block, self.blockchain.chain[1])
+        self.assertEqual((height, position), (1, 1))
+
+    def test_address_history_is_paged_newest_first(self):
+        for amount in range(1, 6):
+            self.wallet.send(self.laura_wallet.pubkey, amount)
+            self.node.mine()
+
+        pages = []
+        cursor = None
+        while True:
+            page, cursor = self.blockchain.address_transactions(
+                compress(self.laura_wallet.pubkey), cursor, limit=2
+            )
+            pages.append([tx.amount for tx, _ in page])
+            if cursor is None:
+                break
+
+        self.assertEqual(pages, [[5, 4], [3, 2], [1]])
+        self.assertEqual(len(self.wallet.get_confirmed_txns()), 11)
+
+    def test_addresses_looked_up_without_decoding(self):
+        self.wallet.send(self.laura_wallet.pubkey, 10)
+        self.node.mine()
+        address = compress(self.laura_wallet.pubkey)
+        # Well formed, but not a point on the curve
+        not_a_point = "02" + "0" * 64
+
+        page, _ = self.blockchain.address_transactions(parse_address(address.upper()))
+        self.assertEqual([tx.amount for tx, _ in page], [10])
+        page, _ = self.blockchain.address_transactions(parse_address(not_a_point))
+        self.assertEqual(page, [])
+        for bad in ("02", "04" + "0" * 64, "02" + "zz" * 32, address + "00"):
+            with self.assertRaises(ValueError):
+                parse_address(bad)
+
+    def test_replaced_blocks_are_dropped(self):
+        self.wallet.send(self.laura_wallet.pubkey, 10)
+        tx = self.blockchain.pending_transactions[0]
+        self.node.mine()
+
+        self.blockchain.set_chain(self.blockchain.chain[:1])
+
+        self.assertIsNone(self.blockchain.find_transaction(tx.id()))
+        page, _ = self.blockchain.address_transactions(
+            compress(self.laura_wallet.pubkey)
+        )
+        self.assertEqual(page, [])
+
+    def test_reopened_index_catches_up(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "tx_index.sqlite")
+            store = BlockLog(directory)
+            blockchain = Blockchain()
+            blockchain.use_store(store, TxIndex(path))
+            node = Node(blockchain)
+            node.add_account(self.wallet)
+            node.set_blockreward_pubkey(self.wallet.pubkey)
+            node.mine()
+            blockchain.tx_index.close()
+            # Blocks added while the index was closed
+            blockchain.tx_index = TxIndex()
+            node.mine()
+            node.mine()
+
+            index = TxIndex(path)
+            self.assertEqual(len(index), 1)
+            self.assertEqual(index.sync(blockchain), 2)
+            self.assertEqual(index.sync(blockchain), 0)
+            page, _ = index.address_txs(self.wallet.pubkey.address)
+            self.assertEqual([height for _, height, _ in page], [2, 1, 0])
+            index.close()
+            store.close()
+
+
+class TestBlockTemplate(unittest.TestCase):
+    def setUp(self):
+        self.blockchain = Blockchain()
+        self.node = Node(self.blockchain)
+        self.wallet = Wallet(self.blockchain)
+        self.laura_wallet = Wallet(self.blockchain)
+        self.miner_wallet = Wallet(self.blockchain)
+        self.node.add_account(self.wallet)
+        self.node.set_blockreward_pubkey(self.wallet.pubkey)
+        self.node.mine()
+        self.node.set_blockreward_pubkey(self.miner_wallet.pubkey)
+
+    def test_highest_fees_are_mined_and_collected(self):
+        self.blockchain.template.max_txs = 2
+        for fee in (0, 2, 1):
+            self.wallet.send(self.laura_wallet.pubkey, 10, fee)
+
+        block = self.node.mine()
+
+        self.assertEqual([tx.fee for tx in block.transactions["regular"]], [2, 1])
+        self.assertEqual(block.transactions["coinbase"].amount, 53)
+        self.assertEqual(self.miner_wallet.verified_balance(), 53)
+        self.assertEqual(self.wallet.verified_balance(), 27)
+        self.assertEqual(len(self.blockchain.mempool), 1)
+
+    def test_senders_never_overdraw(self):
+        self.wallet.send(self.laura_wallet.pubkey, 30)
+        self.wallet.send(self.laura_wallet.pubkey, 30, 1)
+
+        block = self.node.mine()
+
+        self.assertEqual(len(block.transactions["regular"]), 1)
+        self.assertEqual(self.wallet.verified_balance(), 19)
+        self.assertEqual(self.laura_wallet.verified_balance(), 30)
+
+    def test_block_size_is_bounded(self):
+        for fee in range(1, 6):
+            self.wallet.send(self.laura_wallet.pubkey, 1, fee)
+        size = len(self.blockchain.pending_transactions[0].binary_serialize())
+        self.blockchain.template.max_bytes = 3 * size
+
+        self.assertEqual([tx.fee for tx in self.blockchain.template.get()], [5, 4, 3])
+
+    def test_template_is_updated_incrementally(self):
+        template = self.blockchain.template
+        self.wallet.send(self.laura_wallet.pubkey, 1, 1)
+        self.assertEqual(len(template), 1)
+        rebuilds = template.rebuilds
+
+        self.wallet.send(self.laura_wallet.pubkey, 2, 1)
+        self.wallet.send(self.laura_wallet.pubkey, 3)
+
+        self.assertEqual([tx.amount for tx in template.get()], [1, 2, 3])
+        self.assertEqual(template.rebuilds, rebuilds)
+        self.node.mine()
+        self.assertEqual(template.get(), [])
+        self.assertEqual(template.rebuilds, rebuilds + 1)
+
+
+class TestMiningService(unittest.TestCase):
+    def setUp(self):
+        self.blockchain = Blockchain()
+        self.node = Node(self.blockchain)
+        self.wallet = Wallet(self.blockchain)
+        self.node.add_account(self.wallet)
+        self.node.set_blockreward_pubkey(self.wallet.pubkey)
+        self.service = MiningService(self.node)
+
+    def tearDown(self):
+        self.service.stop(timeout=10)
+
+    def test_mines_requested_blocks_in_background(self):
+        announced = []
+        done = threading.Event()
+
+        def listener(block):
+            announced.append(block)
+            if len(announced) == 2:
+                done.set()
+
+        self.service.add_block_listener(listener)
+        self.assertTrue(self.service.start(blocks=2))
+        self.assertFalse(self.service.start())
+
+        self.assertTrue(done.wait(timeout=30))
+        self.service.thread.join(timeout=10)
+        self.assertFalse(self.service.running)
+        self.assertEqual(announced, list(self.blockchain.chain))
+        self.assertEqual(self.service.status()["blocks_mined"], 2)
+
+    def test_stop_abandons_search(self):
+        # Impossible difficulty, so only stopping can end the search
+        self.blockchain.difficulty = 64
+        self.service.start()
+        while self.node.cancel_search is None:
+            self.service.thread.join(0.01)
+
+        self.assertTrue(self.service.stop(timeout=10))
+        self.assertFalse(self.service.running)
+        self.assertEqual(len(self.blockchain.chain), 0)
+        self.assertFalse(self.service.stop())
+
+    def test_new_transactions_restart_search(self):
+        self.node.mine()
+        laura_wallet = Wallet(self.blockchain)
+        self.blockchain.difficulty = 64
+        self.service.refresh_interval = 0
+        self.service.start()
+        while self.node.cancel_search is None:
+            self.service.thread.join(0.01)
+
+        self.wallet.send(laura_wallet.pubkey, 10)
+        while self.service.restarts == 0:
+            self.service.thread.join(0.01)
+
+        self.assertTrue(self.service.running)
+
+
+class LocalGossipClient:
+    """
+    Delivers gossip straight to the Gossip of other in-process nodes
+    """
+
+    def __init__(self, network):
+        self.network = network
+
+    def post(self, peer, path, json=None):
+        if peer not in self.network:
+            return None
+        return LocalResponse(200, {"accepted": self.network[peer].receive(json)})
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class TestGossip(unittest.TestCase):
+    def setUp(self):
+        # a <-> b <-> c: a and c only hear from each other through b
+        self.network = {}
+        self.blockchains = {}
+        links = {"a": {"b"}, "b": {"a", "c"}, "c": {"b"}}
+        for name, peers in links.items():
+            blockchain = Blockchain()
+            blockchain.peer_client = LocalGossipClient(self.network)
+            self.blockchains[name] = blockchain
+            self.network[name] = Gossip(blockchain, flush_interval=0.01)
+            blockchain.register_peers(peers)
+
+        self.node = Node(self.blockchains["a"])
+        self.wallet = Wallet(self.blockchains["a"])
+        self.laura_wallet = Wallet(self.blockchains["a"])
+        self.node.add_account(self.wallet)
+        self.node.set_blockreward_pubkey(self.wallet.pubkey)
+
+    def tearDown(self):
+        for gossip in self.network.values():
+            gossip.close()
+
+    def test_blocks_and_transactions_reach_every_peer(self):
+        self.node.mine()
+        c = self.blockchains["c"]
+        self.assertTrue(wait_for(lambda: len(c.chain) == 1))
+
+        self.wallet.send(self.laura_wallet.pubkey, 10)
+        tx = self.blockchains["a"].pending_transactions[0]
+        self.assertTrue(wait_for(lambda: tx.id() in c.mempool))
+
+        self.node.mine()
+        self.assertTrue(wait_for(lambda: len(c.chain) == 2))
+        self.assertEqual(c.chain[1].hash(), self.blockchains["a"].chain[1].hash())
+        self.assertTrue(wait_for(lambda: len(c.mempool) == 0))
+        self.assertEqual(c.get_balance(self.laura_wallet.pubkey), 10)
+
+    def test_messages_are_relayed_once(self):
+        self.node.mine()
+        self.wallet.send(self.laura_wallet.pubkey, 10)
+        c = self.blockchains["c"]
+        self.assertTrue(wait_for(lambda: len(c.mempool) == 1))
+        # Let any echoes settle
+        self.assertTrue(
+            wait_for(
+                lambda: all(
+                    stats["queued"] == 0
+                    for gossip in self.network.values()
+                    for stats in gossip.stats().values()
+                )
+            )
+        )
+        time.sleep(0.1)
+
+        sent = {
+            name: {peer: stats["sent"] for peer, stats in gossip.stats().items()}
+            for name, gossip in self.network.items()
+        }
+        # The block and the transaction, once over each link in each direction at most
+        for peers in sent.values():
+            for count in peers.values():
+                self.assertLessEqual(count, 2)
+
+    def test_invalid_blocks_are_not_relayed(self):
+        self.node.mine()
+        b = self.blockchains["b"]
+        self.assertTrue(wait_for(lambda: len(self.blockchains["c"].chain) == 1))
+        genesis = b.chain[0]
+        coinbase_tx = Transaction(self.wallet.pubkey, self.wallet.pubkey, 50)
+        block = Block(genesis.hash(), 0, {"coinbase": coinbase_tx, "regular": []})
+        while block.valid_proof():
+            block.nonce += 1
+        sent = self.network["b"].stats()["c"]["sent"]
+
+        accepted = self.network["b"].receive({"blocks": [block.json_serialize()]})
+
+        self.assertEqual(accepted["blocks"], 0)
+        self.assertEqual(len(b.chain), 1)
+        self.assertEqual(self.network["b"].stats()["c"]["sent"], sent)
+
+    def test_overdrawing_blocks_are_not_accepted(self):
+        self.node.mine()
+        b = self.blockchains["b"]
+        self.assertTrue(wait_for(lambda: len(b.chain) == 1))
+        tx = Transaction(self.wallet.pubkey, self.laura_wallet.pubkey, 51)
+        tx.signature = self.wallet.sign(tx)
+        # Mined on a copy of the chain, its miner doesn't check balances
+        copy = Blockchain.json_deserialize(b.json_serialize())
+        miner = Node(copy)
+        miner.set_blockreward_pubkey(self.wallet.pubkey)
+        block = miner.mine_block(copy.chain[0].hash(), [tx])
+
+        accepted = self.network["b"].receive({"blocks": [block.json_serialize()]})
+
+        self.assertEqual(accepted["blocks"], 0)
+        self.assertEqual(len(b.chain), 1)
+
+    def test_transactions_with_invalid_amounts_rejected(self):
+        b = self.blockchains["b"]
+        for amount, fee in ((-10, 0), (0, 0), (10, -1)):
+            tx = Transaction(
+                self.wallet.pubkey, self.laura_wallet.pubkey, amount, fee=fee
+            )
+            tx.signature = self.wallet.sign(tx)
+
+            accepted = self.network["b"].receive({"transactions": [tx.json_serialize()]})
+
+            self.assertEqual(accepted["transactions"], 0)
+            self.assertFalse(b.add_transaction(tx))
+        self.assertEqual(len(b.mempool), 0)
+
+    def test_malformed_payload_rejected(self):
+        for payload in ({"blocks": 5}, {"transactions": {"id": 1}}):
+            with self.assertRaises(ValueError):
+                self.network["b"].receive(payload)
+        accepted = self.network["b"].receive({"blocks": [5, None], "transactions": []})
+        self.assertEqual(accepted, {"blocks": 0, "transactions": 0})
+
+    def gossip_block(self, field, value):
+        """
+        Gossip a new Genesis block to b, with `field` set to `value`
+        """
+        blockchain = Blockchain()
+        node = Node(blockchain)
+        node.set_blockreward_pubkey(self.wallet.pubkey)
+        json_block = node.mine().json_serialize()
+        json_block[field] = value
+        return self.network["b"].receive({"blocks": [json_block]})
+
+    def gossip_transaction(self, field, value):
+        """
+        Gossip a new transaction to b, with `field` set to `value`
+        """
+        tx = Transaction(self.wallet.pubkey, self.laura_wallet.pubkey, 10)
+        tx.signature = self.wallet.sign(tx)
+        json_tx = tx.json_serialize()
+        json_tx[field] = value
+        return self.network["b"].receive({"transactions": [json_tx]})
+
+    def test_block_with_numeric_previous_hash_skipped(self):
+        accepted = self.gossip_block("previous_hash", 5)
+        self.assertEqual(accepted, {"blocks": 0, "transactions": 0})
+
+    def test_block_with_text_timestamp_skipped(self):
+        accepted = self.gossip_block("timestamp", "abc")
+        self.assertEqual(accepted, {"blocks": 0, "transactions": 0})
+
+    def test_block_with_text_proof_skipped(self):
+        accepted = self.gossip_block("proof", "x")
+        self.assertEqual(accepted, {"blocks": 0, "transactions": 0})
+
+    def test_transaction_with_numeric_sender_skipped(self):
+        accepted = self.gossip_transaction("sender", 5)
+        self.assertEqual(accepted, {"blocks": 0, "transactions": 0})
+
+    def test_transaction_with_oversized_amount_skipped(self):
+        accepted = self.gossip_transaction("amount", 2**70)
+        self.assertEqual(accepted, {"blocks": 0, "transactions": 0})
+        self.assertEqual(len(self.blockchains["b"].mempool), 0)
+
+    def test_full_peer_queue_drops_messages(self):
+        release = threading.Event()
+        batches = []
+
+        def send(peer, batch):
+            release.wait(10)
+            batches.append(batch)
+            return True
+
+        queue = PeerQueue("slow", send, max_size=2, batch_size=10, flush_interval=0)
+        try:
+            self.assertTrue(queue.put("transactions", 1))
+            # The first message is taken off the queue and stuck in flight
+            self.assertTrue(wait_for(lambda: queue.stats()["queued"] == 0))
+            self.assertTrue(queue.put("transactions", 2))
+            self.assertTrue(queue.put("transactions", 3))
+            self.assertFalse(queue.put("transactions", 4))
+            self.assertEqual(queue.stats()["dropped"], 1)
+
+            release.set()
+            self.assertTrue(wait_for(lambda: queue.stats()["sent"] == 3))
+            self.assertEqual(
+                [message for batch in batches for _, message in batch], [1, 2, 3]
+            )
+        finally:
+            release.set()
+            queue.close()
+
+
+class TestRWLock(unittest.TestCase):
+    def test_readers_share_the_lock(self):
+        lock = RWLock()
+        both_reading = threading.Barrier(2, timeout=5)
+
+        def read():
+            with lock.read():
+                both_reading.wait()
+
+        threads = [threading.Thread(target=read) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+        self.assertFalse(both_reading.broken)
+
+    def test_writer_excludes_readers(self):
+        lock = RWLock()
+        events = []
+
+        def read():
+            with lock.read():
+                events.append("read")
+
+        lock.acquire_write()
+        reader = threading.Thread(target=read)
+        reader.start()
+        reader.join(timeout=0.1)
+        events.append("write done")
+        lock.release_write()
+        reader.join(timeout=5)
+
+        self.assertEqual(events, ["write done", "read"])
+
+    def test_reentrancy(self):
+        lock = RWLock()
+        with lock.write():
+            with lock.write():
+                with lock.read():
+                    pass
+        with lock.read():
+            with lock.read():
+                with self.assertRaises(RuntimeError):
+                    lock.acquire_write()
+        # Fully released
+        with lock.write():
+            pass
+
+    def test_concurrent_reads_see_whole_blocks(self):
+        blockchain = Blockchain()
+        node = Node(blockchain)
+        wallet = Wallet(blockchain)
+        laura_wallet = Wallet(blockchain)
+        node.add_account(wallet)
+        node.set_blockreward_pubkey(wallet.pubkey)
+        node.mine()
+        errors = []
+        stop = threading.Event()
+
+        def read():
+            while not stop.is_set():
+                try:
+                    with blockchain.lock.read():
+                        height = len(blockchain.chain)
+                        headers = blockchain.headers(0, height)
+                        total = blockchain.get_balance(
+                            wallet.pubkey
+                        ) + blockchain.get_balance(laura_wallet.pubkey)
+                    self.assertEqual(len(headers), height)
+                    self.assertEqual(total, 50 * height)
+                except Exception as error:
+                    errors.append(error)
+                    return
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for reader in readers:
+            reader.start()
+        for amount in range(1, 6):
+            wallet.send(laura_wallet.pubkey, amount)
+            node.mine()
+        stop.set()
+        for reader in readers:
+            reader.join(timeout=10)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(blockchain.chain), 6)
+
+
+class TestChainStreaming(unittest.TestCase):
+    def setUp(self):
+        self.blockchain = Blockchain()
+        self.node = Node(self.blockchain)
+        self.wallet = Wallet(self.blockchain)
+        self.node.add_account(self.wallet)
+        self.node.set_blockreward_pubkey(self.wallet.pubkey)
+        for _ in range(3):
+            self.node.mine()
+
+    def test_streamed_json_matches_chain(self):
+        snapshot = self.blockchain.snapshot(1)
+        body = b"".join(buffered(json_chain_parts(snapshot, {"from": 1}), size=100))
+
+        document = json.loads(body)
+        expected = self.blockchain.json_serialize()["chain"][1:]
+        self.assertEqual(document, {"chain": expected, "from": 1})
+
+    def test_gzipped_stream_round_trip(self):
+        snapshot = self.blockchain.snapshot()
+        parts = encode_chain_parts(
+            len(snapshot), (block.binary_serialize() for block in snapshot)
+        )
+        body = gzip.decompress(b"".join(gzipped(buffered(parts))))
+
+        self.assertEqual(body, encode_chain(self.blockchain.binary_blocks(0, 3)))
+
+    def test_etag_follows_the_fields(self):
+        tip = self.blockchain.get_latest_block().hash()
+        fields = {"pending_transactions": [], "peers": ["a:5000"]}
+        swapped_peer = {"pending_transactions": [], "peers": ["b:5000"]}
+
+        self.assertEqual(chain_etag(tip), tip)
+        self.assertEqual(chain_etag(None), "empty")
+        self.assertEqual(chain_etag(tip, fields), chain_etag(tip, dict(fields)))
+        self.assertNotEqual(chain_etag(tip, fields), chain_etag(tip, swapped_peer))
+        self.assertNotEqual(chain_etag(tip, fields), chain_etag(tip))
+
+    def test_snapshot_ignores_new_blocks(self):
+        snapshot = self.blockchain.snapshot()
+        self.node.mine()
+
+        self.assertEqual(len(list(snapshot)), 3)
+        self.assertEqual(snapshot.tip, self.blockchain.chain[2].hash())
+
+    def test_snapshot_of_replaced_chain_fails(self):
+        snapshot = self.blockchain.snapshot(0, 2)
+        self.blockchain.set_chain(self.blockchain.chain[:1])
+        self.node.mine()
+
+        with self.assertRaises(ChainChanged):
+            list(snapshot)
+
+
 if __name__ == "__main__":
     unittest.main()